@@ -0,0 +1,1049 @@
+"""
+Benchmarks for the bot's hot paths. Runs offline unless a subcommand says otherwise.
+
+    python bench.py preprocess [--corpus DIR] [--live]
+    python bench.py chartfilter [--corpus DIR] [--threshold T]
+    python bench.py parse [--fuzz N]
+    python bench.py runtimes [--scenario text|photo|...] [--levels N ...] [--updates N]
+    python bench.py router [--requests N] [--tail-ratio R]
+    python bench.py load [--runtime bot.py|bot_async.py] [--scenarios text group photo album document mixed] [--replay FILE]
+    python bench.py startup [--runtime bot.py|bot_async.py] [--modes eager lazy background] [--repeat N]
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+
+
+def load_bot():
+    """Imports bot.py with placeholder credentials so its helpers can be benchmarked without a deployment."""
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("RENDER_EXTERNAL_HOSTNAME", "localhost")
+    os.environ.setdefault("SETTINGS_BACKEND", "json") # Never migrate or rewrite real chat settings from a benchmark
+    import bot
+    return bot
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+# ========== IMAGE PREPROCESSING ==========
+CHART_THEMES = {
+    # background, grid, up colour, down colour
+    'dark': ((19, 23, 34), (42, 46, 57), (38, 166, 154), (239, 83, 80)),
+    'light': ((255, 255, 255), (240, 243, 250), (8, 153, 129), (242, 54, 69)),
+    'classic': ((0, 0, 0), (40, 40, 40), (0, 200, 0), (220, 0, 0)),
+    'mono': ((250, 250, 250), (225, 225, 225), (90, 90, 90), (20, 20, 20)),
+}
+
+
+def synthetic_chart(width=1600, height=1000, candles=80, seed=0, theme='dark', style='candles', chrome=False, quality=95,
+                    overlays=0, volume=False, pane=None):
+    """
+    Draws a candlestick screenshot with a flat border, similar to what users send. style is 'candles',
+    'bars' or 'line'; chrome adds the text toolbars of a phone screenshot around the chart. overlays draws
+    that many moving-average lines over the price, volume adds volume bars under it and pane adds an
+    'rsi' or 'macd' indicator sub-pane below the chart.
+    """
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    background, grid, up, down = CHART_THEMES[theme]
+    img = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(img)
+    left, top, right, bottom = 60, 40, width - 120, height - 60
+    if chrome:
+        bar = height // 8
+        text = tuple(255 - c for c in background)
+        for y0 in (0, height - bar):
+            draw.rectangle([0, y0, width, y0 + bar], fill=grid)
+            for x in range(40, width - 200, width // 4):
+                draw.text((x, y0 + bar // 3), rng.choice(["BTCUSDT", "1h", "Indicators", "Trade", "+2.31%"]), fill=text)
+        top, bottom = bar + 40, height - bar - 60
+    if pane:
+        pane_top, pane_bottom = bottom - (bottom - top) // 4, bottom
+        bottom = pane_top - 20
+        draw.line([(left, pane_top - 10), (right, pane_top - 10)], fill=grid, width=2)
+    for y in range(top, bottom, 80):
+        draw.line([(left, y), (right, y)], fill=grid)
+    price = 100.0
+    step = (right - left) / candles
+    prices = []
+    for _ in range(candles):
+        open_ = price
+        close = price + rng.gauss(0, 2)
+        prices.append((open_, close, max(open_, close) + abs(rng.gauss(0, 1)), min(open_, close) - abs(rng.gauss(0, 1))))
+        price = close
+    lo = min(p[3] for p in prices)
+    hi = max(p[2] for p in prices)
+    scale = lambda v: bottom - (v - lo) / (hi - lo) * (bottom - top)
+    if volume:
+        volumes = [abs(rng.gauss(1, 0.5)) + 0.1 for _ in prices]
+        for i, ((open_, close, _, _), size) in enumerate(zip(prices, volumes)):
+            x = left + i * step + step / 2
+            faded = tuple((c + b) // 2 for c, b in zip(up if close >= open_ else down, background))
+            draw.rectangle([x - step * 0.35, bottom - size / max(volumes) * (bottom - top) * 0.2, x + step * 0.35, bottom], fill=faded)
+    if style == 'line':
+        draw.line([(left + i * step + step / 2, scale(close)) for i, (_, close, _, _) in enumerate(prices)], fill=up, width=3)
+    for i, (open_, close, high, low) in enumerate(prices):
+        if style == 'line':
+            break
+        x = left + i * step + step / 2
+        colour = up if close >= open_ else down
+        draw.line([(x, scale(high)), (x, scale(low))], fill=colour, width=1 if style == 'candles' else 2)
+        if style == 'bars':
+            draw.line([(x - step * 0.35, scale(open_)), (x, scale(open_))], fill=colour, width=2)
+            draw.line([(x, scale(close)), (x + step * 0.35, scale(close))], fill=colour, width=2)
+        else:
+            draw.rectangle([x - step * 0.35, scale(max(open_, close)), x + step * 0.35, scale(min(open_, close))], fill=colour)
+    closes = [close for _, close, _, _ in prices]
+    for period, colour in list(zip((9, 21, 50, 100), ((41, 98, 255), (255, 152, 0), (156, 39, 176), (0, 188, 212))))[:overlays]:
+        average = [sum(closes[max(0, i - period + 1):i + 1]) / (i + 1 - max(0, i - period + 1)) for i in range(len(closes))]
+        draw.line([(left + i * step + step / 2, scale(v)) for i, v in enumerate(average)], fill=colour, width=2)
+    if pane == 'rsi':
+        values = [50 + 40 * math.sin(i / 6 + seed) * rng.uniform(0.6, 1) for i in range(candles)]
+        for level in (30, 70):
+            y = pane_bottom - level / 100 * (pane_bottom - pane_top)
+            draw.line([(left, y), (right, y)], fill=grid)
+        draw.line([(left + i * step + step / 2, pane_bottom - v / 100 * (pane_bottom - pane_top)) for i, v in enumerate(values)],
+                  fill=(126, 87, 194), width=2)
+    elif pane == 'macd':
+        middle = (pane_top + pane_bottom) / 2
+        half = (pane_bottom - pane_top) / 2
+        macd = [math.sin(i / 8 + seed) * rng.uniform(0.7, 1) for i in range(candles)]
+        signal = [sum(macd[max(0, i - 8):i + 1]) / (i + 1 - max(0, i - 8)) for i in range(candles)]
+        for i, (m, sig) in enumerate(zip(macd, signal)):
+            x = left + i * step + step / 2
+            draw.rectangle([x - step * 0.3, min(middle, middle - (m - sig) * half), x + step * 0.3, max(middle, middle - (m - sig) * half)],
+                           fill=up if m >= sig else down)
+        draw.line([(left + i * step + step / 2, middle - m * half * 0.9) for i, m in enumerate(macd)], fill=(41, 98, 255), width=2)
+        draw.line([(left + i * step + step / 2, middle - sig * half * 0.9) for i, sig in enumerate(signal)], fill=(255, 152, 0), width=2)
+    for y in range(top, bottom, 80):
+        draw.text((right + 10, y - 5), f"{hi - (y - top) / (bottom - top) * (hi - lo):.2f}", fill=(120, 123, 134))
+    open_, high, low, close = prices[-1][0], prices[-1][2], prices[-1][3], prices[-1][1]
+    draw.text((left + 10, top - 30), f"BTCUSDT  1h  O {open_:.2f} H {high:.2f} L {low:.2f} C {close:.2f}", fill=(120, 123, 134))
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+
+CHART_VARIANTS = ('plain', 'overlay', 'volume', 'pane', 'full')
+NON_CHART_KINDS = ('photo', 'meme', 'blank', 'chat', 'document', 'table')
+
+
+def synthetic_non_chart(kind, width=1280, height=960, seed=0):
+    """
+    Draws a picture people send that is not a price chart: a camera photo, a meme, a blank or chat
+    screenshot, a text document or a spreadsheet (the last three are flat and axis-aligned like charts).
+    """
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+    rng = random.Random(seed)
+    colour = lambda lo=0, hi=255: tuple(rng.randint(lo, hi) for _ in range(3))
+    words = ["the", "price", "meeting", "tomorrow", "ok", "thanks", "lunch", "see", "you", "at", "12:30", "report"]
+    line = lambda n: " ".join(rng.choice(words) for _ in range(n))
+
+    if kind in ('photo', 'meme'):
+        img = Image.new('RGB', (4, 3))
+        img.putdata([colour() for _ in range(12)])
+        img = img.resize((width, height), Image.BICUBIC)
+        draw = ImageDraw.Draw(img)
+        for _ in range(rng.randint(3, 8)):
+            x, y, r = rng.randint(0, width), rng.randint(0, height), rng.randint(40, 300)
+            draw.ellipse([x - r, y - r * 1.3, x + r, y + r * 1.3], fill=colour())
+        img = img.filter(ImageFilter.GaussianBlur(rng.uniform(2, 10)))
+        noise = Image.effect_noise((width, height), rng.uniform(10, 30)).convert('RGB')
+        img = Image.blend(img, noise, 0.15)
+        if kind == 'meme':
+            try:
+                font = ImageFont.load_default(size=height // 10)
+            except TypeError: # Pillow < 10.1 only has the small bitmap font
+                font = ImageFont.load_default()
+            draw = ImageDraw.Draw(img)
+            for y in (height // 20, height - height // 6):
+                draw.text((width // 12, y), line(3).upper(), font=font, fill=(255, 255, 255), stroke_width=4, stroke_fill=(0, 0, 0))
+    elif kind == 'blank':
+        img = Image.new('RGB', (width, height), colour(200))
+        ImageDraw.Draw(img).text((width // 2, height // 2), line(2), fill=colour(0, 120))
+    elif kind == 'chat':
+        img = Image.new('RGB', (width, height), rng.choice([(230, 221, 212), (255, 255, 255), (14, 22, 33)]))
+        draw = ImageDraw.Draw(img)
+        y = 20
+        while y < height - 80:
+            mine = rng.random() < 0.5
+            w, h = rng.randint(width // 4, width * 2 // 3), rng.randint(50, 140)
+            x = width - w - 20 if mine else 20
+            draw.rounded_rectangle([x, y, x + w, y + h], 18, fill=(220, 248, 198) if mine else (250, 250, 250))
+            for ty in range(y + 12, y + h - 15, 18):
+                draw.text((x + 14, ty), line(rng.randint(2, 6)), fill=(30, 30, 30))
+            y += h + rng.randint(10, 30)
+    elif kind == 'document':
+        img = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        for y in range(60, height - 60, 22):
+            if rng.random() < 0.85:
+                draw.text((60, y), line(rng.randint(6, 18)), fill=(20, 20, 20))
+    elif kind == 'table':
+        img = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        cols, rows = rng.randint(4, 9), rng.randint(10, 30)
+        cw, rh = width // cols, height // rows
+        draw.rectangle([0, 0, width, rh], fill=(217, 225, 242))
+        for r in range(rows):
+            for c in range(cols):
+                draw.text((c * cw + 6, r * rh + rh // 3), f"{rng.uniform(0, 9999):.2f}", fill=(0, 0, 0))
+        for x in range(0, width, cw):
+            draw.line([(x, 0), (x, height)], fill=(190, 190, 190))
+        for y in range(0, height, rh):
+            draw.line([(0, y), (width, y)], fill=(190, 190, 190))
+    else:
+        raise ValueError(f"unknown kind {kind}")
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=rng.randint(70, 95))
+    return out.getvalue()
+
+
+def chart_filter_corpus(corpus_dir, count):
+    """
+    Returns [(name, is_chart, bytes)]: a synthetic set of `count` charts of every variant (plain, moving-average
+    overlays, volume bars, an RSI or MACD sub-pane, and all of them together) across themes, styles and sizes,
+    plus `count` pictures of every non-chart kind. Labeled real screenshots under corpus_dir/chart and
+    corpus_dir/other are added to it; tune CHART_FILTER_THRESHOLD on those before enabling the filter.
+    """
+    corpus = []
+    if corpus_dir:
+        corpus += [(f"{label}/{name}", label == 'chart', open(os.path.join(corpus_dir, label, name), 'rb').read())
+                   for label in ('chart', 'other') if os.path.isdir(os.path.join(corpus_dir, label))
+                   for name in sorted(os.listdir(os.path.join(corpus_dir, label)))
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+    rng = random.Random(21)
+    for variant in CHART_VARIANTS:
+        for i in range(count):
+            theme = rng.choice(list(CHART_THEMES))
+            style = rng.choice(['candles', 'candles', 'bars', 'line'])
+            portrait = rng.random() < 0.3
+            width, height = (rng.randint(700, 1100), rng.randint(1400, 2200)) if portrait else (rng.randint(900, 1900), rng.randint(600, 1100))
+            options = {
+                'plain': {},
+                'overlay': {'overlays': rng.randint(1, 4)},
+                'volume': {'volume': True},
+                'pane': {'pane': rng.choice(['rsi', 'macd'])},
+                'full': {'overlays': rng.randint(2, 4), 'volume': True, 'pane': rng.choice(['rsi', 'macd'])},
+            }[variant]
+            corpus.append((f"chart_{variant}_{theme}_{style}_{i}.jpg", True, synthetic_chart(
+                width, height, rng.randint(30, 150), seed=i, theme=theme, style=style, chrome=portrait,
+                quality=rng.randint(60, 95), **options)))
+    for kind in NON_CHART_KINDS:
+        for i in range(count):
+            portrait = rng.random() < 0.4
+            size = (rng.randint(700, 1100), rng.randint(1300, 2000)) if portrait else (rng.randint(900, 1900), rng.randint(600, 1100))
+            corpus.append((f"{kind}_{i}.jpg", False, synthetic_non_chart(kind, *size, seed=i)))
+    return corpus
+
+
+def load_corpus(corpus_dir, count):
+    if corpus_dir:
+        return [(name, open(os.path.join(corpus_dir, name), 'rb').read())
+                for name in sorted(os.listdir(corpus_dir))
+                if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+    return [(f"synthetic_{i}.jpg", synthetic_chart(seed=i)) for i in range(count)]
+
+
+def psnr(original, processed):
+    """Peak signal-to-noise ratio of processed against original, after scaling it back up to the same size."""
+    from PIL import ImageChops, ImageStat
+    processed = processed.resize(original.size)
+    mse = sum(v * v for v in ImageStat.Stat(ImageChops.difference(original, processed)).rms) / 3
+    return float('inf') if mse == 0 else 20 * math.log10(255 / math.sqrt(mse))
+
+
+def bench_preprocess(args):
+    bot = load_bot()
+    if bot.Image is None:
+        sys.exit("Pillow is required for the preprocessing benchmark (pip install pillow).")
+    from PIL import Image
+
+    corpus = load_corpus(args.corpus, args.count)
+    rows = []
+    for name, data in corpus:
+        start = time.perf_counter()
+        processed, mime_type = bot.preprocess_chart_image(data)
+        elapsed = time.perf_counter() - start
+
+        original = Image.open(io.BytesIO(data)).convert('RGB')
+        bbox = bot.find_chart_bbox(original) if bot.IMAGE_AUTOCROP else None
+        reference = original.crop(bbox) if bbox else original
+        quality = psnr(reference, Image.open(io.BytesIO(processed)).convert('RGB'))
+
+        row = {'name': name, 'bytes_in': len(data), 'bytes_out': len(processed), 'ms': elapsed * 1000,
+               'psnr': quality, 'mime_type': mime_type}
+        if args.live:
+            row.update(live_model_call(bot, data, 'image/jpeg', 'orig'))
+            row.update(live_model_call(bot, processed, mime_type, 'proc'))
+        rows.append(row)
+
+    print(f"{'image':<24}{'bytes in':>10}{'bytes out':>11}{'ratio':>8}{'ms':>8}{'PSNR dB':>9}")
+    for row in rows:
+        print(f"{row['name'][:23]:<24}{row['bytes_in']:>10}{row['bytes_out']:>11}"
+              f"{row['bytes_out'] / row['bytes_in']:>8.2f}{row['ms']:>8.1f}{row['psnr']:>9.1f}")
+        if args.live:
+            print(f"    model: original {row['orig_tokens']} tokens / {row['orig_ms']:.0f}ms, "
+                  f"processed {row['proc_tokens']} tokens / {row['proc_ms']:.0f}ms")
+    total_in = sum(row['bytes_in'] for row in rows)
+    total_out = sum(row['bytes_out'] for row in rows)
+    latencies = [row['ms'] for row in rows]
+    print(f"\n{len(rows)} images, {total_in} -> {total_out} bytes ({total_out / total_in:.1%}), "
+          f"preprocess p50 {percentile(latencies, 50):.1f}ms p95 {percentile(latencies, 95):.1f}ms, "
+          f"median PSNR {statistics.median(row['psnr'] for row in rows):.1f} dB")
+
+
+def bench_chartfilter(args):
+    bot = load_bot()
+    if bot.Image is None or bot.np is None:
+        sys.exit("Pillow and NumPy are required for the chart pre-filter benchmark (pip install pillow numpy).")
+    args.threshold = (bot.CHART_FILTER_THRESHOLD or 0.35) if args.threshold is None else args.threshold
+    args.side = bot.CHART_FILTER_SIDE if args.side is None else args.side
+
+    corpus = chart_filter_corpus(args.corpus, args.count)
+    if args.save:
+        for name, is_chart, data in corpus:
+            folder = os.path.join(args.save, 'chart' if is_chart else 'other')
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, os.path.basename(name)), 'wb') as f:
+                f.write(data)
+        print(f"Wrote {len(corpus)} images to {args.save}/chart and {args.save}/other")
+
+    rows = []
+    for name, is_chart, data in corpus:
+        bot.chart_likelihood(data, args.side) # Untimed first pass, so file-system and allocator warm-up isn't measured
+        start = time.perf_counter()
+        score = bot.chart_likelihood(data, args.side)
+        rows.append((name, is_chart, score, (time.perf_counter() - start) * 1000))
+
+    def confusion(threshold):
+        tp = sum(1 for _, is_chart, score, _ in rows if is_chart and score >= threshold)
+        fp = sum(1 for _, is_chart, score, _ in rows if not is_chart and score >= threshold)
+        fn = sum(1 for _, is_chart, score, _ in rows if is_chart and score < threshold)
+        tn = len(rows) - tp - fp - fn
+        return tp, fp, fn, tn, tp / max(1, tp + fp), tp / max(1, tp + fn)
+
+    print(f"{'threshold':>9}{'TP':>6}{'FP':>6}{'FN':>6}{'TN':>6}{'precision':>11}{'recall':>8}")
+    for threshold in sorted({*(round(t * 0.05, 2) for t in range(2, 19)), args.threshold}):
+        tp, fp, fn, tn, precision, recall = confusion(threshold)
+        marker = '  <' if threshold == args.threshold else ''
+        print(f"{threshold:>9.2f}{tp:>6}{fp:>6}{fn:>6}{tn:>6}{precision:>11.3f}{recall:>8.3f}{marker}")
+
+    print(f"\n{'group':<24}{'n':>5}{'min':>7}{'median':>8}{'max':>7}")
+    groups = {}
+    for name, is_chart, score, _ in rows:
+        stem = re.sub(r'^chart_|_\d+$', '', os.path.splitext(os.path.basename(name))[0]).split('_')[0]
+        groups.setdefault(f"{'chart' if is_chart else 'other'}/{stem}", []).append(score)
+    for group, scores in sorted(groups.items()):
+        print(f"{group[:23]:<24}{len(scores):>5}{min(scores):>7.2f}{statistics.median(scores):>8.2f}{max(scores):>7.2f}")
+
+    wrong = [(name, score) for name, is_chart, score, _ in rows if (score >= args.threshold) != is_chart]
+    if wrong:
+        print(f"\nMisclassified at {args.threshold}:")
+        for name, score in wrong:
+            print(f"    {name} {score:.2f}")
+    latencies = [ms for _, _, _, ms in rows]
+    tp, fp, fn, tn, precision, recall = confusion(args.threshold)
+    print(f"\n{len(rows)} images, threshold {args.threshold}: precision {precision:.3f} recall {recall:.3f}, "
+          f"score p50 {percentile(latencies, 50):.1f}ms p95 {percentile(latencies, 95):.1f}ms max {max(latencies):.1f}ms, "
+          f"{fp + tn} non-charts of which {tn} never reach Gemini")
+
+
+def live_model_call(bot, image_bytes, mime_type, prefix):
+    """Sends one image to Gemini with the general analysis prompt and reports prompt tokens and latency."""
+    start = time.perf_counter()
+    response = bot.chart_router.call(lambda backend: backend.client.generate_content(
+        [bot.ANALYZE_INSTRUCTION_EN, {'mime_type': mime_type, 'data': image_bytes}]))
+    return {f'{prefix}_ms': (time.perf_counter() - start) * 1000,
+            f'{prefix}_tokens': response.usage_metadata.prompt_token_count}
+
+
+# ========== SETUP SIGNAL PARSING ==========
+# Shapes of replies Gemini has produced for the Swing/Scalp prompts
+SAMPLE_SETUP_REPLIES = [
+    '{"Pair": "XAUUSD", "Position": "Long", "Entry": "2331.50", "TP": "2352.00", "SL": "2324.80", "RR": "1:3.06", "Reason": "Bullish OB at H1 after liquidity sweep below Asian low."}',
+    '```json\n{\n  "Pair": "BTC/USDT",\n  "Position": "Short",\n  "Entry": "67250",\n  "TP": "65900",\n  "SL": "67700",\n  "RR": "1:3.00",\n  "Reason": "Bearish FVG {H4} rejected; BOS to the downside."\n}\n```',
+    'Here is the setup you asked for:\n```json\n[{"Pair": "EURUSD", "Position": "Long", "Entry": "1.0842", "TP": "1.0901", "SL": "1.0823", "RR": "1:3.11", "Reason": "Demand zone + \\"inducement\\" sweep."}]\n```\nTrade safe!',
+    '{"Pair": "SOL/USDT", "Position": "N/A", "Entry": "N/A", "TP": "N/A", "SL": "N/A", "RR": "N/A", "Reason": "Chart is unclear, no valid setup."}',
+    'Based on the chart {H1}, the best setup is: {"Pair": "GBPJPY", "Position": "Short", "Entry": "198.40", "TP": "197.10", "SL": "198.85", "RR": "1:2.89", "Reason": "Premium zone, CHoCH on M15."} Note: not financial advice.',
+    '```json\n{"Pair": "NAS100", "Position": "Long", "Entry": 18250, "TP": 18420, "SL": 18195, "RR": "1:3.09", "Reason": "Sell-side liquidity taken, bullish displacement."}\n```',
+]
+
+
+def legacy_parse_setup(raw_reply):
+    """The regex cascade handle_photo used before extract_first_json_object, kept for comparison."""
+    json_match = re.search(r'```json\s*([\[\{].*?[\]\}])\s*```', raw_reply, re.DOTALL)
+    json_string = None
+    if json_match:
+        json_string = json_match.group(1).strip()
+    else:
+        clean_raw_reply = re.sub(r'^[^{[]*|[^}\]]*$', '', raw_reply.strip())
+        if clean_raw_reply.startswith('{') and clean_raw_reply.endswith('}'):
+            json_string = clean_raw_reply
+        elif clean_raw_reply.startswith('[') and clean_raw_reply.endswith(']'):
+            json_string = clean_raw_reply
+        else:
+            potential_objects = re.findall(r'\{[^}]*?\}', clean_raw_reply, re.DOTALL)
+            if potential_objects:
+                json_string = potential_objects[0]
+    if not json_string:
+        return None
+    try:
+        parsed = json.loads(json_string)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(parsed, list):
+        return parsed[0] if parsed else None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def fuzz_replies(seed_replies, count, seed=0):
+    """Mutates real replies the way models misbehave: prose around the JSON, stray braces, truncation, noise."""
+    rng = random.Random(seed)
+    noise = ['Sure! ', 'Note: {not json} ', '\n\n', '```', '}', '{', 'Reason: "quoted" ', '[', ']', '\\']
+    mutated = []
+    for _ in range(count):
+        reply = rng.choice(seed_replies)
+        for _ in range(rng.randint(1, 3)):
+            action = rng.random()
+            if action < 0.4:
+                reply = rng.choice(noise) + reply
+            elif action < 0.8:
+                reply = reply + rng.choice(noise)
+            elif action < 0.9:
+                reply = reply[:rng.randint(1, len(reply))]
+            else:
+                pos = rng.randint(0, len(reply))
+                reply = reply[:pos] + rng.choice(noise) + reply[pos:]
+        mutated.append(reply)
+    return mutated
+
+
+def bench_parse(args):
+    bot = load_bot()
+    corpus = SAMPLE_SETUP_REPLIES + fuzz_replies(SAMPLE_SETUP_REPLIES, args.fuzz)
+    expected = [legacy_parse_setup(reply) or bot.extract_first_json_object(reply) for reply in corpus]
+
+    parsers = {
+        'legacy regex cascade': legacy_parse_setup,
+        'parse_setup_signal': lambda reply: bot.parse_setup_signal(reply)[0],
+    }
+    print(f"{len(corpus)} replies ({len(SAMPLE_SETUP_REPLIES)} samples + {args.fuzz} fuzzed)\n")
+    print(f"{'parser':<24}{'parsed':>8}{'us/reply':>10}")
+    for name, parse in parsers.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            results = [parse(reply) for reply in corpus]
+        elapsed = (time.perf_counter() - start) / (args.repeat * len(corpus))
+        parsed = sum(1 for result in results if result)
+        print(f"{name:<24}{parsed:>8}{elapsed * 1e6:>10.1f}")
+
+    for reply, result in zip(corpus, (bot.parse_setup_signal(reply)[0] for reply in corpus)):
+        if result is None and reply in SAMPLE_SETUP_REPLIES:
+            print(f"\nFAILED on sample reply: {reply[:80]!r}")
+    missed = sum(1 for reply, want in zip(corpus, expected) if want and not bot.parse_setup_signal(reply)[0])
+    print(f"\nreplies another parser could read but parse_setup_signal could not: {missed}")
+
+
+# ========== BACKEND ROUTER ==========
+def run_stub_model_server(port, fast, slow, tail_ratio):
+    """
+    Local OpenAI-compatible chat completions API with one behaviour per path prefix:
+    /tail/ answers in `fast` seconds but `tail_ratio` of the time in `slow`, /fast/ always in `fast`,
+    /down/ always fails with a 503.
+    """
+    from aiohttp import web
+    rng = random.Random(7)
+
+    async def completions(request):
+        behaviour = request.match_info['behaviour']
+        if behaviour == 'down':
+            return web.json_response({'error': {'message': 'overloaded'}}, status=503)
+        await asyncio.sleep(slow if behaviour == 'tail' and rng.random() < tail_ratio else fast)
+        return web.json_response({
+            'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': 'stub',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'ok'}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 1, 'total_tokens': 11},
+        })
+
+    app = web.Application()
+    app.router.add_post('/{behaviour}/openai/v1/chat/completions', completions)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def bench_router(args):
+    bot = load_bot()
+    bot.HEDGE_MIN_DELAY = args.fast * 2 # Let the stub's short latencies drive hedging
+    import multiprocessing
+    server = multiprocessing.Process(target=run_stub_model_server, args=(args.port, args.fast, args.slow, args.tail_ratio), daemon=True)
+    server.start()
+    time.sleep(1.0)
+    base = f"http://127.0.0.1:{args.port}"
+    scenarios = [
+        ('tail, no hedging', f"groq:stub@{base}/tail,groq:stub@{base}/fast", False),
+        ('tail, hedging', f"groq:stub@{base}/tail,groq:stub@{base}/fast", True),
+        ('primary down', f"groq:stub@{base}/down,groq:stub@{base}/fast", True),
+        ('all down', f"groq:stub@{base}/down,groq:stub@{base}/down", True),
+    ]
+    messages = [{'role': 'user', 'content': 'what is an order block'}]
+    try:
+        print(f"{args.requests} calls per scenario, {args.tail_ratio:.0%} of /tail calls take {args.slow * 1000:.0f}ms\n")
+        print(f"{'scenario':<20}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'errors':>8}   per backend (calls/hedges/wins/failovers/breaker)")
+        for label, specs, hedge in scenarios:
+            router = bot.BackendRouter('bench', specs, args.timeout, hedge)
+            latencies, errors = [], 0
+            for _ in range(args.requests):
+                t0 = time.perf_counter()
+                try:
+                    router.call(lambda backend: backend.client.chat.completions.create(
+                        messages=messages, model=backend.model, timeout=backend.timeout))
+                except bot.BackendUnavailableError:
+                    errors += 1
+                latencies.append(time.perf_counter() - t0)
+            per_backend = "  ".join(
+                f"{backend.base_url.rsplit('/', 1)[-1]}={s['calls']}/{s['hedges']}/{s['hedge_wins']}/{s['failovers']}/{s['breaker']}"
+                for backend, s in ((b, b.snapshot()) for b in router.backends)
+            )
+            print(f"{label:<20}{percentile(latencies, 50) * 1000:>8.0f}{percentile(latencies, 95) * 1000:>8.0f}"
+                  f"{percentile(latencies, 99) * 1000:>8.0f}{errors:>8}   {per_backend}")
+    finally:
+        server.terminate()
+
+
+# ========== END-TO-END LOAD ==========
+SETUP_STUB_REPLY = json.dumps({'Pair': 'XAUUSD', 'Position': 'BUY', 'Entry': '2350', 'TP': '2380', 'SL': '2335',
+                               'RR': '1:2', 'Reason': 'Bullish order block retest'})
+
+
+MODEL_CALLS = ('chat.completions', 'generateContent') # How the fake services log model calls next to Bot API calls
+PLACEHOLDER_PREFIX = "⏳" # "⏳ Thinking..." and "⏳ Processing image..." are sent before the answer, not as it
+
+
+def synthetic_ohlc_csv(rows=5000, seed=0):
+    """Hourly XAUUSD-like candles with a header, like a platform export."""
+    rng = random.Random(seed)
+    price, start = 2000.0, 1_700_000_000
+    lines = ["time,open,high,low,close,volume"]
+    for i in range(rows):
+        close = price + rng.gauss(0, 3)
+        lines.append(f"{start + i * 3600},{price:.2f},{max(price, close) + abs(rng.gauss(0, 1)):.2f},"
+                     f"{min(price, close) - abs(rng.gauss(0, 1)):.2f},{close:.2f},{rng.randint(100, 5000)}")
+        price = close
+    return "\n".join(lines).encode()
+
+
+def run_fake_services(port, opts):
+    """
+    One local server standing in for the Telegram Bot API, Groq chat completions and Gemini generateContent.
+    Every Telegram call is logged with its chat id and time so the load driver can measure end-to-end latency,
+    and whether it is a final reply (a message or edit that isn't a "⏳ ..." placeholder); model calls are
+    logged without a chat id.
+    """
+    from aiohttp import web
+    rng = random.Random(11)
+    calls = [] # (time, method, chat_id, final)
+    webhook = {'url': ''}
+    message_ids = iter(range(1, 10 ** 9))
+    chart = synthetic_chart()
+    candles = synthetic_ohlc_csv()
+
+    async def telegram(request):
+        method = request.match_info['method']
+        if request.method == 'POST':
+            data = dict(await request.post())
+        else: # The asyncio client sends some GET calls (setWebhook, getWebhookInfo) with a form body
+            data = dict(urllib.parse.parse_qsl(await request.text())) if request.can_read_body else {}
+        data.update(request.query)
+        await asyncio.sleep(opts['telegram_latency'])
+        chat_id = data.get('chat_id')
+        if chat_id is not None and rng.random() < opts['telegram_error_rate']:
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry later',
+                                      'parameters': {'retry_after': 1}}, status=429)
+        final = method.startswith(('send', 'edit')) and method != 'sendChatAction' and not data.get('text', '').startswith(PLACEHOLDER_PREFIX)
+        calls.append((time.time(), method, chat_id, final))
+        if method == 'getMe':
+            result = {'id': 999, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getFile':
+            document = data.get('file_id', '').startswith('doc')
+            result = {'file_id': data.get('file_id'), 'file_unique_id': data.get('file_id'),
+                      'file_size': len(candles if document else chart),
+                      'file_path': f"documents/{data.get('file_id')}.csv" if document else f"photos/{data.get('file_id')}.jpg"}
+        elif method.startswith(('send', 'edit')):
+            result = {'message_id': next(message_ids), 'date': int(time.time()), 'text': data.get('text', ''),
+                      'chat': {'id': int(chat_id), 'type': 'supergroup' if str(chat_id).startswith('-') else 'private'}}
+        elif method == 'getWebhookInfo':
+            result = {'url': webhook['url'], 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method in ('setWebhook', 'deleteWebhook'):
+            webhook['url'] = data.get('url', '') if method == 'setWebhook' else ''
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def telegram_file(request):
+        if request.match_info['path'].startswith('documents/'):
+            return web.Response(body=candles, content_type='text/csv')
+        return web.Response(body=chart, content_type='image/jpeg')
+
+    def model_failure():
+        return rng.random() < opts['llm_error_rate']
+
+    async def groq(request):
+        body = await request.json()
+        calls.append((time.time(), MODEL_CALLS[0], None, False))
+        await asyncio.sleep(opts['llm_latency'])
+        if model_failure():
+            return web.json_response({'error': {'message': 'injected failure'}}, status=503)
+        words = [f"word{i} " for i in range(opts['llm_tokens'])]
+        if not body.get('stream'):
+            return web.json_response({
+                'id': 'bench', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': ''.join(words)}}],
+                'usage': {'prompt_tokens': 100, 'completion_tokens': len(words), 'total_tokens': 100 + len(words)},
+            })
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in words:
+            chunk = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(opts['llm_token_interval'])
+        # Like Groq, the last chunk carries the token usage under x_groq
+        chunk = {'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+                 'x_groq': {'id': 'bench', 'usage': {'prompt_tokens': 100, 'completion_tokens': len(words),
+                                                     'total_tokens': 100 + len(words)}}}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def gemini(request):
+        await request.read()
+        calls.append((time.time(), MODEL_CALLS[1], None, False))
+        await asyncio.sleep(opts['llm_latency'])
+        if model_failure():
+            return web.json_response({'error': {'code': 503, 'message': 'injected failure', 'status': 'UNAVAILABLE'}}, status=503)
+        return web.json_response({'candidates': [{'content': {'parts': [{'text': SETUP_STUB_REPLY}], 'role': 'model'},
+                                                  'finishReason': 'STOP', 'index': 0}],
+                                  'usageMetadata': {'promptTokenCount': 300, 'candidatesTokenCount': 60, 'totalTokenCount': 360}})
+
+    async def call_log(request):
+        return web.json_response(calls)
+
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app.router.add_route('*', '/bot{token}/{method}', telegram)
+    app.router.add_get('/file/bot{token}/{path:.*}', telegram_file)
+    app.router.add_post('/openai/v1/chat/completions', groq)
+    app.router.add_post('/v1beta/models/{model}:generateContent', gemini)
+    app.router.add_get('/_calls', call_log)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+ALBUM_SIZE = 3
+
+
+def synthetic_updates(scenario, count, start_id):
+    """Returns [(payload, chat_id or None if no reply is expected)] for one scenario."""
+    now = int(time.time())
+    updates = []
+    for i in range(count):
+        update_id = start_id + i
+        kind = scenario if scenario != 'mixed' else ('text', 'group', 'photo')[i % 3]
+        album = i // ALBUM_SIZE
+        if kind == 'text':
+            chat = {'id': 10_000 + update_id, 'type': 'private'}
+            message = {'text': f"what is an order block on timeframe {update_id}?"}
+        elif kind == 'group':
+            chat = {'id': -100_000 - update_id, 'type': 'supergroup', 'title': 'Bench'}
+            addressed = i % 2 == 0 # Half the group chatter isn't for the bot and must be dropped cheaply
+            message = ({'text': f"@bench_bot explain liquidity sweep {update_id}",
+                        'entities': [{'type': 'mention', 'offset': 0, 'length': 10}]} if addressed
+                       else {'text': f"gm everyone {update_id}"})
+        elif kind == 'document':
+            chat = {'id': 50_000 + update_id, 'type': 'private'}
+            message = {'document': {'file_id': f"doc{update_id}", 'file_unique_id': f"doc{update_id}",
+                                    'file_name': 'XAUUSD_H1.csv', 'mime_type': 'text/csv', 'file_size': 200_000}}
+        elif kind == 'photo':
+            chat = {'id': 20_000 + update_id, 'type': 'private'}
+            message = {'photo': [{'file_id': f"photo{update_id}", 'file_unique_id': f"photo{update_id}",
+                                  'width': 1600, 'height': 1000, 'file_size': 200_000}]}
+        else: # One chat sends ALBUM_SIZE charts (e.g. H4, H1, M15) as an album
+            chat = {'id': 30_000 + start_id + album, 'type': 'private'}
+            message = {'media_group_id': f"album{start_id + album}",
+                       'photo': [{'file_id': f"photo{update_id}", 'file_unique_id': f"photo{update_id}",
+                                  'width': 1600, 'height': 1000, 'file_size': 200_000}]}
+        message.update({'message_id': 1, 'date': now, 'chat': chat,
+                        'from': {'id': abs(chat['id']), 'is_bot': False, 'first_name': 'Bench'}})
+        expects_reply = (kind != 'group' or 'entities' in message) and (kind != 'album' or i % ALBUM_SIZE == 0)
+        updates.append((json.dumps({'update_id': update_id, 'message': message}), chat['id'] if expects_reply else None))
+    return updates
+
+
+def recorded_updates(path, start_id):
+    """Replays updates recorded with UPDATE_RECORD_FILE, renumbered so the dedup layer doesn't drop them."""
+    updates = []
+    with open(path) as f:
+        for i, line in enumerate(line for line in f if line.strip()):
+            payload = json.loads(line)
+            payload['update_id'] = start_id + i
+            updates.append((json.dumps(payload), None))
+    return updates
+
+
+def peak_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def fake_env(fake, bot_port, **overrides):
+    """Environment for a bot process that talks only to the fake services at fake."""
+    return {
+        **os.environ,
+        'BOT_TOKEN': '123456:bench', 'GROQ_API_KEY': 'bench', 'GEMINI_API_KEY': 'bench',
+        'RENDER_EXTERNAL_HOSTNAME': '127.0.0.1', 'PORT': str(bot_port),
+        'TELEGRAM_API_BASE': fake, 'GEMINI_API_ENDPOINT': fake,
+        'LEARN_BACKENDS': f"groq:llama-3.1-8b-instant@{fake}", 'CHART_BACKENDS': "gemini:gemini-1.5-flash",
+        'SETTINGS_BACKEND': 'json', 'CHAT_RATE_PER_MINUTE': '1000',
+        # Synthetic questions are near-duplicates, so the answer cache would hide the model path unless asked for
+        'LEARN_CACHE_SIZE': os.environ.get('LEARN_CACHE_SIZE', '0'),
+        **overrides,
+    }
+
+
+def start_bot(runtime, workdir, env):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), runtime)
+    return subprocess.Popen([sys.executable, '-W', 'ignore', script], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_serving(session, url, runtime, timeout=10.0):
+    import requests
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            session.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.01)
+    raise RuntimeError(f"{runtime} did not start, run it by hand with the same env to see why")
+
+
+def run_load_scenario(args, label, updates, fake_port, bot_port, env=None):
+    """Starts a fresh bot process against the fake services, posts the updates and measures them. env overrides the bot's settings."""
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+
+    workdir = tempfile.mkdtemp(prefix='bench-load-')
+    settings = {} # Chats sending photos start in Swing mode, so their charts reach Gemini
+    for payload, _ in updates:
+        message = json.loads(payload).get('message') or {}
+        if 'photo' in message:
+            settings[str(message['chat']['id'])] = {'lang': 'en', 'mode': 'setup', 'sub_mode': 'swing'}
+    with open(os.path.join(workdir, 'user_data.json'), 'w') as f:
+        json.dump(settings, f)
+    fake = f"http://127.0.0.1:{fake_port}"
+    bot_process = start_bot(args.runtime, workdir, fake_env(fake, bot_port, **(env or {})))
+    session = requests.Session()
+    url = f"http://127.0.0.1:{bot_port}"
+    try:
+        wait_until_serving(session, url, args.runtime)
+
+        posted_at = {}
+        ack_latencies = []
+        failed = 0
+
+        def post(item):
+            payload, chat_id = item
+            t0 = time.time()
+            response = session.post(f"{url}/webhook", data=payload, headers={'Content-Type': 'application/json'})
+            ack_latencies.append(time.time() - t0)
+            if chat_id is not None:
+                posted_at[str(chat_id)] = t0
+            return response.status_code == 200
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            failed = sum(not ok for ok in pool.map(post, updates))
+        post_elapsed = time.time() - start
+
+        # Replies are done once every expected chat got its final reply (not just the placeholder) and Telegram
+        # has seen no calls for --settle seconds; a streamed answer's later edits move its reply time along
+        last_replies, deadline = {}, time.time() + args.timeout
+        while time.time() < deadline:
+            time.sleep(args.settle)
+            calls = session.get(f"{fake}/_calls").json()
+            last_replies = {}
+            for at, method, chat_id, final in calls:
+                if final and chat_id in posted_at and at >= posted_at[chat_id]:
+                    last_replies[chat_id] = at
+            quiet = not calls or time.time() - calls[-1][0] >= args.settle
+            if len(last_replies) >= len(posted_at) and quiet:
+                break
+        end_to_end = [last_replies[chat_id] - posted_at[chat_id] for chat_id in last_replies]
+        model_calls = sum(1 for at, method, _, _ in calls if method in MODEL_CALLS and at >= start)
+        completed_at = max(last_replies.values(), default=start + post_elapsed)
+        return {
+            'label': label, 'updates': len(updates), 'failed': failed,
+            'ack_rps': len(updates) / post_elapsed if post_elapsed else 0.0,
+            'ack_p95': percentile(ack_latencies, 95),
+            'answered': len(last_replies), 'expected': len(posted_at),
+            'throughput': len(last_replies) / (completed_at - start) if last_replies else 0.0,
+            'e2e': end_to_end, 'rss_mb': peak_rss_mb(bot_process.pid), 'model_calls': model_calls,
+        }
+    finally:
+        bot_process.terminate()
+        bot_process.wait()
+
+
+def bench_load(args):
+    import multiprocessing
+    opts = {key: getattr(args, key) for key in ('telegram_latency', 'telegram_error_rate', 'llm_latency',
+                                                 'llm_error_rate', 'llm_tokens', 'llm_token_interval')}
+    fake = multiprocessing.Process(target=run_fake_services, args=(args.fake_port, opts), daemon=True)
+    fake.start()
+    time.sleep(1.0)
+    scenarios = [(name, synthetic_updates(name, args.updates, 1_000_000 * (i + 1))) for i, name in enumerate(args.scenarios)]
+    if args.replay:
+        scenarios.append(('replay', recorded_updates(args.replay, 9_000_000)))
+    try:
+        print(f"{args.runtime}, {args.updates} updates per scenario, {args.concurrency} concurrent posts, "
+              f"model latency {args.llm_latency * 1000:.0f}ms + {args.llm_tokens} tokens, "
+              f"{args.llm_error_rate:.0%} model / {args.telegram_error_rate:.0%} Telegram errors injected\n")
+        print(f"{'scenario':<10}{'updates':>8}{'non-200':>8}{'ack/s':>8}{'ack p95':>8}{'answered':>10}{'done/s':>8}"
+              f"{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'RSS MB':>8}{'model':>7}")
+        for label, updates in scenarios:
+            r = run_load_scenario(args, label, updates, args.fake_port, args.port)
+            print(f"{r['label']:<10}{r['updates']:>8}{r['failed']:>8}{r['ack_rps']:>8.0f}{r['ack_p95'] * 1000:>8.0f}"
+                  f"{r['answered']:>5}/{r['expected']:<4}{r['throughput']:>8.1f}{percentile(r['e2e'], 50) * 1000:>8.0f}"
+                  f"{percentile(r['e2e'], 95) * 1000:>8.0f}{percentile(r['e2e'], 99) * 1000:>8.0f}{r['rss_mb']:>8.1f}{r['model_calls']:>7}")
+    finally:
+        fake.terminate()
+
+
+# ========== SYNC VS ASYNC RUNTIME ==========
+def bench_runtimes(args):
+    """
+    Runs the same updates through bot.py and bot_async.py against the fake services at each --levels
+    concurrency: model calls in flight for both, plus as many INGEST_WORKERS and ROUTER_THREADS for bot.py.
+    Then compares throughput at matched memory: every async run next to the sync run whose peak RSS is closest.
+    """
+    import multiprocessing
+    opts = {key: getattr(args, key) for key in ('telegram_latency', 'llm_latency', 'llm_tokens', 'llm_token_interval')}
+    opts.update(telegram_error_rate=0.0, llm_error_rate=0.0)
+    fake = multiprocessing.Process(target=run_fake_services, args=(args.fake_port, opts), daemon=True)
+    fake.start()
+    time.sleep(1.0)
+    updates = synthetic_updates(args.scenario, args.updates, 1_000_000)
+    rows = []
+    try:
+        print(f"{args.scenario} scenario, {args.updates} updates, model latency {args.llm_latency * 1000:.0f}ms "
+              f"+ {args.llm_tokens} tokens, Bot API latency {args.telegram_latency * 1000:.0f}ms\n")
+        print(f"{'runtime':<14}{'in flight':>10}{'answered':>10}{'done/s':>8}{'p50 ms':>8}{'p95 ms':>8}{'RSS MB':>8}{'model':>7}")
+        for runtime in ('bot.py', 'bot_async.py'):
+            for level in args.levels:
+                # Telegram's global 30 messages/s would cap both runtimes at the same rate, the fake has no such limit
+                env = {'GROQ_MAX_CONCURRENCY': str(level), 'GEMINI_MAX_CONCURRENCY': str(level),
+                       'BACKEND_QUEUE_TIMEOUT': str(args.timeout), 'TELEGRAM_GLOBAL_PER_SECOND': '1000'}
+                if runtime == 'bot.py':
+                    env.update(INGEST_WORKERS=str(level), ROUTER_THREADS=str(level), INGEST_QUEUE_SIZE=str(len(updates)))
+                else:
+                    env.update(ASYNC_MAX_IN_FLIGHT=str(max(level, len(updates)))) # Nothing is turned away with a 503
+                run_args = argparse.Namespace(**{**vars(args), 'runtime': runtime})
+                r = run_load_scenario(run_args, args.scenario, updates, args.fake_port, args.port, env)
+                r.update(runtime=runtime, level=level)
+                rows.append(r)
+                print(f"{runtime:<14}{level:>10}{r['answered']:>5}/{r['expected']:<4}{r['throughput']:>8.1f}"
+                      f"{percentile(r['e2e'], 50) * 1000:>8.0f}{percentile(r['e2e'], 95) * 1000:>8.0f}"
+                      f"{r['rss_mb']:>8.1f}{r['model_calls']:>7}")
+    finally:
+        fake.terminate()
+
+    sync_rows = [r for r in rows if r['runtime'] == 'bot.py']
+    print(f"\nAt matched peak RSS (best sync run that fits in the async run's memory):\n{'async':>22}{'sync':>22}{'async/sync':>12}")
+    for r in (r for r in rows if r['runtime'] == 'bot_async.py'):
+        fits = [s for s in sync_rows if s['rss_mb'] <= r['rss_mb']]
+        match = max(fits, key=lambda s: s['throughput']) if fits else min(sync_rows, key=lambda s: s['rss_mb'])
+        ratio = r['throughput'] / match['throughput'] if match['throughput'] else float('inf')
+        print(f"{r['level']:>5} in flight {r['rss_mb']:>5.0f}MB{match['level']:>5} in flight {match['rss_mb']:>5.0f}MB"
+              f"{ratio:>11.1f}x  ({r['throughput']:.1f} vs {match['throughput']:.1f} done/s)")
+
+
+# ========== STARTUP ==========
+def bench_startup(args):
+    """
+    Boots the bot against the fake services once per STARTUP_MODE and measures import time, time until the
+    webhook route answers, the Bot API calls made while booting, and how much of the deferred work the first
+    text and chart replies pay for. Each mode boots twice: with a stale webhook URL (first deploy) and with
+    the URL already registered (plain restart).
+    """
+    import multiprocessing
+    import tempfile
+    import requests
+    opts = {'telegram_latency': args.telegram_latency, 'telegram_error_rate': 0.0, 'llm_latency': 0.0,
+            'llm_error_rate': 0.0, 'llm_tokens': 20, 'llm_token_interval': 0.0}
+    fake_service = multiprocessing.Process(target=run_fake_services, args=(args.fake_port, opts), daemon=True)
+    fake_service.start()
+    time.sleep(1.0)
+    fake = f"http://127.0.0.1:{args.fake_port}"
+    session = requests.Session()
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    import_code = "import time; t = time.perf_counter(); import bot; print(time.perf_counter() - t)"
+
+    def webhook_calls(since):
+        return sum(1 for at, method, _, _ in session.get(f"{fake}/_calls").json()
+                   if at >= since and method in ('getWebhookInfo', 'setWebhook', 'deleteWebhook'))
+
+    def first_reply(url, payload, chat_id):
+        """Seconds from posting an update until the fake Telegram saw the last reply for its chat, past the placeholder."""
+        start = time.time()
+        session.post(f"{url}/webhook", data=payload, headers={'Content-Type': 'application/json'})
+        while time.time() - start < 30:
+            time.sleep(0.1)
+            seen = [at for at, _, chat, final in session.get(f"{fake}/_calls").json() if final and chat == str(chat_id) and at >= start]
+            if seen and time.time() - seen[-1] >= args.settle:
+                return seen[-1] - start
+        return float('nan')
+
+    try:
+        print(f"{args.runtime}, median of {args.repeat} imports, Bot API latency {args.telegram_latency * 1000:.0f}ms\n")
+        print(f"{'mode':<12}{'boot':<10}{'import ms':>10}{'ready ms':>10}{'webhook calls':>15}{'text ms':>10}{'chart ms':>10}")
+        for i, mode in enumerate(args.modes):
+            env = fake_env(fake, args.port, STARTUP_MODE=mode, PYTHONPATH=source_dir)
+            workdir = tempfile.mkdtemp(prefix='bench-startup-')
+            imports = []
+            for _ in range(args.repeat):
+                out = subprocess.run([sys.executable, '-W', 'ignore', '-c', import_code], cwd=workdir, env=env,
+                                     capture_output=True, text=True, check=True).stdout
+                imports.append(float(out.strip().splitlines()[-1]))
+            session.post(f"{fake}/bot123456:bench/deleteWebhook")
+            for boot in ('deploy', 'restart'):
+                photo_chat, text_chat = 30_000 + i * 10, 30_001 + i * 10
+                with open(os.path.join(workdir, 'user_data.json'), 'w') as f:
+                    json.dump({str(photo_chat): {'lang': 'en', 'mode': 'setup', 'sub_mode': 'swing'}}, f)
+                url = f"http://127.0.0.1:{args.port}"
+                start = time.time()
+                bot_process = start_bot(args.runtime, workdir, env)
+                try:
+                    wait_until_serving(session, url, args.runtime)
+                    ready = time.time() - start
+                    time.sleep(0.5) # Let the webhook check finish, the route can answer before it does
+                    calls = webhook_calls(start)
+                    update_id = 5_000_000 + i * 10 + (boot == 'restart') * 2 # Fresh ids, or the dedup layer drops them
+                    text_update, photo_update = [json.loads(synthetic_updates(kind, 1, update_id + j)[0][0])
+                                                 for j, kind in enumerate(('text', 'photo'))]
+                    text_update['message']['chat']['id'] = text_chat
+                    photo_update['message']['chat']['id'] = photo_chat
+                    text_ms = first_reply(url, json.dumps(text_update), text_chat) * 1000
+                    chart_ms = first_reply(url, json.dumps(photo_update), photo_chat) * 1000
+                finally:
+                    bot_process.terminate()
+                    bot_process.wait()
+                print(f"{mode:<12}{boot:<10}{statistics.median(imports) * 1000:>10.0f}{ready * 1000:>10.0f}{calls:>15}"
+                      f"{text_ms:>10.0f}{chart_ms:>10.0f}")
+    finally:
+        fake_service.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = commands.add_parser('preprocess', help="bytes, latency and quality of chart image preprocessing")
+    preprocess.add_argument('--corpus', help="directory of sample chart screenshots (default: synthetic charts)")
+    preprocess.add_argument('--count', type=int, default=20, help="number of synthetic charts without --corpus")
+    preprocess.add_argument('--live', action='store_true', help="also call Gemini to compare prompt tokens and latency (needs GEMINI_API_KEY)")
+    preprocess.set_defaults(func=bench_preprocess)
+
+    chartfilter = commands.add_parser('chartfilter', help="precision, recall and latency of the local non-chart photo pre-filter")
+    chartfilter.add_argument('--corpus', help="directory with chart/ and other/ subfolders of labeled screenshots, scored with the synthetic set")
+    chartfilter.add_argument('--count', type=int, default=40, help="synthetic images per chart variant and per non-chart kind")
+    chartfilter.add_argument('--threshold', type=float, default=None, help="score to report on (default: CHART_FILTER_THRESHOLD, or 0.35 while the filter is off)")
+    chartfilter.add_argument('--side', type=int, default=None, help="thumbnail side (default: CHART_FILTER_SIDE)")
+    chartfilter.add_argument('--save', help="also write the corpus here as chart/ and other/, to inspect or extend it")
+    chartfilter.set_defaults(func=bench_chartfilter)
+
+    parse = commands.add_parser('parse', help="speed and robustness of trade-setup JSON parsing")
+    parse.add_argument('--fuzz', type=int, default=2000, help="number of fuzzed replies to add to the samples")
+    parse.add_argument('--repeat', type=int, default=20, help="timing repetitions over the corpus")
+    parse.set_defaults(func=bench_parse)
+
+    runtimes = commands.add_parser('runtimes', help="throughput and memory of bot.py vs bot_async.py on the same load")
+    runtimes.add_argument('--scenario', choices=['text', 'group', 'photo', 'album', 'document', 'mixed'], default='text')
+    runtimes.add_argument('--updates', type=int, default=200)
+    runtimes.add_argument('--levels', type=int, nargs='+', default=[4, 32, 128], help="model calls (and bot.py threads) in flight")
+    runtimes.add_argument('--concurrency', type=int, default=20, help="webhook posts in flight")
+    runtimes.add_argument('--llm-latency', type=float, default=0.5, help="seconds before a fake model answers")
+    runtimes.add_argument('--llm-tokens', type=int, default=40, help="tokens in a fake Learn answer")
+    runtimes.add_argument('--llm-token-interval', type=float, default=0.01, help="seconds between streamed tokens")
+    runtimes.add_argument('--telegram-latency', type=float, default=0.02, help="seconds each fake Bot API call takes")
+    runtimes.add_argument('--settle', type=float, default=2.0, help="seconds without Telegram calls that end a run")
+    runtimes.add_argument('--timeout', type=float, default=300, help="seconds to wait for replies per run")
+    runtimes.add_argument('--port', type=int, default=18765, help="port the bot under test listens on")
+    runtimes.add_argument('--fake-port', type=int, default=18767)
+    runtimes.set_defaults(func=bench_runtimes)
+
+    router = commands.add_parser('router', help="failover, hedging and circuit breaking against local stub model servers")
+    router.add_argument('--requests', type=int, default=200)
+    router.add_argument('--fast', type=float, default=0.02, help="seconds a normal stub call takes")
+    router.add_argument('--slow', type=float, default=1.0, help="seconds a tail stub call takes")
+    router.add_argument('--tail-ratio', type=float, default=0.04, help="share of /tail calls that are slow")
+    router.add_argument('--timeout', type=float, default=5.0, help="per-backend timeout")
+    router.add_argument('--port', type=int, default=18766)
+    router.set_defaults(func=bench_router)
+
+    load = commands.add_parser('load', help="end-to-end webhook load against local fake Telegram, Groq and Gemini servers")
+    load.add_argument('--runtime', choices=['bot.py', 'bot_async.py'], default='bot.py')
+    load.add_argument('--scenarios', nargs='+', choices=['text', 'group', 'photo', 'album', 'document', 'mixed'],
+                      default=['text', 'group', 'photo', 'album', 'document', 'mixed'])
+    load.add_argument('--replay', help="JSONL of recorded updates (see UPDATE_RECORD_FILE) to run as an extra scenario")
+    load.add_argument('--updates', type=int, default=200, help="synthetic updates per scenario")
+    load.add_argument('--concurrency', type=int, default=20, help="webhook posts in flight")
+    load.add_argument('--llm-latency', type=float, default=0.5, help="seconds before a fake model answers")
+    load.add_argument('--llm-tokens', type=int, default=40, help="tokens in a fake Learn answer")
+    load.add_argument('--llm-token-interval', type=float, default=0.01, help="seconds between streamed tokens")
+    load.add_argument('--llm-error-rate', type=float, default=0.0, help="share of model calls answered with a 503")
+    load.add_argument('--telegram-latency', type=float, default=0.02, help="seconds each fake Bot API call takes")
+    load.add_argument('--telegram-error-rate', type=float, default=0.0, help="share of chat calls answered with a 429")
+    load.add_argument('--settle', type=float, default=2.0, help="seconds without Telegram calls that end a scenario")
+    load.add_argument('--timeout', type=float, default=300, help="seconds to wait for replies per scenario")
+    load.add_argument('--port', type=int, default=18770, help="port the bot under test listens on")
+    load.add_argument('--fake-port', type=int, default=18771)
+    load.set_defaults(func=bench_load)
+
+    startup = commands.add_parser('startup', help="cold start time, webhook registration calls and first-reply cost per STARTUP_MODE")
+    startup.add_argument('--runtime', choices=['bot.py', 'bot_async.py'], default='bot.py')
+    startup.add_argument('--modes', nargs='+', choices=['eager', 'lazy', 'background'], default=['eager', 'lazy', 'background'])
+    startup.add_argument('--repeat', type=int, default=5, help="imports of bot.py to time per mode")
+    startup.add_argument('--telegram-latency', type=float, default=0.1, help="seconds each fake Bot API call takes")
+    startup.add_argument('--settle', type=float, default=2.0, help="seconds without calls for a chat that end its reply")
+    startup.add_argument('--port', type=int, default=18772, help="port the bot under test listens on")
+    startup.add_argument('--fake-port', type=int, default=18773)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
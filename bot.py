@@ -1,13 +1,39 @@
 import os
 import json
+import html
 import re
 import time
+import queue
+import asyncio
+import threading
+import sqlite3
+import atexit
+import io
+import socket
+import random
+import zlib
+import heapq
+import glob
+import fcntl
+import contextvars
+import importlib.util
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
+import requests
 import telebot
-from flask import Flask, request
-from groq import Groq
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold # Import tambahan ini
+from flask import Flask, request, jsonify
+
+try:
+    from PIL import Image, ImageChops
+except ImportError: # Pillow is optional, without it chart images are sent exactly as downloaded
+    Image = None
+
+try:
+    import redis
+except ImportError: # Only needed for the multi-node 'redis' backends
+    redis = None
 
 # Load .env
 load_dotenv()
@@ -16,6 +42,14 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 RENDER_EXTERNAL_HOSTNAME = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+# Alternate API endpoints, e.g. a local Bot API server or the stand-ins used by `bench.py load`
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE") # e.g. http://127.0.0.1:8081
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT") # Switches Gemini to its REST transport
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # 'json' writes structured log lines, including one per handler stage
+UPDATE_RECORD_FILE = os.getenv("UPDATE_RECORD_FILE") # Append every webhook payload here for replaying with `bench.py load --replay`
+# 'lazy' imports the model SDKs and loads chat settings on first use, 'background' warms them up in a thread
+# right after startup, 'eager' does it all before serving
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
 
 # Validate environment variables
 if not BOT_TOKEN:
@@ -29,37 +63,506 @@ if not RENDER_EXTERNAL_HOSTNAME:
 
 WEBHOOK_URL = f"https://{RENDER_EXTERNAL_HOSTNAME}/webhook"
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# --- Multi-worker deployment settings ---
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0") # Shared state for the 'redis' backends
+_redis_client = None
+
+def get_redis():
+    """Returns the shared Redis client, creating it on first use."""
+    global _redis_client
+    if redis is None:
+        raise Exception("The 'redis' backend needs the redis package. Install it with `pip install redis`.")
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _redis_client
+
+# --- Webhook ingestion settings ---
+# 'queue' acks Telegram immediately and processes updates on a worker pool, 'inline' processes inside the request
+INGEST_MODE = os.getenv("INGEST_MODE", "queue")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100")) # Per worker
+# 'reject' answers 503 so Telegram redelivers later, 'shed' drops the same chat's oldest queued update to make room
+INGEST_OVERFLOW = os.getenv("INGEST_OVERFLOW", "reject")
+# 'local' keeps the queue in this process; 'sqlite' (one host) or 'redis' (many hosts) share it between
+# worker processes, which lease shards of chats so every chat is still processed in order
+INGEST_BACKEND = os.getenv("INGEST_BACKEND", "local")
+INGEST_DB_FILE = os.getenv("INGEST_DB_FILE", "updates.db")
+INGEST_SHARDS = int(os.getenv("INGEST_SHARDS", "16"))
+INGEST_LEASE_TTL = float(os.getenv("INGEST_LEASE_TTL", "30")) # Seconds a dead worker keeps its shards
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "0.2")) # Idle wait between shared queue scans
+if INGEST_BACKEND != 'local':
+    INGEST_MODE = 'queue' # A shared queue only makes sense with queued ingestion
+
+# --- Update deduplication settings (Telegram redelivers updates when the webhook is slow) ---
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "3600")) # Seconds an update_id is remembered
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "10000"))
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory") # 'memory', 'sqlite' (survives restarts) or 'redis' (shared by all nodes)
+DEDUP_DB_FILE = os.getenv("DEDUP_DB_FILE", "seen_updates.db")
+
+# --- Chart analysis cache settings ---
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "500"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "21600")) # Seconds, charts go stale quickly
+ANALYSIS_CACHE_DB_FILE = os.getenv("ANALYSIS_CACHE_DB_FILE", "") # Set to a path to keep the cache on disk
+
+# --- Trading journal settings: generated signals and Learn exchanges, queried with /journal and /stats ---
+JOURNAL_DB_FILE = os.getenv("JOURNAL_DB_FILE", "journal.db") # Empty disables the journal
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "1.0")) # Seconds entries are batched before one write
+JOURNAL_MAX_BATCH = int(os.getenv("JOURNAL_MAX_BATCH", "200")) # Pending entries that trigger a write right away
+
+# Images up to this size are sent inline with generate_content, larger ones go through the Gemini File API
+INLINE_IMAGE_MAX_BYTES = int(os.getenv("INLINE_IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))
+
+# --- Cleanup settings: Gemini uploads and temp files are deleted by a background worker, orphans by a periodic sweep ---
+CLEANUP_BATCH_WINDOW = float(os.getenv("CLEANUP_BATCH_WINDOW", "0.5")) # Seconds queued deletions wait so they are handled in one pass
+CLEANUP_RETRY_DELAY = float(os.getenv("CLEANUP_RETRY_DELAY", "5")) # Seconds before retrying a failed deletion, doubled after each attempt
+CLEANUP_MAX_ATTEMPTS = int(os.getenv("CLEANUP_MAX_ATTEMPTS", "5")) # Attempts before a deletion is left to the sweep
+CLEANUP_SWEEP_DELAY = float(os.getenv("CLEANUP_SWEEP_DELAY", "30")) # Seconds after start before the first sweep
+CLEANUP_SWEEP_INTERVAL = float(os.getenv("CLEANUP_SWEEP_INTERVAL", "3600")) # Seconds between sweeps, 0 disables sweeping
+CLEANUP_STALE_AGE = float(os.getenv("CLEANUP_STALE_AGE", "900")) # Uploads and temp files older than this belong to no live request
+CLEANUP_SWEEP_LOCK_FILE = os.getenv("CLEANUP_SWEEP_LOCK_FILE", "cleanup_sweep.lock") # Only the worker process holding this lock sweeps
+
+# --- OHLC document settings: CSV/JSON candles are answered with locally computed indicators, no model call ---
+OHLC_MAX_FILE_BYTES = int(os.getenv("OHLC_MAX_FILE_BYTES", str(20 * 1024 * 1024))) # Bots can't download larger files anyway
+OHLC_CHUNK_ROWS = int(os.getenv("OHLC_CHUNK_ROWS", "20000")) # CSV rows parsed per chunk
+OHLC_WINDOW = int(os.getenv("OHLC_WINDOW", "2000")) # Most recent candles kept for the indicators
+
+# --- Album (media group) settings: the photos of one album are analyzed together in a single Gemini call ---
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.0")) # Seconds without a new photo that close an album, 0 analyzes each photo alone
+MEDIA_GROUP_MAX_WAIT = float(os.getenv("MEDIA_GROUP_MAX_WAIT", "4")) # Seconds after its first photo an album is analyzed at the latest
+MEDIA_GROUP_MAX_PHOTOS = int(os.getenv("MEDIA_GROUP_MAX_PHOTOS", "4")) # Charts of one album sent to Gemini, later photos are ignored
+
+# --- Rate limiting settings ---
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "6")) # Model requests a chat may make per minute
+CHAT_BURST = int(os.getenv("CHAT_BURST", "3")) # Requests a quiet chat may fire back to back
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5")) # Seconds to wait for a token before replying "slow down"
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "4"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "2"))
+BACKEND_QUEUE_TIMEOUT = float(os.getenv("BACKEND_QUEUE_TIMEOUT", "60")) # Seconds to wait for a free backend slot
+
+# --- Outbound Telegram settings (limits from the Bot API FAQ) ---
+TELEGRAM_GLOBAL_PER_SECOND = float(os.getenv("TELEGRAM_GLOBAL_PER_SECOND", "30")) # Messages per second across all chats
+TELEGRAM_CHAT_PER_MINUTE = float(os.getenv("TELEGRAM_CHAT_PER_MINUTE", "60")) # Messages and edits per minute in a private chat
+TELEGRAM_GROUP_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_PER_MINUTE", "20")) # Messages and edits per minute in a group
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+OUTBOUND_POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", "32")) # Keep-alive connections to api.telegram.org
+OUTBOUND_MAX_WAIT = float(os.getenv("OUTBOUND_MAX_WAIT", "60")) # Seconds a send may queue before it is dropped
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3")) # Retries after a 429
+OUTBOUND_THREADS = int(os.getenv("OUTBOUND_THREADS", "8")) # Threads sending the paced Bot API queue
+
+# --- Model backend routing settings ---
+# Comma-separated "provider:model[@base_url]" lists, tried in order; base_url is for OpenAI-compatible (groq) servers
+LEARN_BACKENDS = os.getenv("LEARN_BACKENDS", "groq:llama-3.1-8b-instant,groq:llama-3.3-70b-versatile")
+CHART_BACKENDS = os.getenv("CHART_BACKENDS", "gemini:gemini-1.5-flash,gemini:gemini-1.5-flash-8b")
+LEARN_BACKEND_TIMEOUT = float(os.getenv("LEARN_BACKEND_TIMEOUT", "20")) # Seconds to the first token
+CHART_BACKEND_TIMEOUT = float(os.getenv("CHART_BACKEND_TIMEOUT", "60"))
+LEARN_HEDGING = os.getenv("LEARN_HEDGING", "true").lower() == "true"
+CHART_HEDGING = os.getenv("CHART_HEDGING", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95")) # Latency percentile after which a hedged request is sent
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20")) # Latencies needed before hedging starts
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0")) # Never hedge sooner than this many seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")) # Consecutive failures that open a circuit
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30")) # Seconds before an open circuit lets a probe through
+ROUTER_THREADS = int(os.getenv("ROUTER_THREADS", "32")) # Threads running routed calls in the threaded runtime
+
+# --- Token accounting settings: every model request is written to a daily JSONL ledger and summed in memory ---
+USAGE_LEDGER_DIR = os.getenv("USAGE_LEDGER_DIR", "usage") # One usage-YYYY-MM-DD.jsonl per UTC day, empty keeps totals in memory only
+USAGE_KEEP_DAYS = int(os.getenv("USAGE_KEEP_DAYS", "7")) # Days of totals kept in memory (and replayed on restart)
+# Quotas count every worker on this host, which all read the same ledger files; without a ledger
+# directory, or with workers on several hosts, each worker enforces them on its own
+USAGE_CHAT_DAILY_TOKENS = int(os.getenv("USAGE_CHAT_DAILY_TOKENS", "0")) # Tokens a chat may use per UTC day, 0 is unlimited
+USAGE_DAILY_TOKENS = int(os.getenv("USAGE_DAILY_TOKENS", "0")) # Tokens all chats together may use per UTC day, 0 is unlimited
+# USD per million prompt:completion tokens by model, to estimate cost; check the providers' current price lists
+MODEL_PRICES = os.getenv("MODEL_PRICES", "llama-3.1-8b-instant=0.05:0.08,llama-3.3-70b-versatile=0.59:0.79,"
+                                         "gemini-1.5-flash=0.075:0.3,gemini-1.5-flash-8b=0.0375:0.15")
+ADMIN_CHAT_IDS = {chat_id.strip() for chat_id in os.getenv("ADMIN_CHAT_IDS", "").split(',') if chat_id.strip()} # May see top consumers with /usage
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "") # Bearer token for the /usage HTTP route, which is off while this is empty
+
+# --- Trade setup parsing settings ---
+GEMINI_JSON_OUTPUT = os.getenv("GEMINI_JSON_OUTPUT", "true").lower() == "true" # Request schema-constrained JSON from Gemini
+SETUP_STRICT_SCHEMA = os.getenv("SETUP_STRICT_SCHEMA", "false").lower() == "true" # Reject signals missing Pair/Entry/SL/TP/Reason
 
-# Initialize Groq client for text-only queries
-client_groq = Groq(api_key=GROQ_API_KEY)
+# --- Learn mode streaming settings ---
+LEARN_STREAMING = os.getenv("LEARN_STREAMING", "true").lower() == "true"
+LEARN_STREAM_EDIT_INTERVAL = float(os.getenv("LEARN_STREAM_EDIT_INTERVAL", "1.5")) # Seconds between edits, Telegram throttles fast edits
 
-# Initialize Gemini client for vision tasks
-genai.configure(api_key=GEMINI_API_KEY)
-vision_model = genai.GenerativeModel('gemini-1.5-flash') # Or 'gemini-1.5-pro' for potentially better understanding but higher cost/latency
+# --- Learn mode answer cache settings ---
+LEARN_CACHE_SIZE = int(os.getenv("LEARN_CACHE_SIZE", "2000")) # Answers kept per language, 0 disables the cache
+LEARN_CACHE_TTL = int(os.getenv("LEARN_CACHE_TTL", "604800")) # Seconds, concepts don't change quickly
+LEARN_CACHE_MARKET_TTL = int(os.getenv("LEARN_CACHE_MARKET_TTL", "900")) # Seconds, for questions with numbers or timeframes
+LEARN_CACHE_SIMILARITY = float(os.getenv("LEARN_CACHE_SIMILARITY", "0.8")) # Minimum Jaccard similarity to reuse an answer
+
+# --- Learn mode conversation memory: recent exchanges per chat, so follow-up questions keep their context ---
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "8")) # Exchanges kept per chat, 0 disables the memory
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1500")) # History tokens added to a Learn prompt
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "200")) # Part of the budget for older topics
+CONVERSATION_IDLE_TTL = int(os.getenv("CONVERSATION_IDLE_TTL", "3600")) # Seconds before an idle chat's memory is dropped
+CONVERSATION_MAX_CHATS = int(os.getenv("CONVERSATION_MAX_CHATS", "5000")) # Least recently active chats beyond this are dropped
+
+# --- Chart image preprocessing settings (resizing/re-encoding needs Pillow) ---
+IMAGE_TARGET_SIDE = int(os.getenv("IMAGE_TARGET_SIDE", "1280")) # Longest side sent to Gemini, 0 keeps the largest photo
+IMAGE_AUTOCROP = os.getenv("IMAGE_AUTOCROP", "true").lower() == "true" # Trim flat borders around the chart
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper() # 'WEBP', 'JPEG', 'PNG' or 'ORIGINAL' to skip re-encoding
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+CHART_FILTER_THRESHOLD = float(os.getenv("CHART_FILTER_THRESHOLD", "0")) # Photos scoring below this never reach Gemini (needs NumPy); off until tuned on labeled screenshots with `bench.py chartfilter --corpus`
+CHART_FILTER_SIDE = int(os.getenv("CHART_FILTER_SIDE", "160")) # Longest side of the thumbnail the pre-filter scores
+
+if TELEGRAM_API_BASE:
+    telebot.apihelper.API_URL = TELEGRAM_API_BASE.rstrip('/') + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_BASE.rstrip('/') + "/file/bot{0}/{1}"
+
+# In queue mode our own workers run the handlers, so telebot must not hand them off to its thread pool again
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=INGEST_MODE != 'queue')
+
+class LazyModule:
+    """Stands in for a heavy SDK module: imports it, and runs its setup hook, on first attribute access."""
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.monotonic()
+                    module = importlib.import_module(self._name)
+                    if self._setup:
+                        self._setup(module)
+                    self._module = module
+                    print(f"Loaded {self._name} in {(time.monotonic() - start) * 1000:.0f}ms")
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+def _configure_gemini(module):
+    if GEMINI_API_ENDPOINT:
+        module.configure(api_key=GEMINI_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+    else:
+        module.configure(api_key=GEMINI_API_KEY)
+
+# Groq serves text-only queries and Gemini vision tasks, the models come from the LEARN_BACKENDS/CHART_BACKENDS routers.
+# Importing google.generativeai alone takes about a second, so neither SDK is imported until a handler needs it.
+groq_sdk = LazyModule('groq')
+genai = LazyModule('google.generativeai', setup=_configure_gemini)
+# Optional, only OHLC documents need it
+np = LazyModule('numpy') if importlib.util.find_spec('numpy') else None
+
+LEARN_COMPLETION_OPTIONS = {'temperature': 1, 'max_tokens': 1024}
 
 app = Flask(__name__)
 
 # --- Persistence for user_data (language and mode) ---
 USER_DATA_FILE = "user_data.json"
+SETTINGS_BACKEND = os.getenv("SETTINGS_BACKEND", "sqlite") # 'sqlite' (WAL), 'redis', 'log' (append-only) or 'json' (legacy file)
+SETTINGS_DB_FILE = os.getenv("SETTINGS_DB_FILE", "user_data.db")
+SETTINGS_LOG_FILE = os.getenv("SETTINGS_LOG_FILE", "user_data.log")
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "0.5")) # Seconds to coalesce writes before flushing
+# Seconds between pulls of settings changed by other workers ('sqlite' and 'redis' backends)
+SETTINGS_SYNC_INTERVAL = float(os.getenv("SETTINGS_SYNC_INTERVAL", "1.0"))
 
-def load_user_data():
-    """Loads user data from a JSON file."""
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r') as f:
+def _atomic_write_json(path, data):
+    """Writes JSON to a temp file and renames it over path, so readers never see a half-written file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class JsonSettingsBackend:
+    """Legacy backend: the whole dict in user_data.json, now rewritten atomically."""
+    def __init__(self, path=USER_DATA_FILE):
+        self.path = path
+
+    def load_all(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError:
+                    print(f"Warning: {self.path} is empty or corrupted. Starting with empty user data.")
+        return {}
+
+    def write(self, changes, all_data):
+        _atomic_write_json(self.path, all_data)
+
+class SqliteSettingsBackend:
+    """
+    One row per chat in sqlite (WAL mode), so a settings change only touches that chat's row.
+    Every write bumps a version number, which lets other worker processes pull just the changed chats.
+    """
+    def __init__(self, path=SETTINGS_DB_FILE):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute("CREATE TABLE IF NOT EXISTS user_settings (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(user_settings)")]
+        if 'version' not in columns:
+            self._db.execute("ALTER TABLE user_settings ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS user_settings_version ON user_settings (version)")
+        self._lock = threading.Lock()
+
+    def load_all(self):
+        with self._lock:
+            rows = self._db.execute("SELECT chat_id, data FROM user_settings").fetchall()
+        return {chat_id: json.loads(data) for chat_id, data in rows}
+
+    def current_version(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(MAX(version), 0) FROM user_settings").fetchone()[0]
+
+    def changes_since(self, version):
+        """Returns ({chat_id: settings} written after version, newest version)."""
+        with self._lock:
+            rows = self._db.execute("SELECT chat_id, data, version FROM user_settings WHERE version > ? ORDER BY version", (version,)).fetchall()
+        return {chat_id: json.loads(data) for chat_id, data, _ in rows}, (rows[-1][2] if rows else version)
+
+    def write(self, changes, all_data):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE") # Take the write lock before reading the version counter
+            try:
+                version = self._db.execute("SELECT COALESCE(MAX(version), 0) FROM user_settings").fetchone()[0]
+                self._db.executemany(
+                    "INSERT INTO user_settings (chat_id, data, version) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, version = excluded.version",
+                    [(chat_id, json.dumps(settings), version + i + 1) for i, (chat_id, settings) in enumerate(changes.items())]
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+class RedisSettingsBackend:
+    """Chat settings in a Redis hash, shared by every node, with a sorted set of changes for read-through caches."""
+    # Versions are assigned and written in one atomic step: a reader that sees version N also sees every
+    # change up to N, so changes_since never skips a lower version that landed late
+    WRITE_SCRIPT = """
+    local count = #ARGV / 2
+    local first = redis.call('INCRBY', KEYS[2], count) - count
+    for i = 1, count do
+        redis.call('HSET', KEYS[1], ARGV[2 * i - 1], ARGV[2 * i])
+        redis.call('ZADD', KEYS[3], first + i, ARGV[2 * i - 1])
+    end
+    return first + count
+    """
+
+    def __init__(self, prefix="tradebot:settings"):
+        self.prefix = prefix
+        self._write_script = None
+
+    def load_all(self):
+        return {chat_id: json.loads(data) for chat_id, data in get_redis().hgetall(self.prefix).items()}
+
+    def current_version(self):
+        return int(get_redis().get(f"{self.prefix}:version") or 0)
+
+    def changes_since(self, version):
+        r = get_redis()
+        changed = r.zrangebyscore(f"{self.prefix}:changes", f"({version}", "+inf", withscores=True)
+        if not changed:
+            return {}, version
+        chat_ids = [chat_id for chat_id, _ in changed]
+        values = r.hmget(self.prefix, chat_ids)
+        return ({chat_id: json.loads(data) for chat_id, data in zip(chat_ids, values) if data is not None},
+                int(changed[-1][1]))
+
+    def write(self, changes, all_data):
+        if self._write_script is None:
+            self._write_script = get_redis().register_script(self.WRITE_SCRIPT)
+        args = [value for chat_id, settings in changes.items() for value in (chat_id, json.dumps(settings))]
+        self._write_script(keys=[self.prefix, f"{self.prefix}:version", f"{self.prefix}:changes"], args=args)
+
+class LogSettingsBackend:
+    """
+    Append-only JSON-lines log of per-chat changes, replayed on load.
+    The log is compacted into one line per chat once stale lines outnumber live ones.
+    """
+    COMPACT_MIN_LINES = 1000
+
+    def __init__(self, path=SETTINGS_LOG_FILE):
+        self.path = path
+        self._lines = 0
+
+    def load_all(self):
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"Warning: Skipping corrupted line in {self.path}.") # Torn write at the tail
+                        continue
+                    data[entry['chat_id']] = entry['settings']
+                    self._lines += 1
+        return data
+
+    def write(self, changes, all_data):
+        with open(self.path, 'a') as f:
+            for chat_id, settings in changes.items():
+                f.write(json.dumps({'chat_id': chat_id, 'settings': settings}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._lines += len(changes)
+        if self._lines > max(self.COMPACT_MIN_LINES, 2 * len(all_data)):
+            self.compact(all_data)
+
+    def compact(self, all_data):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for chat_id, settings in all_data.items():
+                f.write(json.dumps({'chat_id': chat_id, 'settings': settings}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._lines = len(all_data)
+
+SETTINGS_BACKENDS = {
+    'json': JsonSettingsBackend,
+    'sqlite': SqliteSettingsBackend,
+    'redis': RedisSettingsBackend,
+    'log': LogSettingsBackend,
+}
+
+class SettingsStore:
+    """
+    Holds chat settings in memory and persists only the chats that changed.
+    Changes are coalesced for SETTINGS_FLUSH_INTERVAL and written by a background thread in one batch.
+    With a shared backend the in-memory copy is a read-through cache: sync() pulls chats other workers changed.
+    """
+    def __init__(self, backend, flush_interval=SETTINGS_FLUSH_INTERVAL, sync_interval=SETTINGS_SYNC_INTERVAL):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self.shared = hasattr(backend, 'changes_since')
+        self.data = {}
+        self.loaded = False
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._version = 0
+        self._last_sync = 0.0
+        self.stats = {'flushes': 0, 'chats_written': 0, 'changes_marked': 0, 'syncs': 0, 'chats_refreshed': 0}
+
+    def load(self):
+        """Fills data in place, so references handed out before the first load (user_data) stay valid."""
+        if self.shared:
+            self._version = self.backend.current_version()
+            self._last_sync = time.monotonic()
+        loaded = self.backend.load_all()
+        with self._lock:
+            self.data.clear()
+            self.data.update(loaded)
+        self.loaded = True
+        return self.data
+
+    def sync(self, force=False):
+        """Pulls settings changed by other workers since the last sync, at most every sync_interval seconds."""
+        if not self.shared or (not force and time.monotonic() - self._last_sync < self.sync_interval):
+            return
+        self._last_sync = time.monotonic()
+        try:
+            changes, version = self.backend.changes_since(self._version)
+        except Exception as e:
+            print(f"Warning: Failed to sync user data: {e}")
+            return
+        with self._lock:
+            for chat_id, settings in changes.items():
+                if chat_id in self._dirty:
+                    continue # Our own newer change is about to be written
+                if chat_id in self.data:
+                    self.data[chat_id].clear() # Update in place, handlers may hold a reference
+                    self.data[chat_id].update(settings)
+                else:
+                    self.data[chat_id] = settings
+            self._version = max(self._version, version)
+            self.stats['syncs'] += 1
+            self.stats['chats_refreshed'] += len(changes)
+
+    def mark_dirty(self, chat_id=None):
+        """Schedules a chat (or every chat, if chat_id is None) to be written on the next flush."""
+        with self._lock:
+            self._dirty.update([chat_id] if chat_id is not None else self.data.keys())
+            self.stats['changes_marked'] += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="settings-flusher", daemon=True)
+                self._flusher.start()
+        self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return
+            changes = {chat_id: dict(self.data[chat_id]) for chat_id in dirty if chat_id in self.data}
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                print(f"Warning: {USER_DATA_FILE} is empty or corrupted. Starting with empty user data.")
-                return {}
-    return {}
+                self.backend.write(changes, self.data)
+            except Exception as e:
+                self._dirty |= dirty # Retry on the next flush
+                print(f"Warning: Failed to save user data: {e}")
+                return
+            self.stats['flushes'] += 1
+            self.stats['chats_written'] += len(changes)
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.flush_interval) # Let further changes pile up into the same write
+            self._wakeup.clear()
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = len(self._dirty)
+        stats['chats'] = len(self.data)
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+def _migrate_legacy_user_data(store):
+    """Imports user_data.json into a new backend the first time it starts, then renames the old file."""
+    if isinstance(store.backend, JsonSettingsBackend) or store.data or not os.path.exists(USER_DATA_FILE):
+        return
+    legacy = JsonSettingsBackend(USER_DATA_FILE).load_all()
+    if legacy:
+        store.backend.write(legacy, legacy)
+        store.data.update(legacy)
+        print(f"Migrated {len(legacy)} chats from {USER_DATA_FILE} to {SETTINGS_BACKEND} settings store.")
+    os.replace(USER_DATA_FILE, f"{USER_DATA_FILE}.migrated")
+
+settings_store = SettingsStore(SETTINGS_BACKENDS[SETTINGS_BACKEND]())
+atexit.register(settings_store.flush)
+
+_user_data_lock = threading.Lock()
 
-def save_user_data(data):
-    """Saves user data to a JSON file."""
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+def load_user_data():
+    """Loads user data from the configured settings store, once."""
+    if not settings_store.loaded:
+        with _user_data_lock:
+            if not settings_store.loaded:
+                settings_store.load()
+                _migrate_legacy_user_data(settings_store)
+    return settings_store.data
+
+def refresh_user_data():
+    """Loads chat settings on first use, then pulls the ones other workers changed since."""
+    load_user_data()
+    settings_store.sync()
 
-user_data = load_user_data()
+def save_user_data(data, chat_id=None):
+    """Schedules user data to be saved. Pass chat_id to write only that chat's settings."""
+    settings_store.mark_dirty(chat_id)
+
+# With STARTUP_MODE=lazy the settings are read by the first update (see process_update), not at import
+user_data = settings_store.data
 
 # ========== SYSTEM PROMPTS ==========
 BASE_SYSTEM_PROMPT_ID = (
@@ -204,6 +707,19 @@ ANALYZE_INSTRUCTION_EN = (
     "**Important:** This analysis is purely educational and technical, based on the chart data you provide. It is NOT financial advice or an inducement to invest. Trading decisions are solely the user's responsibility."
 )
 
+# Put in front of the chart instruction when an album of charts is analyzed together
+MULTI_TIMEFRAME_PREFIX_EN = (
+    "You are given {count} chart images, usually of the same pair on different timeframes, labelled Chart 1 to Chart {count}. "
+    "Read each chart's timeframe from its labels. Use the highest timeframe for the trend and key zones and the lowest one to time the entry. "
+    "Combine them into ONE consistent view: where the instructions below say 'this chart', they mean all the charts together.\n\n"
+)
+
+MULTI_TIMEFRAME_PREFIX_ID = (
+    "Kamu menerima {count} gambar chart, biasanya pair yang sama pada timeframe berbeda, diberi label Chart 1 sampai Chart {count}. "
+    "Baca timeframe tiap chart dari labelnya. Gunakan timeframe tertinggi untuk tren dan zona kunci, dan timeframe terendah untuk menentukan entry. "
+    "Gabungkan menjadi SATU pandangan yang konsisten: jika instruksi di bawah menyebut 'chart ini', artinya semua chart tersebut bersama-sama.\n\n"
+)
+
 # ========== KEYBOARD MARKUPS ==========
 def get_language_keyboard():
     """Returns an inline keyboard for language selection."""
@@ -251,85 +767,110 @@ def get_main_options_keyboard(lang):
 #         keyboard.add(telebot.types.InlineKeyboardButton("⬅️ Kembali ke Menu Utama", callback_data="back_to_main_menu"))
 #     return keyboard
 
-# ========== COMMAND HANDLERS ==========
-@bot.message_handler(commands=['start', 'menu'])
-def send_welcome_or_menu(message):
-    """Handles /start and /menu commands, setting up user data if new."""
-    chat_id = str(message.chat.id)
+# ========== CHAT SETTINGS ==========
+MODE_COMMANDS = {
+    # command: (mode, sub_mode, confirmation EN, confirmation ID)
+    'swing': ('setup', 'swing',
+              "You are now in **Swing Trade** mode. Send a chart image (H4/H1 preferred) for signal generation!",
+              "Anda sekarang dalam mode **Swing Trading**. Kirim gambar chart (disarankan H4/H1) untuk menghasilkan sinyal!"),
+    'scalp': ('setup', 'scalp',
+              "You are now in **Scalp Trade** mode. Send a chart image (M30/M15/M5 preferred) for signal generation!",
+              "Anda sekarang dalam mode **Scalp Trading**. Kirim gambar chart (disarankan M30/M15/M5) untuk menghasilkan sinyal!"),
+    'analyze': ('general_analyze', None, # Clear sub-mode
+                "You are now in **General Analysis** mode. Send me a chart image for market movement analysis!",
+                "Anda sekarang dalam mode **Analisis Umum**. Kirimkan gambar chart untuk analisis pergerakan pasar!"),
+    'learn': ('learn', None, # Clear sub-mode
+              "You are now in **Learn** mode. Send me your text queries about trading!",
+              "Anda sekarang dalam mode **Belajar**. Kirimkan pertanyaan teks Anda tentang trading!"),
+}
 
+# Main menu buttons send 'command_<name>'
+BUTTON_COMMANDS = {'learn': 'learn', 'swing': 'swing', 'scalp': 'scalp', 'analyze_chart': 'analyze'}
+
+def get_chat_settings(chat_id):
+    """Returns the settings for chat_id, setting up user data if new."""
     if chat_id not in user_data:
         user_data[chat_id] = {'lang': 'en', 'mode': 'learn', 'sub_mode': None} # Default mode, add sub_mode
-        save_user_data(user_data)
+        save_user_data(user_data, chat_id)
+    return user_data[chat_id]
+
+def apply_mode_command(chat_id, command):
+    """Switches the chat to the mode behind command and returns the confirmation text."""
+    mode, sub_mode, msg_en, msg_id = MODE_COMMANDS[command]
+    settings = get_chat_settings(chat_id)
+    settings['mode'] = mode
+    settings['sub_mode'] = sub_mode
+    save_user_data(user_data, chat_id)
+    return msg_en if settings['lang'] == 'en' else msg_id
 
-    lang = user_data[chat_id]['lang']
+def apply_language(chat_id, lang):
+    """Stores the chat language and returns the confirmation text."""
+    get_chat_settings(chat_id)['lang'] = lang
+    save_user_data(user_data, chat_id)
+    return "Language set to English." if lang == 'en' else "Bahasa diatur ke Bahasa Indonesia."
 
-    if message.text == '/start':
-        welcome_text = "Welcome! Please choose your language / Selamat datang! Silakan pilih bahasa Anda:"
-        bot.send_message(chat_id, welcome_text, reply_markup=get_language_keyboard())
-    elif message.text == '/menu':
-        menu_text = "What would you like to do?" if lang == 'en' else "Apa yang ingin Anda lakukan?"
-        bot.send_message(chat_id, menu_text, reply_markup=get_main_options_keyboard(lang))
+def get_menu_reply(chat_id, command):
+    """Returns (text, reply_markup) for /start, /menu and /language."""
+    lang = get_chat_settings(chat_id)['lang']
+    if command == 'start':
+        return "Welcome! Please choose your language / Selamat datang! Silakan pilih bahasa Anda:", get_language_keyboard()
+    if command == 'menu':
+        return ("What would you like to do?" if lang == 'en' else "Apa yang ingin Anda lakukan?"), get_main_options_keyboard(lang)
+    return ("Please choose your language:" if lang == 'en' else "Silakan pilih bahasa Anda:"), get_language_keyboard()
+
+# ========== COMMAND HANDLERS ==========
+@bot.message_handler(commands=['start', 'menu'])
+def send_welcome_or_menu(message):
+    """Handles /start and /menu commands, setting up user data if new."""
+    chat_id = str(message.chat.id)
+    text, markup = get_menu_reply(chat_id, message.text.split()[0].lstrip('/').split('@')[0])
+    bot.send_message(chat_id, text, reply_markup=markup)
 
 @bot.message_handler(commands=['language'])
 def send_language_menu(message):
     """Sends the language selection menu."""
     chat_id = str(message.chat.id)
-    if chat_id not in user_data:
-        user_data[chat_id] = {'lang': 'en', 'mode': 'learn', 'sub_mode': None}
-        save_user_data(user_data)
-
-    lang = user_data[chat_id]['lang']
-    text = "Please choose your language:" if lang == 'en' else "Silakan pilih bahasa Anda:"
-    bot.send_message(chat_id, text, reply_markup=get_language_keyboard())
+    text, markup = get_menu_reply(chat_id, 'language')
+    bot.send_message(chat_id, text, reply_markup=markup)
 
 # --- NEW DIRECT COMMAND HANDLERS for analysis modes ---
 @bot.message_handler(commands=['swing'])
 def set_mode_swing_command(message):
     chat_id = str(message.chat.id)
-    user_data[chat_id] = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    user_data[chat_id]['mode'] = 'setup'
-    user_data[chat_id]['sub_mode'] = 'swing'
-    save_user_data(user_data)
-    lang = user_data[chat_id]['lang']
-    msg = "You are now in **Swing Trade** mode. Send a chart image (H4/H1 preferred) for signal generation!" if lang == 'en' \
-          else "Anda sekarang dalam mode **Swing Trading**. Kirim gambar chart (disarankan H4/H1) untuk menghasilkan sinyal!"
-    bot.send_message(chat_id, msg)
+    bot.send_message(chat_id, apply_mode_command(chat_id, 'swing'))
 
 @bot.message_handler(commands=['scalp'])
 def set_mode_scalp_command(message):
     chat_id = str(message.chat.id)
-    user_data[chat_id] = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    user_data[chat_id]['mode'] = 'setup'
-    user_data[chat_id]['sub_mode'] = 'scalp'
-    save_user_data(user_data)
-    lang = user_data[chat_id]['lang']
-    msg = "You are now in **Scalp Trade** mode. Send a chart image (M30/M15/M5 preferred) for signal generation!" if lang == 'en' \
-          else "Anda sekarang dalam mode **Scalp Trading**. Kirim gambar chart (disarankan M30/M15/M5) untuk menghasilkan sinyal!"
-    bot.send_message(chat_id, msg)
+    bot.send_message(chat_id, apply_mode_command(chat_id, 'scalp'))
 
 @bot.message_handler(commands=['analyze']) # Renamed from /analyze to avoid conflict with `general_analyze` mode logic
 def set_mode_general_analyze_command(message):
     chat_id = str(message.chat.id)
-    user_data[chat_id] = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    user_data[chat_id]['mode'] = 'general_analyze'
-    user_data[chat_id]['sub_mode'] = None # Clear sub-mode
-    save_user_data(user_data)
-    lang = user_data[chat_id]['lang']
-    msg = "You are now in **General Analysis** mode. Send me a chart image for market movement analysis!" if lang == 'en' \
-          else "Anda sekarang dalam mode **Analisis Umum**. Kirimkan gambar chart untuk analisis pergerakan pasar!"
-    bot.send_message(chat_id, msg)
+    bot.send_message(chat_id, apply_mode_command(chat_id, 'analyze'))
 
 @bot.message_handler(commands=['learn'])
 def set_mode_learn_command(message):
     chat_id = str(message.chat.id)
-    user_data[chat_id] = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    user_data[chat_id]['mode'] = 'learn'
-    user_data[chat_id]['sub_mode'] = None # Clear sub-mode
-    save_user_data(user_data)
-    lang = user_data[chat_id]['lang']
-    msg = "You are now in **Learn** mode. Send me your text queries about trading!" if lang == 'en' \
-          else "Anda sekarang dalam mode **Belajar**. Kirimkan pertanyaan teks Anda tentang trading!"
-    bot.send_message(chat_id, msg)
+    bot.send_message(chat_id, apply_mode_command(chat_id, 'learn'))
+
+@bot.message_handler(commands=['journal'])
+def send_journal(message):
+    """/journal [PAIR] [N] [swing|scalp|learn]: the chat's latest journaled signals or Learn questions."""
+    chat_id = str(message.chat.id)
+    bot.send_message(chat_id, get_journal_reply(chat_id, message.text.split()[1:], get_chat_settings(chat_id)['lang']))
+
+@bot.message_handler(commands=['stats'])
+def send_journal_stats(message):
+    """/stats: signal counts and average RR per mode and pair, from the journal's running totals."""
+    chat_id = str(message.chat.id)
+    bot.send_message(chat_id, get_journal_stats_reply(chat_id, get_chat_settings(chat_id)['lang']))
+
+@bot.message_handler(commands=['usage'])
+def send_usage(message):
+    """/usage: the chat's tokens and estimated cost today; chats in ADMIN_CHAT_IDS also see the top consumers."""
+    chat_id = str(message.chat.id)
+    bot.send_message(chat_id, get_usage_reply(chat_id, get_chat_settings(chat_id)['lang']))
 
 
 # ========== CALLBACK QUERY HANDLERS ==========
@@ -337,326 +878,4045 @@ def set_mode_learn_command(message):
 def set_language_callback(call):
     chat_id = str(call.message.chat.id)
     lang = call.data.split('_')[2]
-    user_data[chat_id]['lang'] = lang
-    save_user_data(user_data)
-
-    bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id,
-                          text="Language set to English." if lang == 'en' else "Bahasa diatur ke Bahasa Indonesia.")
-    send_welcome_or_menu(call.message) # Show main options after language is set
+    bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id, text=apply_language(chat_id, lang))
+    text, markup = get_menu_reply(chat_id, 'menu') # Show main options after language is set
+    bot.send_message(chat_id, text, reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('command_'))
 def handle_command_buttons(call):
-    """Handles command buttons by simulating direct command calls."""
+    """Handles command buttons by running the same mode switch as the direct commands."""
     chat_id = str(call.message.chat.id)
-    command_name = call.data.split('_')[1] # e.g., 'learn', 'swing', 'scalp', 'analyze_chart'
-
-    # Simulate typing the command to trigger actual command handlers
-    if command_name == 'learn':
-        call.message.text = '/learn'
-        set_mode_learn_command(call.message)
-    elif command_name == 'swing':
-        call.message.text = '/swing'
-        set_mode_swing_command(call.message)
-    elif command_name == 'scalp':
-        call.message.text = '/scalp'
-        set_mode_scalp_command(call.message)
-    elif command_name == 'analyze_chart':
-        call.message.text = '/analyze_chart'
-        set_mode_general_analyze_command(call.message)
-    
+    command_name = call.data.split('_', 1)[1] # e.g., 'learn', 'swing', 'scalp', 'analyze_chart'
+    if command_name in BUTTON_COMMANDS:
+        bot.send_message(chat_id, apply_mode_command(chat_id, BUTTON_COMMANDS[command_name]))
     bot.answer_callback_query(call.id) # Acknowledge the button press
 
 # (Removed `set_mode_callback`, `show_setup_options`, and `back_to_main_menu_callback`
 # because we are now using direct commands from the main menu.)
 # (The `set_mode_callback` was handling 'set_mode_setup_swing' etc. which are now direct commands.)
 
-# ========== TEXT HANDLER ==========
-@bot.message_handler(func=lambda m: m.content_type == 'text')
-def handle_text(message):
-    chat_id = str(message.chat.id)
-    chat_type = message.chat.type
-    bot_username = bot.get_me().username.lower()
+# ========== METRICS ==========
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 1500, 2000, 3000, 5000, 10000)
+_trace = contextvars.ContextVar('trace', default={}) # Fields added to every span and log line of the current update
 
-    user_settings = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    lang = user_settings['lang']
-    mode = user_settings['mode']
+class MetricsRegistry:
+    """Counters and histograms keyed by name and labels, rendered in the Prometheus text format for /metrics."""
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self._help = {} # name -> (type, help)
+        self._counters = {} # (name, labels) -> value, for counters and gauges
+        self._histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+        self._bucket_bounds = {} # name -> buckets, when not the default latency ones
+        self._lock = threading.Lock()
 
-    # Ensure text messages are only handled in 'learn' mode
-    if mode != 'learn':
-        bot.reply_to(message, "Please switch to **Learn** mode to send text queries. Use /menu to change." if lang == 'en' else "Mohon beralih ke mode **Belajar** untuk mengirim pertanyaan teks. Gunakan /menu untuk mengubahnya.")
-        return
+    def inc(self, name, help_text, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('counter', help_text))
+            self._counters[key] = self._counters.get(key, 0) + value
 
-    if chat_type in ["group", "supergroup"]:
-        is_mentioned = any(
-            entity.type == "mention" and message.text[entity.offset:entity.offset + entity.length].lower() == f"@{bot_username}"
-            for entity in message.entities or []
-        )
-        is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.username == bot_username
+    def set(self, name, help_text, value, **labels):
+        """Sets a gauge, a value that can go down as well as up."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('gauge', help_text))
+            self._counters[key] = value
 
-        if not (is_mentioned or is_reply_to_bot):
-            return
+    def observe(self, name, help_text, value, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ('histogram', help_text))
+            buckets = self._bucket_bounds.setdefault(name, buckets or self.buckets)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
 
-    try:
-        user_input = message.text
-        current_system_prompt = BASE_SYSTEM_PROMPT_EN if lang == 'en' else BASE_SYSTEM_PROMPT_ID
-
-        completion = client_groq.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": current_system_prompt},
-                {"role": "user", "content": user_input}
-            ],
-            temperature=1,
-            max_tokens=1024,
-        )
-        reply = completion.choices[0].message.content
-        bot.reply_to(message, reply)
-    except Exception as e:
-        bot.reply_to(message, f"❌ Error:\n{str(e)}" if lang == 'en' else f"❌ Error:\n{str(e)}")
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in (*labels, *extra)]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
 
-# ========== IMAGE HANDLER ==========
-@bot.message_handler(content_types=["photo"])
-def handle_photo(message):
-    chat_id = str(message.chat.id)
-    user_settings = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
-    lang = user_settings['lang']
-    current_mode = user_settings['mode']
-    current_sub_mode = user_settings['sub_mode'] # Get sub-mode
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+            help_texts = dict(self._help)
+            bucket_bounds = dict(self._bucket_bounds)
+        lines = []
+        for name, (kind, help_text) in sorted(help_texts.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind in ('counter', 'gauge'):
+                lines += [f"{name}{self._labels(labels)} {value:g}" for (n, labels), value in sorted(counters.items()) if n == name]
+                continue
+            for (n, labels), histogram in sorted(histograms.items()):
+                if n != name:
+                    continue
+                lines += [f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {histogram[i]}" for i, bound in enumerate(bucket_bounds[name])]
+                lines += [f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram[-1]}",
+                          f"{name}_sum{self._labels(labels)} {histogram[-2]:.6f}",
+                          f"{name}_count{self._labels(labels)} {histogram[-1]}"]
+        return "\n".join(lines) + "\n"
 
-    # Check if in a valid analysis mode for images
-    # If mode is 'setup', current_sub_mode *must* be 'swing' or 'scalp'
-    if current_mode == 'setup' and current_sub_mode not in ['swing', 'scalp']:
-        bot.reply_to(message, "Please choose a trading style first (Swing or Scalp) using the menu or commands like /swing or /scalp." if lang == 'en' else "Mohon pilih gaya trading terlebih dahulu (Swing atau Scalp) menggunakan menu atau perintah seperti /swing atau /scalp.")
-        return
-    elif current_mode not in ['setup', 'general_analyze']: # For other invalid modes
-        bot.reply_to(message, "Please select an analysis mode first (Swing, Scalp, or General Analysis) using /menu or commands." if lang == 'en' else "Mohon pilih mode analisis terlebih dahulu (Swing, Scalp, atau Analisis Umum) menggunakan /menu atau perintah.")
-        return
+metrics = MetricsRegistry()
 
-    # Indicate that the bot is processing the image
-    processing_message = bot.reply_to(message, "⏳ Processing image... This may take a moment." if lang == 'en' else "⏳ Memproses gambar... Ini mungkin memakan waktu sebentar.")
+def log_event(event, **fields):
+    """Writes one log line: a JSON object with the current trace fields when LOG_FORMAT=json, plain text otherwise."""
+    fields = {**_trace.get(), **fields}
+    if LOG_FORMAT == 'json':
+        print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str), flush=True)
+    else:
+        print(f"{event}: " + ", ".join(f"{key}={value}" for key, value in fields.items()))
 
-    temp_file_path = None
-    uploaded_file = None
+@contextmanager
+def trace_context(**fields):
+    """Adds fields (update_id, chat_id, handler, ...) to every span and log line inside the block."""
+    token = _trace.set({**_trace.get(), **fields})
+    try:
+        yield
+    finally:
+        _trace.reset(token)
 
+def observe_stage(stage, seconds, outcome='ok'):
+    """Records one stage duration in the stage histogram and, with JSON logs, as a span line."""
+    handler = _trace.get().get('handler', 'other')
+    metrics.observe('tradebot_stage_duration_seconds', "Time spent in each handler stage", seconds,
+                    handler=handler, stage=stage, outcome=outcome)
+    if LOG_FORMAT == 'json':
+        log_event('span', stage=stage, duration_ms=round(seconds * 1000, 1), outcome=outcome)
+
+@contextmanager
+def span(stage, timings=None):
+    """Times a handler stage; also stores the duration in timings[stage] when a dict is given."""
+    start = time.monotonic()
+    outcome = 'ok'
     try:
-        caption = message.caption or ("Analyze this image?" if lang == 'en' else "Analisis Gambar Ini?")
-        file_id = message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        
-        downloaded_file = bot.download_file(file_info.file_path)
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        if timings is not None:
+            timings[stage] = elapsed
+        observe_stage(stage, elapsed, outcome)
 
-        temp_file_path = f"temp_{file_id}.jpg"
-        with open(temp_file_path, 'wb') as f:
-            f.write(downloaded_file)
+def record_token_usage(backend, prompt_tokens, completion_tokens):
+    """Counts the tokens one model call used, as reported by the provider, and bills them to the current request."""
+    metrics.inc('tradebot_model_tokens_total', "Tokens reported by the model APIs", prompt_tokens or 0, backend=backend, kind='prompt')
+    metrics.inc('tradebot_model_tokens_total', "Tokens reported by the model APIs", completion_tokens or 0, backend=backend, kind='completion')
+    usage_ledger.add_tokens(backend, prompt_tokens or 0, completion_tokens or 0)
 
-        uploaded_file = genai.upload_file(path=temp_file_path, display_name=f"chart_{file_id}")
-        
-        print(f"Uploaded file '{uploaded_file.display_name}' ({uploaded_file.uri}). Waiting for it to become active...")
-        while uploaded_file.state.name == "PROCESSING":
-            print('.', end='', flush=True)
-            time.sleep(1)
-            uploaded_file = genai.get_file(uploaded_file.name)
-
-        if uploaded_file.state.name == "FAILED":
-            raise ValueError("File processing failed on Gemini side. Please try again.")
-        
-        print(f"\nFile {uploaded_file.display_name} is active.")
-
-        # --- Determine the appropriate instruction text based on current_mode and sub_mode ---
-        full_instruction_text = ""
-        if current_mode == 'setup':
-            if current_sub_mode == 'swing':
-                full_instruction_text = SETUP_SWING_INSTRUCTION_EN if lang == 'en' else SETUP_SWING_INSTRUCTION_ID
-            elif current_sub_mode == 'scalp':
-                full_instruction_text = SETUP_SCALP_INSTRUCTION_EN if lang == 'en' else SETUP_SCALP_INSTRUCTION_ID
-            # No 'else' needed here, as the initial check `if current_mode == 'setup' and current_sub_mode not in ['swing', 'scalp']`
-            # would have caught it.
-        elif current_mode == 'general_analyze':
-            full_instruction_text = ANALYZE_INSTRUCTION_EN if lang == 'en' else ANALYZE_INSTRUCTION_ID
-        
-        contents = [
-            full_instruction_text,
-            uploaded_file
-        ]
-
-        # Configure generation settings to constrain output
-        generation_config = genai.types.GenerationConfig(
-            temperature=0.7,
-            max_output_tokens=300 # Reduced to encourage concise, single-signal output
-        )
+def record_groq_usage(backend, usage):
+    """Records a Groq usage object (completion.usage, or x_groq.usage on the last stream chunk)."""
+    if usage is not None:
+        record_token_usage(backend, usage.prompt_tokens, usage.completion_tokens)
 
-        gemini_response = vision_model.generate_content(
-            contents=contents,
-            safety_settings={
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
-            },
-            generation_config=generation_config
-        )
-        
-        raw_reply = ""
-        if not gemini_response.candidates:
-            block_reason_feedback = "UNKNOWN_REASON"
-            if gemini_response.prompt_feedback and gemini_response.prompt_feedback.block_reason:
-                block_reason_feedback = gemini_response.prompt_feedback.block_reason.name
-            
-            if block_reason_feedback == "SAFETY":
-                raise genai.types.BlockedPromptException(
-                    "Prompt blocked due to content policy. This often occurs if the chart or request implies risky financial behavior. Please try a different chart or a more general/educational request." if lang == 'en' else
-                    "Permintaan diblokir karena kebijakan konten. Ini sering terjadi jika chart atau permintaan menyiratkan perilaku keuangan berisiko. Silakan coba chart yang berbeda atau permintaan yang lebih umum/edukatif."
-                )
-            else:
-                raise ValueError(
-                    f"Gemini API did not return any candidates and was blocked for reason: {block_reason_feedback}." if lang == 'en' else
-                    f"API Gemini tidak mengembalikan hasil dan diblokir karena alasan: {block_reason_feedback}."
-                )
-        else:
-            raw_reply = gemini_response.text
+def record_gemini_usage(backend, response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        record_token_usage(backend, usage.prompt_token_count, usage.candidates_token_count)
+
+# ========== USAGE LEDGER ==========
+_usage = contextvars.ContextVar('usage', default=None) # Token tally of the model request in progress
+
+class QuotaExceededError(Exception):
+    pass
+
+def parse_model_prices(spec):
+    """'model=prompt:completion,...' in USD per million tokens -> {model: (prompt, completion)}"""
+    prices = {}
+    for item in spec.split(','):
+        model, _, price = item.strip().partition('=')
+        prompt_price, _, completion_price = price.partition(':')
+        try:
+            prices[model] = (float(prompt_price), float(completion_price or prompt_price))
+        except ValueError:
+            if item.strip():
+                print(f"Warning: Ignoring malformed MODEL_PRICES entry {item!r}")
+    return prices
+
+class UsageLedger:
+    """
+    Token, cost and latency accounting per model request. Each request is appended as one JSON line to a
+    per-day ledger file, and the totals per day, per chat and day, and per model and day are kept in memory,
+    so quota checks and per-chat lookups are dictionary reads. Tokens reach the request through a context
+    variable, which also covers calls the backend router runs on its own threads and tasks.
+    Every worker appends whole lines with O_APPEND and builds its totals by reading the ledger from where it
+    left off, so the workers of one host share their totals (and quotas), and a restart picks up the last
+    keep_days days. Without a ledger directory the totals are this process's own.
+    """
+    def __init__(self, directory=USAGE_LEDGER_DIR, keep_days=USAGE_KEEP_DAYS,
+                 chat_daily_tokens=USAGE_CHAT_DAILY_TOKENS, daily_tokens=USAGE_DAILY_TOKENS, prices=MODEL_PRICES):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.chat_daily_tokens = chat_daily_tokens
+        self.daily_tokens = daily_tokens
+        self.prices = parse_model_prices(prices)
+        self._days = OrderedDict() # day -> {'total': totals, 'chats': {chat_id: totals}, 'models': {model: totals}}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._offsets = {} # day -> bytes of its ledger file already added to the totals
+        self._fd = None
+        self._fd_day = None
+        self.stats = {'requests': 0, 'quota_rejections': 0, 'write_errors': 0, 'read': 0}
+
+    @staticmethod
+    def _today():
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    @staticmethod
+    def _new_totals():
+        return {'requests': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0, 'latency_total': 0.0}
+
+    def cost(self, backend, prompt_tokens, completion_tokens):
+        prompt_price, completion_price = self.prices.get(backend.partition(':')[2] or backend, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+    def _path(self, day):
+        return os.path.join(self.directory, f"usage-{day}.jsonl")
+
+    def _sync(self):
+        """Adds the lines appended to today's ledger since the last call, by any worker. Caller holds _lock."""
+        if not self.directory:
+            return
+        if not self._loaded:
+            self._loaded = True
+            if os.path.isdir(self.directory):
+                days = sorted(name[6:16] for name in os.listdir(self.directory) if name.startswith('usage-') and name.endswith('.jsonl'))
+                for day in days[-self.keep_days:]:
+                    self._read(day)
+        self._read(self._today())
+
+    def _read(self, day):
+        offset = self._offsets.get(day, 0)
+        try:
+            if os.path.getsize(self._path(day)) <= offset:
+                return
+            with open(self._path(day), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        complete = data.rfind(b"\n") + 1 # A line still being written is picked up next time
+        self._offsets[day] = offset + complete
+        for line in data[:complete].splitlines():
+            try:
+                self._add(json.loads(line))
+                self.stats['read'] += 1
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                print(f"Warning: Skipping malformed usage ledger line in {self._path(day)}")
+
+    def _add(self, entry):
+        day = self._days.get(entry['day'])
+        if day is None:
+            day = self._days[entry['day']] = {'total': self._new_totals(), 'chats': {}, 'models': {}}
+            while len(self._days) > max(1, self.keep_days):
+                self._days.popitem(last=False)
+        tokens = entry['prompt_tokens'] + entry['completion_tokens']
+        for totals in (day['total'], day['chats'].setdefault(entry['chat_id'], self._new_totals())):
+            totals['requests'] += 1
+            totals['errors'] += entry['outcome'] != 'ok'
+            totals['prompt_tokens'] += entry['prompt_tokens']
+            totals['completion_tokens'] += entry['completion_tokens']
+            totals['cost_usd'] += entry['cost_usd']
+            totals['latency_total'] += entry['latency_ms'] / 1000
+        for model, (prompt_tokens, completion_tokens) in entry['models'].items():
+            totals = day['models'].setdefault(model, self._new_totals())
+            totals['requests'] += 1
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+            totals['cost_usd'] += self.cost(model, prompt_tokens, completion_tokens)
+        return tokens
+
+    def _append(self, entry):
+        """Appends entry as one whole line. Returns False if it could not be written."""
+        try:
+            if self._fd_day != entry['day']:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                os.makedirs(self.directory, exist_ok=True)
+                self._fd = os.open(self._path(entry['day']), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self._fd_day = entry['day']
+            # One write per line: O_APPEND places it after every other worker's lines, never inside one
+            os.write(self._fd, (json.dumps(entry, separators=(',', ':')) + "\n").encode())
+            return True
+        except OSError as e:
+            self.stats['write_errors'] += 1
+            print(f"Warning: Failed to append to the usage ledger: {e}")
+            return False
+
+    def tokens_used(self, chat_id=None, day=None):
+        """Tokens used on day (default today) by chat_id, or by every chat together."""
+        with self._lock:
+            self._sync()
+            totals = self._days.get(day or self._today())
+            if totals is not None and chat_id is not None:
+                totals = {'total': totals['chats'].get(str(chat_id))}
+            totals = totals and totals['total']
+            return totals['prompt_tokens'] + totals['completion_tokens'] if totals else 0
+
+    def check_quota(self, chat_id):
+        """Raises QuotaExceededError if the chat, or all chats together, used up today's tokens."""
+        if not self.chat_daily_tokens and not self.daily_tokens:
+            return
+        if (self.chat_daily_tokens and self.tokens_used(chat_id) >= self.chat_daily_tokens) or \
+                (self.daily_tokens and self.tokens_used() >= self.daily_tokens):
+            with self._lock:
+                self.stats['quota_rejections'] += 1
+            metrics.inc('tradebot_quota_rejections_total', "Requests refused because a daily token quota was used up")
+            raise QuotaExceededError(f"Daily token quota used up for chat {chat_id}")
+
+    @contextmanager
+    def request(self, chat_id, kind):
+        """Bills every model call made inside the block to chat_id as one ledger entry of the given kind."""
+        tally = {'models': {}}
+        token = _usage.set(tally)
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield tally
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            _usage.reset(token)
+            self._record(str(chat_id), kind, tally['models'], time.monotonic() - start, tally.get('outcome', outcome))
 
-        reply_text = ""
-        if current_mode == 'setup':
-            json_match = re.search(r'```json\s*([\[\{].*?[\]\}])\s*```', raw_reply, re.DOTALL)
-            json_string = None
+    @asynccontextmanager
+    async def request_async(self, chat_id, kind):
+        """async with-version of request: the ledger is written and read back in a thread, off the event loop."""
+        tally = {'models': {}}
+        token = _usage.set(tally)
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield tally
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            _usage.reset(token)
+            await asyncio.to_thread(self._record, str(chat_id), kind, tally['models'], time.monotonic() - start, tally.get('outcome', outcome))
 
-            if json_match:
-                json_string = json_match.group(1).strip()
+    def add_tokens(self, backend, prompt_tokens, completion_tokens):
+        tally = _usage.get()
+        if tally is None:
+            return
+        with self._lock: # Hedged attempts may report from two threads at once
+            counts = tally['models'].setdefault(backend, [0, 0])
+            counts[0] += prompt_tokens
+            counts[1] += completion_tokens
+
+    def _record(self, chat_id, kind, models, seconds, outcome):
+        prompt_tokens = sum(counts[0] for counts in models.values())
+        completion_tokens = sum(counts[1] for counts in models.values())
+        entry = {
+            'ts': round(time.time(), 3), 'day': self._today(), 'chat_id': chat_id, 'kind': kind, 'outcome': outcome,
+            'models': models, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'cost_usd': round(sum(self.cost(model, *counts) for model, counts in models.items()), 8),
+            'latency_ms': round(seconds * 1000, 1),
+        }
+        with self._lock:
+            self._sync() # Everything before this entry, so reading it back below adds only this one
+            if self.directory and self._append(entry):
+                self._sync()
             else:
-                clean_raw_reply = re.sub(r'^[^{[]*|[^}\]]*$', '', raw_reply.strip())
-                if clean_raw_reply.startswith('{') and clean_raw_reply.endswith('}'):
-                    json_string = clean_raw_reply
-                elif clean_raw_reply.startswith('[') and clean_raw_reply.endswith(']'):
-                    json_string = clean_raw_reply
-                else:
-                    potential_objects = re.findall(r'\{[^}]*?\}', clean_raw_reply, re.DOTALL)
-                    if potential_objects:
-                        json_string = potential_objects[0]
+                self._add(entry)
+            self.stats['requests'] += 1
+        metrics.inc('tradebot_model_cost_usd_total', "Estimated model spend in USD", entry['cost_usd'], kind=kind)
 
+    def chat_usage(self, chat_id, day=None):
+        """Today's totals for one chat (zeros if it made no requests)."""
+        with self._lock:
+            self._sync()
+            totals = self._days.get(day or self._today(), {'chats': {}})['chats'].get(str(chat_id))
+            return dict(totals) if totals else self._new_totals()
 
-            setup_data = None
-            if json_string:
-                try:
-                    parsed_json = json.loads(json_string)
-                    if isinstance(parsed_json, list):
-                        if parsed_json:
-                            setup_data = parsed_json[0]
-                        else:
-                            raise json.JSONDecodeError("JSON array is empty.", json_string, 0)
-                    elif isinstance(parsed_json, dict):
-                        setup_data = parsed_json
-                    else:
-                        raise json.JSONDecodeError("Parsed JSON is not an object or array.", json_string, 0)
-
-                except json.JSONDecodeError as e:
-                    reply_text = (f"❌ Error: Could not parse setup data. "
-                                  f"The AI's response was not valid JSON ({e}). "
-                                  f"Raw response extracted:\n`{json_string}`") if lang == 'en' \
-                                 else (f"❌ Error: Tidak dapat mengurai data setup. "
-                                       f"Respon AI bukan JSON yang valid ({e}). "
-                                       f"Respon mentah yang diekstrak:\n`{json_string}`")
+    def report(self, top=10, day=None):
+        """Totals for day (default today): all chats, each model, and the top chats by tokens."""
+        with self._lock:
+            self._sync()
+            day = day or self._today()
+            totals = self._days.get(day)
+            if totals is None:
+                return {'day': day, 'total': self._new_totals(), 'models': {}, 'top_chats': []}
+            ranked = heapq.nlargest(top, totals['chats'].items(), key=lambda item: item[1]['prompt_tokens'] + item[1]['completion_tokens'])
+            return {'day': day, 'total': dict(totals['total']), 'chats': len(totals['chats']),
+                    'models': {model: dict(t) for model, t in totals['models'].items()},
+                    'top_chats': [{'chat_id': chat_id, **t} for chat_id, t in ranked]}
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'days': len(self._days)}
+
+usage_ledger = UsageLedger()
+
+def get_quota_text(lang):
+    return ("📉 The daily AI usage limit has been reached. It resets at 00:00 UTC." if lang == 'en'
+            else "📉 Batas penggunaan AI harian sudah tercapai. Batas direset pukul 00:00 UTC.")
+
+def get_quota_error(chat_id, lang):
+    """Returns the reply for a chat whose daily token quota is used up, or None if it may call a model."""
+    try:
+        usage_ledger.check_quota(chat_id)
+    except QuotaExceededError:
+        return get_quota_text(lang)
+    return None
+
+def get_usage_reply(chat_id, lang):
+    """Text for /usage: the chat's tokens and estimated cost today, plus the top consumers for admins (HTML)."""
+    en = lang == 'en'
+    mine = usage_ledger.chat_usage(chat_id)
+    tokens = mine['prompt_tokens'] + mine['completion_tokens']
+    lines = [f"🧮 <b>{'Your AI usage today' if en else 'Penggunaan AI Anda hari ini'}</b> (UTC)",
+             f"{'Requests' if en else 'Permintaan'}: {mine['requests']} · Tokens: <code>{tokens}</code> "
+             f"({mine['prompt_tokens']} in / {mine['completion_tokens']} out) · ~${mine['cost_usd']:.4f}"]
+    if usage_ledger.chat_daily_tokens:
+        lines.append(f"{'Daily limit' if en else 'Batas harian'}: <code>{usage_ledger.chat_daily_tokens}</code>")
+    if str(chat_id) in ADMIN_CHAT_IDS:
+        report = usage_ledger.report(top=10)
+        total = report['total']
+        lines += ["", f"<b>All chats</b>: {total['requests']} requests · <code>{total['prompt_tokens'] + total['completion_tokens']}</code> tokens · ~${total['cost_usd']:.4f}"]
+        lines += [f"<code>{html.escape(entry['chat_id'])}</code>: {entry['prompt_tokens'] + entry['completion_tokens']} tokens · "
+                  f"{entry['requests']} req · ~${entry['cost_usd']:.4f}" for entry in report['top_chats']]
+    return "\n".join(lines)
+
+# ========== REQUEST STATS ==========
+class StageStats:
+    """Per-stage timing (and counter) totals grouped by path, e.g. inline vs File API image uploads."""
+    def __init__(self, label):
+        self.label = label
+        self._lock = threading.Lock()
+        self._paths = {}
+
+    def record(self, path, timings, counters=None):
+        with self._lock:
+            totals = self._paths.setdefault(path, {'count': 0})
+            totals['count'] += 1
+            for stage, value in {**timings, **(counters or {})}.items():
+                totals[stage] = totals.get(stage, 0) + value
+        log_event(self.label, path=path, **{f"{stage}_ms": round(seconds * 1000) for stage, seconds in timings.items()}, **(counters or {}))
+
+    def snapshot(self):
+        """Returns average seconds per stage and average counters for each path."""
+        with self._lock:
+            return {
+                path: {'count': totals['count'], **{stage: value / totals['count'] for stage, value in totals.items() if stage != 'count'}}
+                for path, totals in self._paths.items()
+            }
+
+learn_reply_stats = StageStats("learn_reply")
+image_pipeline_stats = StageStats("chart_analysis")
+
+# ========== MESSAGE SPLITTING ==========
+TELEGRAM_MESSAGE_LIMIT = 4096
+HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z-]+)[^>]*>')
+
+def _safe_cut(text, limit):
+    """Finds a cut position <= limit at a paragraph, line or word break that is not inside a tag or entity."""
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, 0, limit)
+        while cut > limit // 2: # Don't trade a nicer break for a tiny part
+            head = text[:cut]
+            if head.rfind('<') <= head.rfind('>') and head.rfind('&') <= head.rfind(';'):
+                return cut
+            cut = text.rfind(separator, 0, cut)
+    cut = limit
+    while cut > 0 and (text.rfind('<', 0, cut) > text.rfind('>', 0, cut) or text.rfind('&', 0, cut) > text.rfind(';', 0, cut)):
+        cut -= 1
+    return cut or limit
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Splits text into Telegram-sized parts at safe HTML boundaries.
+    Tags still open at a cut are closed at the end of the part and reopened at the start of the next one.
+    """
+    parts = []
+    reopen = ""
+    text = text.strip()
+    while text:
+        text = reopen + text
+        budget = limit - 64 # Leave room for the closing tags we may have to append
+        if len(text) <= limit:
+            parts.append(text)
+            break
+        cut = _safe_cut(text, budget)
+        part, text = text[:cut], text[cut:].lstrip()
+        open_tags = []
+        for match in HTML_TAG_RE.finditer(part):
+            closing, tag = match.group(1), match.group(2).lower()
+            if not closing:
+                open_tags.append((tag, match.group(0)))
+            elif open_tags and open_tags[-1][0] == tag:
+                open_tags.pop()
+        parts.append(part + "".join(f"</{tag}>" for tag, _ in reversed(open_tags)))
+        reopen = "".join(opening for _, opening in open_tags)
+    return parts
+
+
+# ========== RATE LIMITING ==========
+class RateLimitedError(Exception):
+    """Raised when a request has to be turned away because of a per-chat or backend limit."""
+
+def get_slow_down_text(lang):
+    return ("⏳ You're sending requests too fast. Please wait a moment and try again." if lang == 'en'
+            else "⏳ Kamu mengirim permintaan terlalu cepat. Mohon tunggu sebentar lalu coba lagi.")
+
+class ChatRateLimiter:
+    """Token bucket per chat. Idle buckets are evicted once more than max_chats are tracked."""
+    def __init__(self, rate_per_minute, burst, max_chats=10000):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_chats = max_chats
+        self._buckets = OrderedDict() # chat_id -> [tokens, last refill timestamp]
+        self._lock = threading.Lock()
+        self.stats = {'allowed': 0, 'waited': 0, 'throttled': 0}
+
+    def reserve(self, chat_id, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        Reserves a token for chat_id and returns how many seconds the caller must wait before using it,
+        or None if the chat is over its limit for longer than max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.pop(chat_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            if wait > max_wait:
+                self._buckets[chat_id] = [tokens, now]
+                self.stats['throttled'] += 1
+                return None
+            self._buckets[chat_id] = [tokens - 1, now] # May go negative: the token is reserved while we sleep
+            while len(self._buckets) > self.max_chats:
+                self._buckets.popitem(last=False)
+            self.stats['waited' if wait else 'allowed'] += 1
+            return wait
+
+    def acquire(self, chat_id, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Takes a token for chat_id, sleeping up to max_wait for one. Returns False if the chat is over its limit."""
+        wait = self.reserve(chat_id, max_wait)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+    async def acquire_async(self, chat_id, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Like acquire, but waits with asyncio.sleep."""
+        wait = self.reserve(chat_id, max_wait)
+        if wait is None:
+            return False
+        if wait:
+            await asyncio.sleep(wait)
+        return True
+
+    def refund(self, chat_id):
+        """Returns a reserved token that ended up unused."""
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'chats': len(self._buckets)}
+
+class BackendLimiter:
+    """
+    Caps concurrent calls to one model backend. Waiting requests are queued per chat and
+    slots are handed out round-robin across chats, so one busy group can't starve everyone else.
+    """
+    def __init__(self, name, max_concurrent):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self._waiting = {} # chat_id -> deque of threading.Event
+        self._turns = deque() # chat_ids with waiters, in round-robin order
+        self._lock = threading.Lock()
+        self.stats = {'granted': 0, 'queued': 0, 'timeouts': 0}
+
+    def _dispatch(self):
+        while self.active < self.max_concurrent and self._turns:
+            chat_id = self._turns.popleft()
+            waiters = self._waiting[chat_id]
+            waiters.popleft().set()
+            self.active += 1
+            self.stats['granted'] += 1
+            if waiters:
+                self._turns.append(chat_id)
             else:
-                reply_text = (f"❌ Error: Could not find valid JSON in the AI's response for trade setup. "
-                              f"Raw AI response:\n`{raw_reply}`") if lang == 'en' \
-                             else (f"❌ Error: Tidak dapat menemukan JSON yang valid dalam respon AI untuk setup trading. "
-                                   f"Respon AI mentah:\n`{raw_reply}`")
-            
-            if setup_data:
-                # Bold the section title for better readability
-                if lang == 'en':
-                    reply_text = (
-                        f"📊 **Trade Setup ({current_sub_mode.capitalize()}):**\n"
-                        f"➡️ **Pair:** `{setup_data.get('Pair', 'N/A')}`\n"
-                        f"➡️ **Position:** `{setup_data.get('Position', 'N/A')}`\n"
-                        f"➡️ **Entry:** `{setup_data.get('Entry', 'N/A')}`\n"
-                        f"➡️ **TP:** `{setup_data.get('TP', 'N/A')}`\n"
-                        f"➡️ **SL:** `{setup_data.get('SL', 'N/A')}`\n"
-                        f"➡️ **RR:** `{setup_data.get('RR', 'N/A')}`\n"
-                        f"➡️ **Reason:** {setup_data.get('Reason', 'N/A')}\n\n"
-                        f"_Important: This analysis is for educational purposes only and not financial advice._"
-                    )
-                else: # id
-                    reply_text = (
-                        f"📊 **Setup Trading ({current_sub_mode.capitalize()}):**\n"
-                        f"➡️ **Pair:** `{setup_data.get('Pair', 'N/A')}`\n"
-                        f"➡️ **Position:** `{setup_data.get('Position', 'N/A')}`\n"
-                        f"➡️ **Entry:** `{setup_data.get('Entry', 'N/A')}`\n"
-                        f"➡️ **TP:** `{setup_data.get('TP', 'N/A')}`\n"
-                        f"➡️ **SL:** `{setup_data.get('SL', 'N/A')}`\n"
-                        f"➡️ **RR:** `{setup_data.get('RR', 'N/A')}`\n"
-                        f"➡️ **Alasan:** {setup_data.get('Reason', 'N/A')}\n\n"
-                        f"_Penting: Analisis ini murni bersifat edukatif dan bukan nasihat keuangan._"
-                    )
-        else: # general_analyze
-            reply_text = raw_reply + (
-                "\n\n_Important: This analysis is for educational purposes only and not financial advice._" if lang == 'en' else "\n\n_Penting: Analisis ini murni bersifat edukatif dan bukan nasihat keuangan._"
-            )
+                del self._waiting[chat_id]
 
-        bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=reply_text)
+    def _enqueue(self, chat_id, granted):
+        with self._lock:
+            if chat_id not in self._waiting:
+                self._waiting[chat_id] = deque()
+                self._turns.append(chat_id)
+            self._waiting[chat_id].append(granted)
+            if self.active >= self.max_concurrent:
+                self.stats['queued'] += 1
+            self._dispatch()
 
-    # Specific error handling for Gemini API content blocking
-    except genai.types.BlockedPromptException as e:
-        block_reason = "Unknown"
-        if e.response and e.response.prompt_feedback and e.response.prompt_feedback.block_reason:
-            block_reason = e.response.prompt_feedback.block_reason.name
-        
-        detailed_msg_en = f"The input (chart or caption) was blocked due to '{block_reason}' content policy. This often occurs if the chart or request implies risky financial behavior. Please try a different chart or a more general/educational request."
-        detailed_msg_id = f"Input (chart atau caption) diblokir karena kebijakan konten '{block_reason}'. Silakan coba chart yang berbeda atau modifikasi permintaan Anda agar tidak terlalu eksplisit tentang potensi risiko keuangan."
-        
-        final_error_msg = detailed_msg_en if lang == 'en' else detailed_msg_id
-        bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=f"❌ Analysis blocked by AI:\n{final_error_msg}")
+    def _cancel(self, chat_id, granted):
+        """Withdraws a timed-out waiter. Returns True if it was granted a slot just as it timed out."""
+        with self._lock:
+            if granted.is_set():
+                return True
+            waiters = self._waiting.get(chat_id)
+            if waiters is not None:
+                waiters.remove(granted)
+                if not waiters:
+                    del self._waiting[chat_id]
+                    self._turns.remove(chat_id)
+            self.stats['timeouts'] += 1
+            return False
 
-    except genai.types.StopCandidateException as e:
-        block_reason_category = "UNKNOWN"
-        if e.response and e.response.safety_ratings:
-            for rating in e.response.safety_ratings:
-                if rating.blocked:
-                    block_reason_category = rating.category.name.replace("HARM_CATEGORY_", "")
-                    break
-        
-        detailed_msg_en = f"The AI's response was blocked due to '{block_reason_category}' content policy. This can happen if the generated signal/analysis is interpreted as promoting high-risk behavior. Please try again with a different chart."
-        detailed_msg_id = f"Respons AI diblokir karena kebijakan konten '{block_reason_category}'. Ini bisa terjadi jika sinyal/analisis yang dihasilkan diinterpretasikan sebagai mendorong perilaku berisiko tinggi. Silakan coba lagi dengan chart yang berbeda."
-        
-        final_error_msg = detailed_msg_en if lang == 'en' else detailed_msg_id
-        bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=f"❌ AI response blocked:\n{final_error_msg}")
+    def acquire(self, chat_id, timeout=BACKEND_QUEUE_TIMEOUT):
+        granted = threading.Event()
+        self._enqueue(chat_id, granted)
+        return granted.wait(timeout) or self._cancel(chat_id, granted)
 
-    except Exception as e:
-        error_msg = f"❌ An unexpected error occurred during image analysis:\n{str(e)}" if lang == 'en' else f"❌ Terjadi error tak terduga saat analisis gambar:\n{str(e)}"
-        bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=error_msg)
-    finally:
-        # Clean up temporary files
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-            print(f"Cleaned up temporary file {temp_file_path}.")
-        # Delete the uploaded file from Gemini File API
-        if uploaded_file and uploaded_file.name:
-            try:
-                genai.delete_file(uploaded_file.name)
-                print(f"Cleaned up Gemini uploaded file {uploaded_file.name}.")
-            except Exception as delete_error:
-                print(f"Warning: Failed to delete Gemini file {uploaded_file.name}: {delete_error}")
+    async def acquire_async(self, chat_id, timeout=BACKEND_QUEUE_TIMEOUT):
+        """Like acquire, for the asyncio runtime. Must be used from a single event loop."""
+        granted = asyncio.Event()
+        self._enqueue(chat_id, granted)
+        try:
+            await asyncio.wait_for(granted.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._cancel(chat_id, granted)
 
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
 
-# ========= FLASK ROUTES =========
-@app.route("/")
-def home():
-    """Basic home route to indicate the bot is running."""
-    return "🤖 Bot is running via webhook!", 200
+    @contextmanager
+    def slot(self, chat_id):
+        """Holds one backend slot for the with-block; raises RateLimitedError if none frees up in time."""
+        if not self.acquire(chat_id):
+            raise RateLimitedError(f"No free {self.name} slot")
+        try:
+            yield
+        finally:
+            self.release()
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    """Webhook endpoint for Telegram updates."""
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode("utf-8")
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
-        return "OK", 200
-    return "Invalid request", 403
+    @asynccontextmanager
+    async def async_slot(self, chat_id):
+        """async with-version of slot."""
+        if not await self.acquire_async(chat_id):
+            raise RateLimitedError(f"No free {self.name} slot")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'active': self.active, 'max_concurrent': self.max_concurrent,
+                    'waiting': sum(len(waiters) for waiters in self._waiting.values()),
+                    'waiting_chats': len(self._waiting)}
+
+chat_rate_limiter = ChatRateLimiter(CHAT_RATE_PER_MINUTE, CHAT_BURST)
+backend_limiters = {
+    'groq': BackendLimiter('groq', GROQ_MAX_CONCURRENCY),
+    'gemini': BackendLimiter('gemini', GEMINI_MAX_CONCURRENCY),
+}
+
+
+# ========== OUTBOUND TELEGRAM ==========
+class TelegramOutbound:
+    """
+    Sends every Bot API request over one pooled keep-alive session, pacing messages and edits.
+    Each send waits for a token from its chat's bucket (Telegram allows about one message per second
+    per chat and 20 per minute per group) and from a global bucket (30 per second). A 429 blocks the chat
+    for its retry_after and the request is retried.
+
+    Paced requests from handler threads go into a per-chat queue that a few sender threads drain in order, so
+    no handler sleeps for its turn. Edits and chat actions return as soon as they are queued; an edit of a
+    message that already has an edit queued replaces that edit's text instead of queueing another call.
+    Sends still wait for their response, since the handler needs the sent message. The asyncio runtime
+    paces inline with the _register_edit/_claim_edit helpers instead, as its waits don't hold a thread.
+    """
+    PACED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+    DETACHED_METHODS = ('editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'sendChatAction')
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, pool_size=OUTBOUND_POOL_SIZE, max_wait=OUTBOUND_MAX_WAIT, max_retries=OUTBOUND_MAX_RETRIES,
+                 threads=OUTBOUND_THREADS):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.global_limiter = ChatRateLimiter(TELEGRAM_GLOBAL_PER_SECOND * 60, TELEGRAM_GLOBAL_PER_SECOND)
+        self.chat_limiter = ChatRateLimiter(TELEGRAM_CHAT_PER_MINUTE, TELEGRAM_CHAT_BURST)
+        self.group_limiter = ChatRateLimiter(TELEGRAM_GROUP_PER_MINUTE, TELEGRAM_CHAT_BURST)
+        self.threads = threads
+        self._edits = {} # (chat_id, message_id) -> {'latest': generation, 'claimed': generation, 'params': ..., 'send': ...}
+        self._blocked_until = {} # chat_id -> monotonic time its 429 block ends
+        self._lock = threading.Lock()
+        self._queue = threading.Condition() # Guards _chats, _ready and _seq; taken before _lock, never while reserving
+        self._chats = {} # chat_id -> deque of jobs not sent yet; present while the chat is scheduled or sending
+        self._ready = [] # Heap of (due, seq, chat_id): when each scheduled chat may send its first job
+        self._seq = 0
+        self._senders = []
+        self._waits = deque(maxlen=self.LATENCY_WINDOW)
+        self.stats = {'requests': 0, 'paced': 0, 'coalesced': 0, 'retried_429': 0, 'retry_after_total': 0.0,
+                      'dropped': 0, 'wait_max': 0.0}
+
+    def install(self):
+        """Routes all of telebot's synchronous API calls through this sender."""
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def _limiter(self, chat_id):
+        return self.group_limiter if str(chat_id).startswith('-') else self.chat_limiter
+
+    def _reserve(self, chat_id):
+        """Reserves a send slot and returns the seconds to wait for it, or None if the chat is backed up past max_wait."""
+        chat_wait = self._limiter(chat_id).reserve(chat_id, self.max_wait)
+        if chat_wait is None:
+            return None
+        global_wait = self.global_limiter.reserve('*', self.max_wait)
+        if global_wait is None:
+            self._limiter(chat_id).refund(chat_id)
+            return None
+        with self._lock:
+            blocked = self._blocked_until.get(chat_id, 0.0) - time.monotonic()
+            if blocked <= 0:
+                self._blocked_until.pop(chat_id, None)
+            self.stats['paced'] += 1
+        return max(chat_wait, global_wait, blocked, 0.0)
+
+    def _refund(self, chat_id):
+        self._limiter(chat_id).refund(chat_id)
+        self.global_limiter.refund('*')
+
+    def _block(self, chat_id, retry_after):
+        now = time.monotonic()
+        with self._lock:
+            # 429s are rare, so this is a cheap place to drop the blocks of chats that never sent again
+            for expired in [chat for chat, until in self._blocked_until.items() if until <= now]:
+                del self._blocked_until[expired]
+            self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), now + retry_after)
+            self.stats['retried_429'] += 1
+            self.stats['retry_after_total'] += retry_after
+
+    def _record_wait(self, wait):
+        metrics.observe('tradebot_telegram_queue_seconds', "Time a Bot API call waited for its send slot", wait)
+        with self._lock:
+            self._waits.append(wait)
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+
+    def _register_edit(self, method_name, chat_id, params):
+        """Records a pending message edit. Returns (key, generation), or None for anything else."""
+        if method_name != 'editMessageText' or 'message_id' not in params:
+            return None
+        key = (str(chat_id), params['message_id'])
+        with self._lock:
+            entry = self._edits.setdefault(key, {'latest': 0, 'claimed': 0, 'waiting': 0, 'params': None, 'send': None})
+            entry['latest'] += 1
+            entry['waiting'] += 1
+            entry['params'] = params
+            return key, entry['latest']
+
+    def _forget_edit(self, key, entry):
+        """Drops an edit entry once nobody waits on it and its last send finished. Caller holds _lock."""
+        if entry['waiting'] == 0 and (entry['send'] is None or entry['send']['finished']) and self._edits.get(key) is entry:
+            del self._edits[key]
+
+    def _claim_edit(self, key, generation, make_event):
+        """
+        Called when an edit's turn comes. Returns (params, send) with the newest text if this waiter sends,
+        or (None, send) of the in-flight or finished send that already covers it.
+        """
+        with self._lock:
+            entry = self._edits[key]
+            entry['waiting'] -= 1
+            if entry['claimed'] >= generation:
+                self.stats['coalesced'] += 1
+                send = entry['send']
+                self._forget_edit(key, entry)
+                return None, send
+            entry['claimed'] = entry['latest']
+            entry['send'] = {'done': make_event(), 'result': None, 'error': None, 'finished': False}
+            return entry['params'], entry['send']
+
+    def _abandon_edit(self, key):
+        """Called for an edit dropped before its turn came, so its entry doesn't wait for it forever."""
+        with self._lock:
+            entry = self._edits[key]
+            entry['waiting'] -= 1
+            self._forget_edit(key, entry)
+
+    def _refresh_edit(self, key):
+        """Picks up edits that arrived while a send was waiting out a 429."""
+        with self._lock:
+            entry = self._edits[key]
+            entry['claimed'] = entry['latest']
+            return entry['params']
+
+    def _finish_edit(self, key, send, result, error=None):
+        """Hands the response, or the error, of a send to the edits it covered."""
+        if result is None and error is None:
+            error = RateLimitedError("The send covering this edit was abandoned")
+        with self._lock:
+            send['result'] = result
+            send['error'] = error
+            send['finished'] = True
+            entry = self._edits.get(key)
+            if entry is not None:
+                self._forget_edit(key, entry)
+        send['done'].set()
+
+    def _covered_result(self, send, finished):
+        """What a coalesced edit returns: the response of the send that covered it, or that send's error."""
+        if not finished:
+            raise RateLimitedError(f"The send covering this edit is still pending after {self.max_wait:g}s")
+        if send['error'] is not None:
+            raise send['error']
+        return send['result']
+
+    def _start_senders(self):
+        """Starts the sender threads on the first paced request, so a forked worker starts its own."""
+        with self._queue:
+            if not self._senders:
+                self._senders = [threading.Thread(target=self._run_sender, name=f"outbound-{i}", daemon=True)
+                                 for i in range(max(1, self.threads))]
+                for thread in self._senders:
+                    thread.start()
+
+    def _enqueue(self, job):
+        """
+        Queues a job behind the chat's earlier ones. Returns the job that will carry it: itself, or a queued
+        edit of the same message that now sends this job's text.
+        """
+        chat_id = job['chat_id']
+        with self._queue:
+            jobs = self._chats.get(chat_id)
+            if jobs is not None and job['edit_key'] is not None:
+                for queued in jobs:
+                    if queued['edit_key'] == job['edit_key']:
+                        queued['params'] = job['params']
+                        with self._lock:
+                            self.stats['coalesced'] += 1
+                        return queued
+            if jobs is not None:
+                jobs.append(job)
+                return job
+            self._chats[chat_id] = deque([job])
+        self._schedule(chat_id)
+        return job
+
+    def _schedule(self, chat_id):
+        """Reserves a send slot for the chat's first job, dropping jobs that would wait past max_wait in total."""
+        while True:
+            wait = self._reserve(chat_id)
+            with self._queue:
+                jobs = self._chats[chat_id]
+                job = jobs[0]
+                waited = time.monotonic() - job['enqueued_at']
+                if wait is not None and (job['attempts'] > 0 or waited + wait <= self.max_wait):
+                    self._seq += 1
+                    heapq.heappush(self._ready, (time.monotonic() + wait, self._seq, chat_id))
+                    self._queue.notify()
+                    return
+                jobs.popleft()
+                if not jobs:
+                    del self._chats[chat_id]
+            if wait is not None:
+                self._refund(chat_id)
+            with self._lock:
+                self.stats['dropped'] += 1
+            self._finish(job, error=RateLimitedError(f"Outbound messages for chat {chat_id} are backed up over {self.max_wait:g}s"))
+            if not jobs:
+                return
+
+    def _run_sender(self):
+        while True:
+            with self._queue:
+                while not self._ready or self._ready[0][0] > time.monotonic():
+                    self._queue.wait(self._ready[0][0] - time.monotonic() if self._ready else None)
+                _, _, chat_id = heapq.heappop(self._ready)
+                job = self._chats[chat_id].popleft()
+            retry = self._send(job)
+            with self._queue:
+                jobs = self._chats[chat_id]
+                if retry:
+                    jobs.appendleft(job) # Still first in line, and later edits of it can still coalesce into it
+                elif not jobs:
+                    del self._chats[chat_id]
+                    continue
+            self._schedule(chat_id)
+
+    def _send(self, job):
+        """Sends one job. Returns True if it got a 429 and should be retried after the chat's block."""
+        if job['attempts'] == 0:
+            self._record_wait(time.monotonic() - job['enqueued_at'])
+        job['attempts'] += 1
+        try:
+            request_start = time.monotonic()
+            response = self.session.request(job['method'], job['url'], params=job['params'], files=job['files'],
+                                            timeout=job['timeout'], proxies=job['proxies'])
+            metrics.observe('tradebot_telegram_request_seconds', "Bot API request latency, excluding pacing",
+                            time.monotonic() - request_start, method=job['method_name'], status=response.status_code)
+            if response.status_code == 429 and job['attempts'] <= self.max_retries:
+                try:
+                    retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+                except ValueError:
+                    retry_after = 1.0
+                self._block(job['chat_id'], retry_after)
+                return True
+        except Exception as e:
+            self._finish(job, error=e)
+            return False
+        self._finish(job, response=response)
+        return False
+
+    def _finish(self, job, response=None, error=None):
+        job['response'] = response
+        job['error'] = error
+        if job['detached'] and (error is not None or response.status_code != 200):
+            # Nobody waits on an edit or chat action, so its failure is only logged
+            print(f"Warning: {job['method_name']} for chat {job['chat_id']} failed: "
+                  f"{error if error is not None else f'{response.status_code} {response.text[:200]}'}")
+        job['done'].set()
+
+    @staticmethod
+    def _accepted():
+        """The response a detached request returns once queued; telebot reads it as a successful edit."""
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        response._content = b'{"ok":true,"result":true}'
+        return response
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """telebot CUSTOM_REQUEST_SENDER: queues paced requests and waits only for the responses a handler uses."""
+        with self._lock:
+            self.stats['requests'] += 1
+        method_name = url.rsplit('/', 1)[-1]
+        chat_id = (params or {}).get('chat_id')
+        if chat_id is None or not method_name.startswith(self.PACED_PREFIXES):
+            return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+        self._start_senders()
+        edit_key = (str(chat_id), params['message_id']) if method_name == 'editMessageText' and 'message_id' in params else None
+        job = self._enqueue({
+            'method': method, 'url': url, 'params': params, 'files': files, 'timeout': timeout, 'proxies': proxies,
+            'method_name': method_name, 'chat_id': str(chat_id), 'edit_key': edit_key, 'detached': method_name in self.DETACHED_METHODS,
+            'attempts': 0, 'enqueued_at': time.monotonic(), 'done': threading.Event(), 'response': None, 'error': None,
+        })
+        if job['detached']:
+            return self._accepted()
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['response']
+
+    def snapshot(self):
+        with self._queue:
+            queued = sum(len(jobs) for jobs in self._chats.values())
+        with self._lock:
+            stats = dict(self.stats)
+            waits = sorted(self._waits)
+            stats['waiting'] = queued
+            stats['pending_edits'] = len(self._edits)
+            stats['chats_blocked'] = sum(1 for until in self._blocked_until.values() if until > time.monotonic())
+        stats['wait_avg'] = sum(waits) / len(waits) if waits else 0.0
+        stats['wait_p95'] = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return stats
+
+telegram_outbound = TelegramOutbound()
+telegram_outbound.install()
+
+
+# ========== BACKEND ROUTING ==========
+class BackendUnavailableError(Exception):
+    """Raised when every configured model backend failed, timed out or has its circuit open."""
+    def __init__(self, router, errors):
+        super().__init__(f"All {router} backends failed: " + "; ".join(errors) if errors else f"No {router} backend available")
+        self.errors = errors
+
+def get_backend_unavailable_text(lang):
+    return ("⚠️ The AI service is not responding right now. Please try again in a minute." if lang == 'en'
+            else "⚠️ Layanan AI sedang tidak merespons. Silakan coba lagi dalam satu menit.")
+
+def is_non_retryable(error):
+    """
+    True for errors caused by the request itself: another backend would fail the same way, and the provider is healthy.
+    Only SDKs already imported are checked, an error can't come from one that isn't.
+    """
+    errors = ()
+    if groq_sdk.loaded:
+        errors += (groq_sdk.BadRequestError,)
+    if genai.loaded:
+        errors += (genai.types.BlockedPromptException, genai.types.StopCandidateException)
+    return isinstance(error, errors)
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds,
+    then lets a single probe through (half-open) to decide whether to close again.
+    """
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """True if a call could be let through now. Does not change state."""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return not self._probing
+
+    def try_acquire(self):
+        """Lets a call through, turning an expired open circuit into a half-open probe."""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self._failures >= self.failure_threshold:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """Gives back a probe whose outcome will never be known (the call was cancelled)."""
+        with self._lock:
+            self._probing = False
+
+class ModelBackend:
+    """
+    One provider/model pair behind a router, parsed from "provider:model" or "provider:model@base_url".
+    base_url points Groq (an OpenAI-compatible API) at another server, e.g. a local stub.
+    """
+    LATENCY_WINDOW = 200
+
+    def __init__(self, spec, timeout):
+        provider_model, _, self.base_url = spec.strip().partition('@')
+        self.provider, _, self.model = provider_model.partition(':')
+        if self.provider not in ('groq', 'gemini') or not self.model:
+            raise ValueError(f"Unknown model backend {spec!r}, expected 'groq:<model>' or 'gemini:<model>'")
+        self.name = f"{self.provider}:{self.model}"
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._client = None
+        self._async_client = None
+        self._client_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'successes': 0, 'failures': 0, 'timeouts': 0, 'hedges': 0, 'hedge_wins': 0,
+                      'failovers': 0, 'breaker_rejections': 0}
+
+    @property
+    def client(self):
+        """The SDK client, created (and its SDK imported) on first use."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    if self.provider == 'groq':
+                        # The router retries on other backends, so the SDK must not hide slow retries from it
+                        self._client = groq_sdk.Groq(api_key=GROQ_API_KEY, base_url=self.base_url or None, max_retries=0)
+                    else:
+                        self._client = genai.GenerativeModel(self.model)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = (groq_sdk.AsyncGroq(api_key=GROQ_API_KEY, base_url=self.base_url or None, max_retries=0)
+                                  if self.provider == 'groq' else self.client)
+        return self._async_client
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def record(self, elapsed, error=None):
+        """Feeds the outcome of one call into the breaker, counters, latency window and metrics."""
+        outcome = 'ok' if error is None else 'timeout' if isinstance(error, TimeoutError) else 'error'
+        metrics.observe('tradebot_backend_request_seconds', "Model API call latency per backend", elapsed,
+                        backend=self.name, outcome=outcome)
+        if error is None:
+            self.breaker.record_success()
+            with self._lock:
+                self.stats['successes'] += 1
+                self._latencies.append(elapsed)
+        elif is_non_retryable(error):
+            self.breaker.record_success() # The provider answered, the request was the problem
+        else:
+            self.breaker.record_failure()
+            with self._lock:
+                self.stats['timeouts' if isinstance(error, TimeoutError) else 'failures'] += 1
+
+    def hedge_delay(self):
+        """Seconds after which a second request is worth sending, or None until enough latencies are known."""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return max(HEDGE_MIN_DELAY, latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE))])
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            latencies = sorted(self._latencies)
+        stats['breaker'] = self.breaker.state
+        stats['latency_p50'] = latencies[len(latencies) // 2] if latencies else None
+        stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+        return stats
+
+class BackendRouter:
+    """
+    Sends a request to the first backend whose circuit is closed and fails over down the list on errors and
+    timeouts. If the request is still running after the backend's HEDGE_PERCENTILE latency, a hedged copy
+    goes to the next backend (or the same one if there is no other) and whichever answers first wins.
+
+    Requests are passed as attempt(backend) callables so each call site keeps its own SDK code.
+    """
+    def __init__(self, name, specs, timeout, hedge=True):
+        self.name = name
+        self.backends = [ModelBackend(spec, timeout) for spec in specs.split(',') if spec.strip()]
+        self.hedge = hedge
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=ROUTER_THREADS, thread_name_prefix=f"{self.name}-router")
+            return self._executor
+
+    def _next_backend(self, candidates, exclude=None):
+        """Pops the next backend whose breaker lets a call through."""
+        while candidates:
+            backend = candidates.pop(0)
+            if backend is not exclude and backend.breaker.try_acquire():
+                return backend
+            backend.count('breaker_rejections')
+        return None
+
+    def _hedge_target(self, candidates, primary):
+        if candidates:
+            return self._next_backend(candidates)
+        return primary if primary.breaker.state == 'closed' else None
+
+    def call(self, attempt):
+        """Runs attempt(backend) in the router's thread pool and returns the first successful result."""
+        candidates = [b for b in self.backends if b.breaker.available()] or list(self.backends)
+        pending = {} # future -> (backend, started_at)
+        errors = []
+        hedged = False
+        decided = {'winner': None}
+        no_winner = object() # Set as the winner when call gives up, so every late result is closed
+        discard_lock = threading.Lock()
+
+        def discard(future):
+            """Closes the result of an attempt that lost or timed out (an open stream nobody reads), once."""
+            with discard_lock:
+                if future.discarded:
+                    return
+                future.discarded = True
+            close = getattr(future.result(), 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    print(f"Warning: Failed to close a losing {self.name} result: {e}")
+
+        def launch(backend, kind):
+            backend.count('calls')
+            if kind:
+                backend.count(kind)
+            started_at = time.monotonic()
+            # A copy of the caller's context per attempt, so spans and token usage reach the right request
+            future = self._pool().submit(contextvars.copy_context().run, attempt, backend)
+            future.timed_out = False
+            future.discarded = False
+            def on_done(f):
+                if not f.timed_out: # Otherwise the router already recorded a timeout
+                    backend.record(time.monotonic() - started_at, f.exception())
+                # The thread can't be cancelled: a result that arrives after another attempt won is closed instead
+                if f.exception() is None and (f.timed_out or decided['winner'] not in (None, f)):
+                    discard(f)
+            future.add_done_callback(on_done)
+            pending[future] = (backend, started_at)
+            return future
+
+        current = launch(self._first_backend(candidates), None)
+        try:
+            while True:
+                now = time.monotonic()
+                wake_at = min(started_at + backend.timeout for backend, started_at in pending.values())
+                hedge_at = None
+                if self.hedge and not hedged and current in pending:
+                    backend, started_at = pending[current]
+                    hedge_delay = backend.hedge_delay()
+                    if hedge_delay is not None:
+                        hedge_at = started_at + hedge_delay
+                        wake_at = min(wake_at, hedge_at)
+                done, _ = wait(list(pending), timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    backend, _ = pending.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        if future is not current:
+                            backend.count('hedge_wins')
+                        decided['winner'] = future
+                        return future.result()
+                    if is_non_retryable(error):
+                        raise error
+                    errors.append(f"{backend.name}: {error}")
+                    print(f"Warning: {self.name} backend {backend.name} failed: {error}")
+
+                now = time.monotonic()
+                for future, (backend, started_at) in list(pending.items()):
+                    if now - started_at >= backend.timeout:
+                        future.timed_out = True # The thread can't be stopped, its late result is ignored
+                        del pending[future]
+                        backend.record(now - started_at, TimeoutError())
+                        errors.append(f"{backend.name}: timed out after {backend.timeout:g}s")
+
+                if hedge_at is not None and current in pending and now >= hedge_at:
+                    hedged = True
+                    target = self._hedge_target(candidates, pending[current][0])
+                    if target is not None:
+                        launch(target, 'hedges')
+                if not pending:
+                    backend = self._next_backend(candidates)
+                    if backend is None:
+                        raise BackendUnavailableError(self.name, errors)
+                    current = launch(backend, 'failovers')
+        finally:
+            if decided['winner'] is None:
+                decided['winner'] = no_winner
+            for future in pending: # Attempts that finished before on_done could see the outcome
+                if future.done() and future.exception() is None:
+                    discard(future)
+
+    async def call_async(self, attempt):
+        """Async twin of call: attempt(backend) returns a coroutine, and losing or timed-out attempts are cancelled."""
+        candidates = [b for b in self.backends if b.breaker.available()] or list(self.backends)
+        pending = {} # task -> (backend, started_at)
+        errors = []
+        hedged = False
+
+        def launch(backend, kind):
+            backend.count('calls')
+            if kind:
+                backend.count(kind)
+            started_at = time.monotonic()
+            task = asyncio.ensure_future(attempt(backend))
+            def on_done(t):
+                if t.cancelled():
+                    backend.breaker.release()
+                else:
+                    backend.record(time.monotonic() - started_at, t.exception())
+            task.add_done_callback(on_done)
+            pending[task] = (backend, started_at)
+            return task
+
+        current = launch(self._first_backend(candidates), None)
+        try:
+            while True:
+                now = time.monotonic()
+                wake_at = min(started_at + backend.timeout for backend, started_at in pending.values())
+                hedge_at = None
+                if self.hedge and not hedged and current in pending:
+                    backend, started_at = pending[current]
+                    hedge_delay = backend.hedge_delay()
+                    if hedge_delay is not None:
+                        hedge_at = started_at + hedge_delay
+                        wake_at = min(wake_at, hedge_at)
+                done, _ = await asyncio.wait(list(pending), timeout=max(0.0, wake_at - now), return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    backend, _ = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if task is not current:
+                            backend.count('hedge_wins')
+                        return task.result()
+                    if is_non_retryable(error):
+                        raise error
+                    errors.append(f"{backend.name}: {error}")
+                    print(f"Warning: {self.name} backend {backend.name} failed: {error}")
+
+                now = time.monotonic()
+                for task, (backend, started_at) in list(pending.items()):
+                    if now - started_at >= backend.timeout:
+                        del pending[task]
+                        task.cancel()
+                        backend.record(now - started_at, TimeoutError())
+                        errors.append(f"{backend.name}: timed out after {backend.timeout:g}s")
+
+                if hedge_at is not None and current in pending and now >= hedge_at:
+                    hedged = True
+                    target = self._hedge_target(candidates, pending[current][0])
+                    if target is not None:
+                        launch(target, 'hedges')
+                if not pending:
+                    backend = self._next_backend(candidates)
+                    if backend is None:
+                        raise BackendUnavailableError(self.name, errors)
+                    current = launch(backend, 'failovers')
+        finally:
+            for task in pending:
+                task.cancel() # Losing hedges stop here instead of burning tokens
+
+    def _first_backend(self, candidates):
+        backend = self._next_backend(candidates)
+        if backend is None:
+            raise BackendUnavailableError(self.name, [])
+        return backend
+
+    def snapshot(self):
+        return {backend.name: backend.snapshot() for backend in self.backends}
+
+learn_router = BackendRouter('learn', LEARN_BACKENDS, LEARN_BACKEND_TIMEOUT, LEARN_HEDGING)
+chart_router = BackendRouter('chart', CHART_BACKENDS, CHART_BACKEND_TIMEOUT, CHART_HEDGING)
+
+
+# ========== LEARN ANSWER CACHE ==========
+LEARN_QUESTION_STRIP_RE = re.compile(r"@\w+|[^\w\s]")
+
+def normalize_question(text):
+    """Lowercases a question and drops mentions, punctuation and repeated whitespace."""
+    return " ".join(LEARN_QUESTION_STRIP_RE.sub(" ", text.lower()).split())
+
+# Questions about a ticker or about right now are answered for the market of the moment and never cached.
+# Tickers are $-prefixed or all-caps words that aren't a trading term, pairs like eurusd/btcusdt, or common names
+LEARN_TICKER_CASE_RE = re.compile(r"\$[A-Za-z]{2,10}\b|\b[A-Z][A-Z0-9]{1,9}\b")
+LEARN_TICKER_RE = re.compile(
+    r"^(?:[a-z]{2,6}(?:usdt|usdc|busd|usd|perp)|(?:usd|eur|gbp|aud|nzd|cad|chf|jpy){2}"
+    r"|btc|bitcoin|eth|ethereum|sol|xrp|bnb|doge|ada|xau|xag|gold|emas|silver|nasdaq|spx|dxy|oil)$")
+LEARN_ACRONYMS = {
+    'rsi', 'macd', 'ema', 'sma', 'ma', 'atr', 'bb', 'adx', 'vwap', 'obv', 'sl', 'tp', 'rr', 'pnl', 'roi', 'dca',
+    'ath', 'atl', 'fomo', 'fud', 'hodl', 'ict', 'smc', 'fvg', 'bos', 'choch', 'ob', 'sr', 'ta', 'fa', 'etf',
+    'ipo', 'cpi', 'fomc', 'nfp', 'gdp', 'ai', 'ok', 'pdf', 'usd',
+}
+LEARN_TIME_WORDS_RE = re.compile(
+    r"\b(?:today|now|tonight|currently|yesterday|tomorrow|this (?:week|month|morning)|latest"
+    r"|hari ini|sekarang|malam ini|saat ini|kemarin|besok|minggu ini|bulan ini|terbaru)\b")
+# Questions about prices and trends, or with numbers and timeframes, are only reused for LEARN_CACHE_MARKET_TTL
+LEARN_MARKET_WORDS_RE = re.compile(r"\b(?:price|prices|market|trend|bullish|bearish|pump|dump|harga|pasar|naik|turun)\b")
+# Numbers and timeframes (1h, H4, m15, daily) change the answer even when the rest of the question matches
+LEARN_KEY_TOKEN_RE = re.compile(r"^(?:\d+(?:[smhdwy]|mn)?|[smhdw]\d+|daily|weekly|monthly|hourly|harian|mingguan|bulanan)$")
+
+def learn_question_tokens(question, normalized):
+    """
+    Returns (volatile, keys) for a question: whether it names a ticker or a time like "today", and the
+    number and timeframe tokens a similar question must share before its answer is reused.
+    """
+    keys = frozenset(token for token in normalized.split() if LEARN_KEY_TOKEN_RE.match(token))
+    words = {match.lstrip('$').lower() for match in LEARN_TICKER_CASE_RE.findall(question)} - LEARN_ACRONYMS
+    tickers = {word for word in words if not LEARN_KEY_TOKEN_RE.match(word)}
+    tickers |= {token for token in normalized.split() if LEARN_TICKER_RE.match(token)}
+    return bool(tickers or LEARN_TIME_WORDS_RE.search(normalized)), keys
+
+def estimate_tokens(text):
+    """Rough token count for when the API doesn't report usage (~4 characters per token)."""
+    return max(1, len(text) // 4)
+
+class LearnAnswerCache:
+    """
+    Learn mode answers keyed on the normalized question, partitioned by language.
+    Near-duplicate questions are found with MinHash over character 3-grams and LSH banding, and a stored
+    answer is only served when the exact Jaccard similarity of the two questions reaches the threshold and
+    both have the same numbers and timeframes. Questions naming a ticker or a time like "today" are never
+    cached, and market questions expire after market_ttl instead of ttl.
+    """
+    NUM_PERM = 64
+    BANDS = 16 # 4 rows per band: pairs with similarity 0.8 share a band ~99.9% of the time
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, max_size, ttl, threshold, market_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.market_ttl = market_ttl
+        self.threshold = threshold
+        rng = random.Random(1337) # Fixed seed, signatures must stay comparable for the life of the process
+        self._perms = [(rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(self.NUM_PERM)]
+        self._partitions = {} # lang -> OrderedDict(normalized -> entry)
+        self._buckets = {} # lang -> {(band, band_hash): set(normalized)}
+        self._lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0, 'uncacheable': 0, 'saved_tokens': 0,
+                      'lookups': 0, 'lookup_total_ms': 0.0, 'lookup_max_ms': 0.0}
+
+    @staticmethod
+    def _shingles(normalized):
+        padded = f" {normalized} "
+        return {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+
+    def _bands(self, shingles):
+        hashes = [zlib.crc32(shingle.encode()) for shingle in shingles]
+        signature = [min((a * h + b) % self.PRIME for h in hashes) for a, b in self._perms]
+        rows = self.NUM_PERM // self.BANDS
+        return [(band, hash(tuple(signature[band * rows:(band + 1) * rows]))) for band in range(self.BANDS)]
+
+    def _drop(self, lang, normalized, entry):
+        buckets = self._buckets[lang]
+        for band in entry['bands']:
+            members = buckets.get(band)
+            if members is not None:
+                members.discard(normalized)
+                if not members:
+                    del buckets[band]
+
+    def get(self, lang, question):
+        """Returns a cached answer for this question or a near-duplicate of it, or None."""
+        if self.max_size <= 0:
+            return None
+        start = time.perf_counter()
+        normalized = normalize_question(question)
+        volatile, keys = learn_question_tokens(question, normalized)
+        if volatile:
+            with self._lock:
+                self.stats['uncacheable'] += 1
+            return None
+        answer = None
+        with self._lock:
+            partition = self._partitions.get(lang, {})
+            now = time.time()
+            entry = partition.get(normalized)
+            if entry is not None and now - entry['created_at'] < entry['ttl']:
+                answer = entry
+                self.stats['exact_hits'] += 1
+            elif partition:
+                shingles = self._shingles(normalized)
+                candidates = set()
+                for band in self._bands(shingles):
+                    candidates |= self._buckets[lang].get(band, set())
+                best, best_score = None, self.threshold
+                for candidate in candidates:
+                    other = partition[candidate]
+                    if now - other['created_at'] >= other['ttl'] or other['keys'] != keys:
+                        continue
+                    score = len(shingles & other['shingles']) / len(shingles | other['shingles'])
+                    if score >= best_score:
+                        best, best_score = other, score
+                if best is not None:
+                    answer = best
+                    self.stats['similar_hits'] += 1
+            if answer is None:
+                self.stats['misses'] += 1
+            else:
+                partition.move_to_end(answer['question'])
+                self.stats['saved_tokens'] += answer['tokens']
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.stats['lookups'] += 1
+            self.stats['lookup_total_ms'] += elapsed_ms
+            self.stats['lookup_max_ms'] = max(self.stats['lookup_max_ms'], elapsed_ms)
+        return answer['answer'] if answer else None
+
+    def put(self, lang, question, answer, tokens=None):
+        """Stores an answer. tokens is what generating it cost, counted as saved on every later hit."""
+        if self.max_size <= 0 or not answer:
+            return
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        volatile, keys = learn_question_tokens(question, normalized)
+        if volatile:
+            return
+        market = bool(keys) or LEARN_MARKET_WORDS_RE.search(normalized) is not None
+        shingles = self._shingles(normalized)
+        entry = {'question': normalized, 'answer': answer, 'created_at': time.time(), 'shingles': shingles,
+                 'bands': self._bands(shingles), 'keys': keys, 'ttl': self.market_ttl if market else self.ttl,
+                 'tokens': tokens or estimate_tokens(question) + estimate_tokens(answer)}
+        with self._lock:
+            partition = self._partitions.setdefault(lang, OrderedDict())
+            buckets = self._buckets.setdefault(lang, {})
+            old = partition.pop(normalized, None)
+            if old is not None:
+                self._drop(lang, normalized, old)
+            partition[normalized] = entry
+            for band in entry['bands']:
+                buckets.setdefault(band, set()).add(normalized)
+            while len(partition) > self.max_size:
+                evicted, evicted_entry = partition.popitem(last=False)
+                self._drop(lang, evicted, evicted_entry)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = {lang: len(partition) for lang, partition in self._partitions.items()}
+        hits = stats['exact_hits'] + stats['similar_hits']
+        stats['hit_rate'] = hits / stats['lookups'] if stats['lookups'] else 0.0
+        stats['lookup_avg_ms'] = stats.pop('lookup_total_ms') / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
+
+learn_answer_cache = LearnAnswerCache(LEARN_CACHE_SIZE, LEARN_CACHE_TTL, LEARN_CACHE_SIMILARITY, LEARN_CACHE_MARKET_TTL)
+
+
+# ========== CONVERSATION MEMORY ==========
+class ConversationMemory:
+    """
+    The last few Learn exchanges of each chat, kept zlib-compressed in a bounded ring buffer, so a follow-up
+    question is sent with its context. Exchanges pushed out of the buffer leave their question behind in a
+    short rolling summary. context() fits the newest exchanges plus that summary into a fixed token budget,
+    so prompts stop growing however long a chat gets. Chats idle for idle_ttl, or beyond max_chats, are dropped.
+    Memory is per process: with several workers a chat's questions can reach different workers, each of
+    which then knows only the exchanges it answered itself.
+    """
+    SUMMARY_QUESTION_CHARS = 120
+
+    def __init__(self, max_turns=CONVERSATION_MAX_TURNS, token_budget=CONVERSATION_TOKEN_BUDGET,
+                 summary_tokens=CONVERSATION_SUMMARY_TOKENS, idle_ttl=CONVERSATION_IDLE_TTL, max_chats=CONVERSATION_MAX_CHATS):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self._chats = OrderedDict() # chat_id -> {'turns': deque, 'summary': deque, 'last_used': t, 'bytes': n}; oldest first
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.stats = {'turns_added': 0, 'turns_summarized': 0, 'chats_evicted': 0, 'contexts': 0, 'truncated_answers': 0}
+
+    @staticmethod
+    def _pack(text):
+        return zlib.compress(text.encode(), 6)
+
+    @staticmethod
+    def _unpack(blob):
+        return zlib.decompress(blob).decode()
+
+    def _evict(self, now):
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and now - chat['last_used'] < self.idle_ttl:
+                break
+            self._chats.popitem(last=False)
+            self._bytes -= chat['bytes']
+            self.stats['chats_evicted'] += 1
+
+    def _publish(self):
+        metrics.set('tradebot_conversation_memory_bytes', "Compressed bytes held by Learn conversation memory", self._bytes)
+        metrics.set('tradebot_conversation_memory_chats', "Chats with Learn conversation memory", len(self._chats))
+
+    def add(self, chat_id, question, answer):
+        """Remembers one finished exchange."""
+        if self.max_turns <= 0 or not answer:
+            return
+        now = time.monotonic()
+        turn = (self._pack(question), self._pack(answer), estimate_tokens(question), estimate_tokens(answer))
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = {'turns': deque(), 'summary': deque(), 'last_used': now, 'bytes': 0}
+            self._chats.move_to_end(chat_id)
+            chat['last_used'] = now
+            chat['turns'].append(turn)
+            size = len(turn[0]) + len(turn[1])
+            while len(chat['turns']) > self.max_turns:
+                old = chat['turns'].popleft()
+                size -= len(old[0]) + len(old[1])
+                topic = " ".join(self._unpack(old[0]).split())[:self.SUMMARY_QUESTION_CHARS]
+                chat['summary'].append(topic)
+                size += len(topic)
+                self.stats['turns_summarized'] += 1
+                while sum(estimate_tokens(t) for t in chat['summary']) > self.summary_tokens and len(chat['summary']) > 1:
+                    size -= len(chat['summary'].popleft())
+            chat['bytes'] += size
+            self._bytes += size
+            self.stats['turns_added'] += 1
+            self._evict(now)
+            self._publish()
+
+    def has_history(self, chat_id):
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            return chat is not None and time.monotonic() - chat['last_used'] < self.idle_ttl
+
+    def context(self, chat_id):
+        """
+        Returns (summary, [(question, answer), ...] oldest first) for chat_id within token_budget: the newest exchanges
+        that fit, the newest one with its answer cut short if it alone is too long, and the questions of everything
+        older as the summary.
+        """
+        with self._lock:
+            self._evict(time.monotonic())
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                return "", []
+            turns = list(chat['turns'])
+            topics = list(chat['summary'])
+            self.stats['contexts'] += 1
+
+        budget = self.token_budget - (self.summary_tokens if topics or len(turns) > 1 else 0)
+        picked = []
+        for i, (question, answer, question_tokens, answer_tokens) in enumerate(reversed(turns)):
+            if question_tokens + answer_tokens <= budget:
+                picked.append((self._unpack(question), self._unpack(answer)))
+                budget -= question_tokens + answer_tokens
+            elif i == 0 and question_tokens < budget:
+                picked.append((self._unpack(question), self._unpack(answer)[:(budget - question_tokens) * 4] + " …"))
+                budget = 0
+                self.stats['truncated_answers'] += 1
+            else:
+                # Too old to fit: only the question survives, in the summary
+                topics += [" ".join(self._unpack(q).split())[:self.SUMMARY_QUESTION_CHARS] for q, *_ in turns[:len(turns) - i]]
+                break
+        summary = ""
+        while topics:
+            summary = "; ".join(topics)
+            if estimate_tokens(summary) <= self.summary_tokens:
+                break
+            topics.pop(0)
+        return (summary if topics else ""), picked[::-1]
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'chats': len(self._chats), 'turns': sum(len(c['turns']) for c in self._chats.values()),
+                    'bytes': self._bytes}
+
+conversation_memory = ConversationMemory()
+
+# ========== TEXT HANDLER ==========
+_bot_identity = None
+_bot_identity_lock = threading.Lock()
+group_filter_stats = {'group_messages': 0, 'addressed': 0, 'short_circuited': 0}
+group_filter_lock = threading.Lock() # Group messages are filtered on every ingest worker thread
+
+def group_filter_snapshot():
+    with group_filter_lock:
+        return dict(group_filter_stats)
+
+def get_bot_identity(refresh=False):
+    """Returns the bot's own User, calling getMe only the first time or when refresh is requested."""
+    global _bot_identity
+    with _bot_identity_lock:
+        if _bot_identity is None or refresh:
+            _bot_identity = bot.get_me()
+        return _bot_identity
+
+def is_addressed_to_bot(message):
+    """
+    Cheap pre-filter for text messages and documents: private chats always pass, group messages
+    only when they mention the bot or reply to it. Runs before any handler work or network I/O.
+    """
+    if message.chat.type not in ["group", "supergroup"]:
+        return True
+    me = get_bot_identity()
+    bot_mention = f"@{me.username.lower()}"
+    text = message.text or message.caption or "" # Documents are addressed through their caption
+    is_mentioned = any(
+        (entity.type == "mention" and text[entity.offset:entity.offset + entity.length].lower() == bot_mention)
+        or (entity.type == "text_mention" and entity.user and entity.user.id == me.id)
+        for entity in message.entities or message.caption_entities or []
+    )
+    is_reply_to_bot = bool(message.reply_to_message and message.reply_to_message.from_user
+                           and message.reply_to_message.from_user.id == me.id)
+    addressed = is_mentioned or is_reply_to_bot
+    with group_filter_lock:
+        group_filter_stats['group_messages'] += 1
+        group_filter_stats['addressed' if addressed else 'short_circuited'] += 1
+    return addressed
+
+def get_learn_mode_error(lang):
+    return "Please switch to **Learn** mode to send text queries. Use /menu to change." if lang == 'en' else "Mohon beralih ke mode **Belajar** untuk mengirim pertanyaan teks. Gunakan /menu untuk mengubahnya."
+
+def get_thinking_text(lang):
+    return "⏳ Thinking..." if lang == 'en' else "⏳ Sedang berpikir..."
+
+def build_learn_messages(lang, user_input, summary="", history=()):
+    """Builds the Groq chat messages for a Learn mode question, after the summary and exchanges of earlier turns."""
+    current_system_prompt = BASE_SYSTEM_PROMPT_EN if lang == 'en' else BASE_SYSTEM_PROMPT_ID
+    messages = [{"role": "system", "content": current_system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": f"Earlier in this conversation the user asked about: {summary}"})
+    for question, answer in history:
+        messages += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+def assemble_learn_messages(chat_id, lang, user_input):
+    """Returns (messages, with_context) for a Learn question, with the chat's remembered context fitted into the token budget."""
+    summary, history = conversation_memory.context(chat_id)
+    messages = build_learn_messages(lang, user_input, summary, history)
+    with_context = bool(summary or history)
+    metrics.observe('tradebot_learn_prompt_tokens', "Estimated prompt tokens of Learn requests",
+                    sum(estimate_tokens(m['content']) for m in messages), buckets=TOKEN_BUCKETS, context='yes' if with_context else 'no')
+    return messages, with_context
+
+def chunk_usage(chunk):
+    """Token usage carried by a Groq stream chunk (only the last one has it), or None."""
+    x_groq = getattr(chunk, 'x_groq', None)
+    return chunk.usage or (x_groq.usage if x_groq is not None else None)
+
+@bot.message_handler(func=lambda m: m.content_type == 'text' and is_addressed_to_bot(m))
+def handle_text(message):
+    with trace_context(handler='text', chat_id=message.chat.id, message_id=message.message_id):
+        _handle_text(message)
+
+def _handle_text(message):
+    chat_id = str(message.chat.id)
+
+    user_settings = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
+    lang = user_settings['lang']
+    mode = user_settings['mode']
+
+    # Ensure text messages are only handled in 'learn' mode
+    if mode != 'learn':
+        bot.reply_to(message, get_learn_mode_error(lang))
+        return
+
+    # Cached answers cost no model call, so they are served before the rate limit. A follow-up question
+    # depends on the conversation so far, so it is never answered from (or stored in) the shared cache
+    start = time.monotonic()
+    cached = None
+    if not conversation_memory.has_history(chat_id):
+        with span('cache_lookup'):
+            cached = learn_answer_cache.get(lang, message.text)
+    if cached is not None:
+        for part in split_message(cached):
+            bot.reply_to(message, part)
+        elapsed = time.monotonic() - start
+        learn_reply_stats.record('cached', {'first_token': elapsed, 'total': elapsed})
+        conversation_memory.add(chat_id, message.text, cached)
+        journal_learn(chat_id, lang, message.text, cached)
+        return
+
+    quota_error = get_quota_error(chat_id, lang)
+    if quota_error:
+        bot.reply_to(message, quota_error)
+        return
+
+    with span('rate_limit'):
+        allowed = chat_rate_limiter.acquire(chat_id)
+    if not allowed:
+        bot.reply_to(message, get_slow_down_text(lang))
+        return
+
+    try:
+        messages, with_context = assemble_learn_messages(chat_id, lang, message.text)
+
+        if LEARN_STREAMING:
+            wait_start = time.monotonic()
+            with backend_limiters['groq'].slot(chat_id), usage_ledger.request(chat_id, 'learn') as usage:
+                observe_stage('backend_wait', time.monotonic() - wait_start)
+                reply = stream_learn_reply(message, messages, lang)
+                if reply is None:
+                    usage['outcome'] = 'error' # The failure was already shown in the placeholder
+            if not with_context:
+                learn_answer_cache.put(lang, message.text, reply)
+            conversation_memory.add(chat_id, message.text, reply)
+            journal_learn(chat_id, lang, message.text, reply)
+            return
+
+        def complete(backend):
+            completion = backend.client.chat.completions.create(
+                messages=messages, model=backend.model, timeout=backend.timeout, **LEARN_COMPLETION_OPTIONS)
+            record_groq_usage(backend.name, completion.usage)
+            return completion
+
+        start = time.monotonic()
+        with backend_limiters['groq'].slot(chat_id):
+            observe_stage('backend_wait', time.monotonic() - start)
+            with span('generate'), usage_ledger.request(chat_id, 'learn'):
+                completion = learn_router.call(complete)
+        reply = completion.choices[0].message.content
+        if not (reply or "").strip():
+            raise BackendUnavailableError(learn_router.name, ["the model returned an empty answer"])
+        with span('reply'):
+            for part in split_message(reply):
+                bot.reply_to(message, part)
+        elapsed = time.monotonic() - start
+        learn_reply_stats.record('blocking', {'first_token': elapsed, 'total': elapsed})
+        if not with_context:
+            learn_answer_cache.put(lang, message.text, reply, completion.usage.total_tokens if completion.usage else None)
+        conversation_memory.add(chat_id, message.text, reply)
+        journal_learn(chat_id, lang, message.text, reply)
+    except RateLimitedError:
+        bot.reply_to(message, get_slow_down_text(lang))
+    except BackendUnavailableError as e:
+        print(f"Warning: {e}")
+        bot.reply_to(message, get_backend_unavailable_text(lang))
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error:\n{str(e)}" if lang == 'en' else f"❌ Error:\n{str(e)}")
+
+def iter_stream_deltas(stream, backend, first=None):
+    """
+    Yields the non-empty text deltas of a Groq completion stream, starting with an already read one.
+    Token usage from the final chunk is recorded for backend.
+    """
+    if first:
+        yield first
+    for chunk in stream:
+        usage = chunk_usage(chunk)
+        if usage is not None:
+            record_groq_usage(backend.name, usage)
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+class LearnStream:
+    """The text deltas of a Groq completion stream whose first delta already arrived. close() releases its connection."""
+    def __init__(self, stream, backend, first):
+        self._stream = stream
+        self._deltas = iter_stream_deltas(stream, backend, first)
+
+    def __iter__(self):
+        return self._deltas
+
+    def close(self):
+        self._stream.close()
+
+def open_learn_stream(backend, messages):
+    """
+    Starts a streamed completion on one backend and waits for its first token, so the router
+    times, hedges and fails over on time-to-first-token. Returns a LearnStream over the text deltas.
+    """
+    stream = backend.client.chat.completions.create(messages=messages, model=backend.model, stream=True,
+                                                    timeout=backend.timeout, **LEARN_COMPLETION_OPTIONS)
+    for first in iter_stream_deltas(stream, backend):
+        return LearnStream(stream, backend, first)
+    return iter(())
+
+def stream_learn_reply(message, messages, lang):
+    """
+    Streams a Groq completion into a placeholder reply, editing it at most every LEARN_STREAM_EDIT_INTERVAL seconds.
+    Answers longer than one Telegram message continue in follow-up messages.
+    Returns the full answer, or None if the stream failed.
+    """
+    start = time.monotonic()
+    with span('placeholder'):
+        placeholder = bot.reply_to(message, get_thinking_text(lang))
+    sent = [[placeholder, ""]] # [message, text currently shown] per Telegram message
+    counters = {'edits': 0, 'messages': 1}
+    first_token_at = None
+    reply = ""
+
+    def publish():
+        for i, part in enumerate(split_message(reply)):
+            if i == len(sent):
+                sent.append([bot.send_message(message.chat.id, part, reply_to_message_id=message.message_id), part])
+                counters['messages'] += 1
+            elif sent[i][1] != part:
+                bot.edit_message_text(chat_id=message.chat.id, message_id=sent[i][0].message_id, text=part)
+                sent[i][1] = part
+                counters['edits'] += 1
+
+    try:
+        with span('first_token'):
+            deltas = learn_router.call(lambda backend: open_learn_stream(backend, messages))
+        generate_start = last_publish = time.monotonic()
+        for delta in deltas:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            reply += delta
+            if time.monotonic() - last_publish >= LEARN_STREAM_EDIT_INTERVAL:
+                with span('publish'):
+                    publish()
+                last_publish = time.monotonic()
+        observe_stage('stream', time.monotonic() - generate_start)
+        if not reply.strip(): # Nothing to show, the placeholder would keep saying it is thinking
+            raise BackendUnavailableError(learn_router.name, ["the model returned an empty answer"])
+        with span('publish'):
+            publish()
+    except Exception as e:
+        error_text = get_backend_unavailable_text(lang) if isinstance(e, BackendUnavailableError) else f"❌ Error:\n{str(e)}"
+        bot.edit_message_text(chat_id=message.chat.id, message_id=sent[-1][0].message_id,
+                              text=(sent[-1][1] + "\n\n" if sent[-1][1] else "") + error_text)
+        return None
+
+    end = time.monotonic()
+    learn_reply_stats.record('stream', {'first_token': (first_token_at or end) - start, 'total': end - start}, counters)
+    return reply
+
+# ========== ANALYSIS CACHE ==========
+class AnalysisCache:
+    """
+    LRU cache with TTL for formatted chart analyses, with an optional sqlite tier that survives restarts.
+    An analysis is (reply_text, setup_data): the parsed signal is kept next to the reply, so every chat served
+    the reply can journal it. Concurrent requests for the same key are collapsed into a single in-flight model call.
+    """
+    def __init__(self, max_size, ttl, db_file=None, wait_timeout=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout # Seconds a collapsed request waits for the one computing its analysis
+        self._entries = OrderedDict() # key -> (created_at, reply_text, setup_data)
+        self._inflight = {}
+        self._inflight_async = {} # key -> asyncio.Future, only touched from the event loop
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'collapsed': 0, 'wait_timeouts': 0}
+        if db_file:
+            self._db = sqlite3.connect(db_file, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS analysis_cache (key TEXT PRIMARY KEY, created_at REAL NOT NULL, reply_text TEXT NOT NULL)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(analysis_cache)")]
+            if 'setup_data' not in columns:
+                self._db.execute("ALTER TABLE analysis_cache ADD COLUMN setup_data TEXT")
+            self._db.commit()
+
+    def get(self, key):
+        """Returns the cached (reply_text, setup_data) for key, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1], entry[2]
+            if self._db is not None:
+                row = self._db.execute("SELECT created_at, reply_text, setup_data FROM analysis_cache WHERE key = ?", (key,)).fetchone()
+                if row and now - row[0] < self.ttl:
+                    setup_data = json.loads(row[2]) if row[2] else None
+                    self._remember(key, row[0], row[1], setup_data)
+                    self.stats['disk_hits'] += 1
+                    return row[1], setup_data
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, reply_text, setup_data=None):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, reply_text, setup_data)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO analysis_cache (key, created_at, reply_text, setup_data) VALUES (?, ?, ?, ?)",
+                                 (key, now, reply_text, json.dumps(setup_data) if setup_data else None))
+                self._db.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl,))
+                self._db.commit()
+
+    def _remember(self, key, created_at, reply_text, setup_data):
+        self._entries[key] = (created_at, reply_text, setup_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached (reply_text, setup_data) for key, or calls compute() -> (reply_text, setup_data, cacheable)
+        once and shares its result (or exception) with every caller waiting on the same key.
+        """
+        analysis = self.get(key)
+        if analysis is not None:
+            return analysis
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._inflight[key] = {'done': threading.Event(), 'analysis': None, 'error': None}
+            else:
+                self.stats['collapsed'] += 1
+
+        if not is_leader:
+            if not flight['done'].wait(self.wait_timeout):
+                raise self._wait_timed_out()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['analysis']
+
+        try:
+            reply_text, setup_data, cacheable = compute()
+            flight['analysis'] = reply_text, setup_data
+            if cacheable:
+                self.put(key, reply_text, setup_data)
+            return reply_text, setup_data
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight['done'].set()
+
+    async def get_or_compute_async(self, key, compute):
+        """Like get_or_compute, for the asyncio runtime: compute is a coroutine function returning (reply_text, setup_data, cacheable)."""
+        analysis = self.get(key)
+        if analysis is not None:
+            return analysis
+
+        flight = self._inflight_async.get(key)
+        if flight is not None:
+            self.stats['collapsed'] += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(flight), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise self._wait_timed_out() from None
+
+        flight = self._inflight_async[key] = asyncio.get_running_loop().create_future()
+        try:
+            reply_text, setup_data, cacheable = await compute()
+            if cacheable:
+                self.put(key, reply_text, setup_data)
+            flight.set_result((reply_text, setup_data))
+            return reply_text, setup_data
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            del self._inflight_async[key]
+            if not flight.done(): # The leader was cancelled: its followers get an error instead of waiting forever
+                flight.set_exception(BackendUnavailableError('chart', ["the request computing this analysis was cancelled"]))
+            flight.exception() # Mark retrieved, in case nobody else was waiting
+
+    def _wait_timed_out(self):
+        with self._lock:
+            self.stats['wait_timeouts'] += 1
+        return BackendUnavailableError('chart', [f"the same analysis was still running after {self.wait_timeout:g}s"])
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+            stats['in_flight'] = len(self._inflight) + len(self._inflight_async)
+        stats['persistent'] = self._db is not None
+        return stats
+
+# A collapsed request waits as long as the leader can: a Gemini slot, then every chart backend timing out in turn
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_DB_FILE or None,
+                               BACKEND_QUEUE_TIMEOUT + sum(backend.timeout for backend in chart_router.backends))
+
+
+# ========== SETUP SIGNAL PARSING ==========
+SETUP_SIGNAL_REQUIRED_FIELDS = ('Pair', 'Entry', 'SL', 'TP', 'Reason')
+SETUP_SIGNAL_FIELDS = ('Pair', 'Position', 'Entry', 'TP', 'SL', 'RR', 'Reason')
+SETUP_SIGNAL_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {field: {'type': 'STRING'} for field in SETUP_SIGNAL_FIELDS},
+    'required': list(SETUP_SIGNAL_FIELDS),
+}
+
+def extract_first_json_object(text):
+    """
+    Returns the first JSON object embedded in text (inside code fences, prose or an array), or None.
+    Scans once, keeping a stack of open braces and the string state, and only calls json.loads
+    on balanced candidates. Stray braces in surrounding prose don't hide a later valid object.
+    """
+    open_braces = []
+    best = None
+    best_start = -1
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = bool(open_braces) # Quotes in surrounding prose don't start strings
+        elif ch == '{':
+            open_braces.append(i)
+        elif ch == '}' and open_braces:
+            start = open_braces.pop()
+            # An enclosing object supersedes one found inside it, a later sibling does not
+            if best is None or start < best_start:
+                try:
+                    candidate = json.loads(text[start:i + 1])
+                except json.JSONDecodeError:
+                    candidate = None
+                if isinstance(candidate, dict):
+                    best, best_start = candidate, start
+            if best is not None and not open_braces:
+                return best
+    return best
+
+def validate_setup_signal(data, strict=False):
+    """Returns a list of schema problems; in non-strict mode only a non-object or an empty object is a problem."""
+    if not isinstance(data, dict):
+        return ["not a JSON object"]
+    problems = []
+    for field in SETUP_SIGNAL_REQUIRED_FIELDS if strict else ():
+        if field not in data:
+            problems.append(f"missing {field}")
+    for field in SETUP_SIGNAL_FIELDS if strict else ():
+        if field in data and not isinstance(data[field], (str, int, float)):
+            problems.append(f"{field} is not a string or number")
+    if not strict and not any(field in data for field in SETUP_SIGNAL_FIELDS):
+        problems.append("no signal fields")
+    return problems
+
+def parse_setup_signal(raw_reply, strict=False):
+    """Parses a Swing/Scalp signal from a model reply. Returns (setup_data, None) or (None, problem)."""
+    try:
+        data = json.loads(raw_reply) # Structured output (and well-behaved replies) need nothing more
+        if isinstance(data, list):
+            data = data[0] if data else None
+    except json.JSONDecodeError:
+        data = extract_first_json_object(raw_reply)
+    if data is None:
+        return None, "no JSON object found"
+    problems = validate_setup_signal(data, strict)
+    if problems:
+        return None, ", ".join(problems)
+    return data, None
+
+
+# ========== SIGNAL JOURNAL ==========
+JOURNAL_DEFAULT_LIMIT = 10
+JOURNAL_MAX_LIMIT = 50
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signals (
+    id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, ts REAL NOT NULL, pair TEXT NOT NULL, sub_mode TEXT NOT NULL,
+    position TEXT, entry TEXT, tp TEXT, sl TEXT, rr TEXT, rr_value REAL, reason TEXT
+);
+CREATE INDEX IF NOT EXISTS signals_chat_ts ON signals (chat_id, ts);
+CREATE INDEX IF NOT EXISTS signals_chat_pair_ts ON signals (chat_id, pair, ts);
+CREATE INDEX IF NOT EXISTS signals_chat_mode_ts ON signals (chat_id, sub_mode, ts);
+CREATE TABLE IF NOT EXISTS learn_exchanges (
+    id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, ts REAL NOT NULL, lang TEXT NOT NULL, question TEXT NOT NULL, answer TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS learn_exchanges_chat_ts ON learn_exchanges (chat_id, ts);
+CREATE TABLE IF NOT EXISTS signal_totals (
+    chat_id TEXT NOT NULL, sub_mode TEXT NOT NULL, pair TEXT NOT NULL, signals INTEGER NOT NULL, longs INTEGER NOT NULL,
+    shorts INTEGER NOT NULL, rr_count INTEGER NOT NULL, rr_sum REAL NOT NULL, last_ts REAL NOT NULL,
+    PRIMARY KEY (chat_id, sub_mode, pair)
+);
+CREATE TABLE IF NOT EXISTS learn_totals (chat_id TEXT PRIMARY KEY, exchanges INTEGER NOT NULL, last_ts REAL NOT NULL);
+"""
+RR_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def normalize_pair(pair):
+    """'xau/usd', 'XAU-USD ' and 'XAUUSD' all file under XAUUSD."""
+    return re.sub(r"[^A-Z0-9]", "", str(pair or "").upper()) or "UNKNOWN"
+
+def parse_rr(rr):
+    """Reward per unit of risk from '1:2.5', '2.5', 'RR 1 : 3' and the like, or None."""
+    numbers = [float(n.replace(',', '.')) for n in RR_NUMBER_RE.findall(str(rr or ""))]
+    if len(numbers) >= 2 and numbers[0] > 0:
+        return numbers[1] / numbers[0]
+    return numbers[0] if numbers else None
+
+def position_side(position):
+    text = str(position or "").lower()
+    if any(word in text for word in ('buy', 'long', 'beli')):
+        return 'long'
+    if any(word in text for word in ('sell', 'short', 'jual')):
+        return 'short'
+    return None
+
+class SignalJournal:
+    """
+    Trading journal in sqlite: every generated signal and Learn exchange, indexed by chat, pair, sub-mode and time.
+    Handlers only queue entries; a background thread writes them in batches and, in the same transaction, updates
+    per chat/sub-mode/pair totals, so /stats reads a handful of rows instead of scanning the journal.
+    """
+    def __init__(self, path, flush_interval=JOURNAL_FLUSH_INTERVAL, max_batch=JOURNAL_MAX_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._db = None # Opened on first use, like the settings, so importing the bot stays cheap
+        self._db_lock = threading.Lock()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._full = threading.Event()
+        self._writer = None
+        self.stats = {'signals': 0, 'learn_exchanges': 0, 'flushes': 0, 'entries_written': 0, 'write_errors': 0}
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=5000")
+            db.executescript(JOURNAL_SCHEMA)
+            self._db = db
+        return self._db
+
+    def record_signal(self, chat_id, sub_mode, setup_data):
+        rr = setup_data.get('RR')
+        self._queue('signal', (
+            str(chat_id), time.time(), normalize_pair(setup_data.get('Pair')), sub_mode or '',
+            *(None if setup_data.get(field) is None else str(setup_data[field]) for field in ('Position', 'Entry', 'TP', 'SL', 'RR')),
+            parse_rr(rr), None if setup_data.get('Reason') is None else str(setup_data['Reason']),
+        ))
+
+    def record_learn(self, chat_id, lang, question, answer):
+        self._queue('learn', (str(chat_id), time.time(), lang, question, answer))
+
+    def _queue(self, kind, row):
+        with self._lock:
+            self._pending.append((kind, row))
+            self.stats['signals' if kind == 'signal' else 'learn_exchanges'] += 1
+            full = len(self._pending) >= self.max_batch
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="journal-writer", daemon=True)
+                self._writer.start()
+        self._wakeup.set()
+        if full:
+            self._full.set()
+
+    def _write_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._full.wait(self.flush_interval) # Let further entries pile up into the same write
+            self._wakeup.clear()
+            self._full.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes every queued entry and its totals in one transaction."""
+        with self._db_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            signals = [row for kind, row in batch if kind == 'signal']
+            exchanges = [row for kind, row in batch if kind == 'learn']
+            signal_totals = {}
+            for chat_id, ts, pair, sub_mode, position, *_, rr_value, _ in signals:
+                totals = signal_totals.setdefault((chat_id, sub_mode, pair), [0, 0, 0, 0, 0.0, ts])
+                side = position_side(position)
+                totals[0] += 1
+                totals[1] += side == 'long'
+                totals[2] += side == 'short'
+                if rr_value is not None:
+                    totals[3] += 1
+                    totals[4] += rr_value
+                totals[5] = max(totals[5], ts)
+            learn_totals = {}
+            for chat_id, ts, *_ in exchanges:
+                count, last_ts = learn_totals.get(chat_id, (0, ts))
+                learn_totals[chat_id] = (count + 1, max(last_ts, ts))
+            try:
+                db = self._connect()
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    db.executemany("INSERT INTO signals (chat_id, ts, pair, sub_mode, position, entry, tp, sl, rr, rr_value, reason) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", signals)
+                    db.executemany("INSERT INTO learn_exchanges (chat_id, ts, lang, question, answer) VALUES (?, ?, ?, ?, ?)", exchanges)
+                    db.executemany(
+                        "INSERT INTO signal_totals (chat_id, sub_mode, pair, signals, longs, shorts, rr_count, rr_sum, last_ts) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (chat_id, sub_mode, pair) DO UPDATE SET "
+                        "signals = signals + excluded.signals, longs = longs + excluded.longs, shorts = shorts + excluded.shorts, "
+                        "rr_count = rr_count + excluded.rr_count, rr_sum = rr_sum + excluded.rr_sum, last_ts = MAX(last_ts, excluded.last_ts)",
+                        [key + tuple(totals) for key, totals in signal_totals.items()])
+                    db.executemany(
+                        "INSERT INTO learn_totals (chat_id, exchanges, last_ts) VALUES (?, ?, ?) ON CONFLICT (chat_id) DO UPDATE SET "
+                        "exchanges = exchanges + excluded.exchanges, last_ts = MAX(last_ts, excluded.last_ts)",
+                        [(chat_id,) + totals for chat_id, totals in learn_totals.items()])
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+            except Exception as e:
+                with self._lock:
+                    self._pending[:0] = batch # Retry on the next flush
+                    self.stats['write_errors'] += 1
+                print(f"Warning: Failed to write {len(batch)} journal entries: {e}")
+                return
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['entries_written'] += len(batch)
+
+    def _query(self, sql, params):
+        self.flush() # A chat sees its own latest signal even if the writer hasn't run yet
+        with self._db_lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def recent_signals(self, chat_id, pair=None, sub_mode=None, limit=JOURNAL_DEFAULT_LIMIT):
+        """Newest signals of a chat, optionally for one pair and/or sub-mode (each served by an index)."""
+        where, params = ["chat_id = ?"], [str(chat_id)]
+        if pair:
+            where.append("pair = ?")
+            params.append(normalize_pair(pair))
+        if sub_mode:
+            where.append("sub_mode = ?")
+            params.append(sub_mode)
+        return self._query(
+            f"SELECT ts, pair, sub_mode, position, entry, tp, sl, rr FROM signals WHERE {' AND '.join(where)} ORDER BY ts DESC, id DESC LIMIT ?",
+            (*params, limit))
+
+    def recent_learn(self, chat_id, limit=JOURNAL_DEFAULT_LIMIT):
+        return self._query("SELECT ts, question FROM learn_exchanges WHERE chat_id = ? ORDER BY ts DESC, id DESC LIMIT ?", (str(chat_id), limit))
+
+    def mode_totals(self, chat_id):
+        """[(sub_mode, signals, longs, shorts, average RR or None)] from the running totals."""
+        return self._query(
+            "SELECT sub_mode, SUM(signals), SUM(longs), SUM(shorts), SUM(rr_sum) / NULLIF(SUM(rr_count), 0) "
+            "FROM signal_totals WHERE chat_id = ? GROUP BY sub_mode ORDER BY sub_mode", (str(chat_id),))
+
+    def pair_totals(self, chat_id, limit=5):
+        """[(pair, signals, average RR or None)] for the chat's most signalled pairs."""
+        return self._query(
+            "SELECT pair, SUM(signals) AS total, SUM(rr_sum) / NULLIF(SUM(rr_count), 0) "
+            "FROM signal_totals WHERE chat_id = ? GROUP BY pair ORDER BY total DESC, pair LIMIT ?", (str(chat_id), limit))
+
+    def learn_total(self, chat_id):
+        rows = self._query("SELECT exchanges FROM learn_totals WHERE chat_id = ?", (str(chat_id),))
+        return rows[0][0] if rows else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'pending': len(self._pending)}
+
+signal_journal = SignalJournal(JOURNAL_DB_FILE) if JOURNAL_DB_FILE else None
+if signal_journal:
+    atexit.register(signal_journal.flush)
+
+def journal_signal(chat_id, sub_mode, setup_data):
+    if signal_journal and chat_id is not None:
+        signal_journal.record_signal(chat_id, sub_mode, setup_data)
+
+def journal_learn(chat_id, lang, question, answer):
+    if signal_journal and answer:
+        signal_journal.record_learn(chat_id, lang, question, answer)
+
+def parse_journal_args(args):
+    """'/journal XAUUSD 20 swing' -> {'pair': 'XAUUSD', 'limit': 20, 'sub_mode': 'swing', 'learn': False}"""
+    query = {'pair': None, 'limit': JOURNAL_DEFAULT_LIMIT, 'sub_mode': None, 'learn': False}
+    for arg in args:
+        word = arg.lower()
+        if word.isdigit():
+            query['limit'] = max(1, min(JOURNAL_MAX_LIMIT, int(word)))
+        elif word in ('swing', 'scalp'):
+            query['sub_mode'] = word
+        elif word in ('learn', 'belajar'):
+            query['learn'] = True
+        else:
+            query['pair'] = normalize_pair(arg)
+    return query
+
+def format_journal_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(ts))
+
+def get_journal_disabled_text(lang):
+    return "The trading journal is turned off on this bot." if lang == 'en' else "Jurnal trading dinonaktifkan di bot ini."
+
+def get_journal_reply(chat_id, args, lang):
+    """Text for /journal [PAIR] [N] [swing|scalp|learn]: the chat's latest signals or Learn questions (HTML)."""
+    if not signal_journal:
+        return get_journal_disabled_text(lang)
+    en = lang == 'en'
+    query = parse_journal_args(args)
+    if query['learn']:
+        rows = signal_journal.recent_learn(chat_id, query['limit'])
+        if not rows:
+            return "No Learn questions in your journal yet." if en else "Belum ada pertanyaan Belajar di jurnal Anda."
+        lines = [f"📓 <b>{'Last' if en else 'Terakhir'} {len(rows)} {'Learn questions' if en else 'pertanyaan Belajar'}</b>"]
+        lines += [f"{format_journal_time(ts)} · {html.escape(question[:120])}" for ts, question in rows]
+        return "\n".join(lines)
+
+    rows = signal_journal.recent_signals(chat_id, query['pair'], query['sub_mode'], query['limit'])
+    scope = " ".join(filter(None, [query['pair'], query['sub_mode'] and query['sub_mode'].capitalize()]))
+    if not rows:
+        return (f"No signals{' for ' + scope if scope else ''} in your journal yet. Send a chart in Swing or Scalp mode to add one." if en
+                else f"Belum ada sinyal{' untuk ' + scope if scope else ''} di jurnal Anda. Kirim chart di mode Swing atau Scalp untuk menambahkannya.")
+    lines = [f"📓 <b>{'Last' if en else 'Terakhir'} {len(rows)} {'signals' if en else 'sinyal'}{' · ' + html.escape(scope) if scope else ''}</b>"]
+    for ts, pair, sub_mode, position, entry, tp, sl, rr in rows:
+        lines.append(
+            f"{format_journal_time(ts)} · <b>{html.escape(pair)}</b> · {sub_mode.capitalize()} · {html.escape(str(position or '-'))} "
+            f"@ <code>{html.escape(str(entry or '-'))}</code> TP <code>{html.escape(str(tp or '-'))}</code> "
+            f"SL <code>{html.escape(str(sl or '-'))}</code> RR <code>{html.escape(str(rr or '-'))}</code>"
+        )
+    return "\n".join(lines)
+
+def get_journal_stats_reply(chat_id, lang):
+    """Text for /stats: signals, sides and average RR per mode, top pairs and Learn questions (HTML)."""
+    if not signal_journal:
+        return get_journal_disabled_text(lang)
+    en = lang == 'en'
+    modes = signal_journal.mode_totals(chat_id)
+    learned = signal_journal.learn_total(chat_id)
+    if not modes and not learned:
+        return "Your journal is empty so far." if en else "Jurnal Anda masih kosong."
+    average = lambda rr: f"1:{rr:.2f}" if rr is not None else "-"
+    lines = [f"📊 <b>{'Your trading journal' if en else 'Jurnal trading Anda'}</b>"]
+    for sub_mode, signals, longs, shorts, rr in modes:
+        lines.append(f"{sub_mode.capitalize() or '-'}: {signals} {'signals' if en else 'sinyal'} "
+                     f"({longs} long / {shorts} short), {'avg RR' if en else 'rata-rata RR'} <code>{average(rr)}</code>")
+    pairs = signal_journal.pair_totals(chat_id)
+    if pairs:
+        lines.append(f"\n<b>{'Top pairs' if en else 'Pair teratas'}</b>")
+        lines += [f"{html.escape(pair)}: {signals} · RR <code>{average(rr)}</code>" for pair, signals, rr in pairs]
+    lines.append(f"\n{'Learn questions' if en else 'Pertanyaan Belajar'}: {learned}")
+    return "\n".join(lines)
+
+
+# ========== BACKGROUND CLEANUP ==========
+TEMP_FILE_PATTERN = "temp_*.jpg" # Written by analyze_chart_images for File API uploads
+UPLOAD_NAME_PREFIX = "chart_" # display_name of every chart uploaded to the Gemini File API
+
+def is_already_deleted(error):
+    """True if a deletion failed only because the file is gone, e.g. another worker's sweep deleted it first."""
+    return isinstance(error, FileNotFoundError) or type(error).__name__ == 'NotFound' or '404' in str(error)
+
+class CleanupWorker:
+    """
+    Deletes Gemini uploads and temp files on a background thread, so chart replies don't wait for the extra
+    round trips. Deletions queued while a pass runs, or within batch_window of each other, are handled in one
+    pass; failed ones are retried with exponential backoff. The same thread sweeps sweep_delay after start and
+    then every sweep_interval: chart_* uploads and temp_*.jpg files older than stale_age were left behind by a
+    request that died midway (or by deletions that ran out of attempts) and are queued for deletion.
+    Sweeps only run in the process holding the lock on lock_file, so several workers on one host don't list
+    the same uploads; when that process exits the lock is released and another worker takes over.
+    """
+    RESOURCES = ('upload', 'temp_file')
+
+    def __init__(self, batch_window=CLEANUP_BATCH_WINDOW, retry_delay=CLEANUP_RETRY_DELAY, max_attempts=CLEANUP_MAX_ATTEMPTS,
+                 sweep_delay=CLEANUP_SWEEP_DELAY, sweep_interval=CLEANUP_SWEEP_INTERVAL, stale_age=CLEANUP_STALE_AGE, temp_dir=".",
+                 lock_file=CLEANUP_SWEEP_LOCK_FILE):
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.max_attempts = max(1, max_attempts)
+        self.sweep_delay = sweep_delay
+        self.sweep_interval = sweep_interval
+        self.stale_age = stale_age
+        self.temp_dir = temp_dir
+        self.lock_file = lock_file
+        self._lease = None # Open lock_file while this process holds the sweep lock
+        self._pending = {} # (resource, target) -> [due (monotonic), attempts]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.stats = {resource: {'queued': 0, 'deleted': 0, 'already_gone': 0, 'retries': 0, 'failed': 0, 'leaked': 0}
+                      for resource in self.RESOURCES}
+        self.stats.update({'passes': 0, 'sweeps': 0, 'sweeps_skipped': 0, 'sweep_errors': 0})
+
+    def start(self):
+        """Starts the worker thread once; it also runs the sweeps unless sweep_interval is 0."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cleanup", daemon=True)
+                self._thread.start()
+
+    def delete_upload(self, name):
+        self._queue('upload', name)
+
+    def delete_temp_file(self, path):
+        self._queue('temp_file', path)
+
+    def _queue(self, resource, target):
+        with self._lock:
+            if (resource, target) in self._pending:
+                return
+            self._pending[(resource, target)] = [time.monotonic(), 0]
+            self.stats[resource]['queued'] += 1
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_delay if self.sweep_interval > 0 else None
+        while True:
+            with self._lock:
+                deadlines = [due for due, _ in self._pending.values()]
+            if next_sweep is not None:
+                deadlines.append(next_sweep)
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            if self._wakeup.wait(timeout):
+                self._wakeup.clear()
+                time.sleep(self.batch_window) # Let the deletions of concurrent requests join this pass
+            if next_sweep is not None and time.monotonic() >= next_sweep:
+                if self._hold_sweep_lease():
+                    self.sweep()
+                else:
+                    with self._lock:
+                        self.stats['sweeps_skipped'] += 1
+                next_sweep = time.monotonic() + self.sweep_interval
+            try:
+                self.process()
+            except Exception as e:
+                print(f"Warning: Cleanup pass failed: {e}")
+
+    def process(self, retry=True):
+        """Deletes every queued resource that is due; failures are rescheduled while retry is set and attempts remain."""
+        now = time.monotonic()
+        with self._lock:
+            batch = [key for key, (due, _) in self._pending.items() if due <= now]
+            self.stats['passes'] += bool(batch)
+        for resource, target in batch:
+            try:
+                if resource == 'upload':
+                    genai.delete_file(target)
+                else:
+                    os.remove(target)
+                outcome = 'deleted'
+            except Exception as e:
+                outcome = 'already_gone' if is_already_deleted(e) else 'error'
+                error = e
+            with self._lock:
+                entry = self._pending[(resource, target)]
+                entry[1] += 1
+                if outcome == 'error' and retry and entry[1] < self.max_attempts:
+                    entry[0] = time.monotonic() + self.retry_delay * 2 ** (entry[1] - 1)
+                    self.stats[resource]['retries'] += 1
+                    continue
+                del self._pending[(resource, target)]
+                outcome = 'failed' if outcome == 'error' else outcome
+                self.stats[resource][outcome] += 1
+            if outcome == 'failed':
+                print(f"Warning: Giving up deleting {resource} {target} after {entry[1]} attempts: {error}")
+            metrics.inc('tradebot_cleanup_total', "Deletions of Gemini uploads and temp files by outcome", resource=resource, outcome=outcome)
+        return len(batch)
+
+    def _hold_sweep_lease(self):
+        """Takes the sweep lock unless another process holds it. Returns True if this process holds it."""
+        if self._lease is not None:
+            return True
+        try:
+            lease = open(self.lock_file, 'a')
+        except OSError as e:
+            print(f"Warning: Failed to open the cleanup sweep lock {self.lock_file}: {e}")
+            return False
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lease.close() # Another worker sweeps
+            return False
+        self._lease = lease # Kept open for the life of the process, the OS releases it when we exit
+        return True
+
+    def sweep(self):
+        """Queues every temp file and chart upload older than stale_age. Returns how many were found."""
+        cutoff = time.time() - self.stale_age
+        leaked = []
+        for path in glob.glob(os.path.join(self.temp_dir, TEMP_FILE_PATTERN)):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    leaked.append(('temp_file', path))
+            except OSError:
+                pass # Deleted by its request in the meantime
+        try:
+            for uploaded_file in genai.list_files():
+                if (uploaded_file.display_name or '').startswith(UPLOAD_NAME_PREFIX) and uploaded_file.create_time.timestamp() < cutoff:
+                    leaked.append(('upload', uploaded_file.name))
+        except Exception as e:
+            with self._lock:
+                self.stats['sweep_errors'] += 1
+            print(f"Warning: Failed to list Gemini uploads for the cleanup sweep: {e}")
+        with self._lock:
+            self.stats['sweeps'] += 1
+            for resource, _ in leaked:
+                self.stats[resource]['leaked'] += 1
+        for resource, target in leaked:
+            metrics.inc('tradebot_orphans_total', "Leaked Gemini uploads and temp files found by the cleanup sweep", resource=resource)
+            self._queue(resource, target)
+        if leaked:
+            log_event('cleanup_sweep', uploads=sum(r == 'upload' for r, _ in leaked), temp_files=sum(r == 'temp_file' for r, _ in leaked))
+        return len(leaked)
+
+    def drain(self):
+        """One last pass over everything queued, without retries, for shutdown."""
+        with self._lock:
+            for entry in self._pending.values():
+                entry[0] = 0
+        self.process(retry=False)
+
+    def snapshot(self):
+        with self._lock:
+            return {**{key: dict(value) if isinstance(value, dict) else value for key, value in self.stats.items()},
+                    'pending': len(self._pending), 'sweep_lease': self._lease is not None}
+
+cleanup_worker = CleanupWorker()
+atexit.register(cleanup_worker.drain)
+
+# ========== IMAGE HANDLER ==========
+IMAGE_MIME_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+def select_photo_size(photo_sizes, target_side=IMAGE_TARGET_SIDE):
+    """Picks the smallest PhotoSize whose longest side still reaches target_side, or the largest one."""
+    by_area = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    if target_side > 0:
+        for size in by_area:
+            if max(size.width, size.height) >= target_side:
+                return size
+    return by_area[-1]
+
+def find_chart_bbox(img):
+    """Returns the box around everything that differs noticeably from the corner (background) colour."""
+    background = Image.new('RGB', img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, background)
+    return ImageChops.add(diff, diff, 2.0, -20).getbbox()
+
+def preprocess_chart_image(data, target_side=IMAGE_TARGET_SIDE, autocrop=IMAGE_AUTOCROP,
+                           image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """
+    Crops flat borders, downscales and re-encodes a chart image to cut vision payload and tokens.
+    Returns (image_bytes, mime_type); the original bytes are kept if Pillow is missing or nothing is gained.
+    """
+    if Image is None or image_format not in IMAGE_MIME_TYPES:
+        return data, 'image/jpeg'
+
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    if autocrop:
+        bbox = find_chart_bbox(img)
+        if bbox and bbox != (0, 0) + img.size:
+            img = img.crop(bbox)
+    if target_side > 0 and max(img.size) > target_side:
+        img.thumbnail((target_side, target_side), Image.LANCZOS)
+
+    out = io.BytesIO()
+    img.save(out, format=image_format, quality=quality)
+    if out.tell() >= len(data):
+        return data, 'image/jpeg'
+    return out.getvalue(), IMAGE_MIME_TYPES[image_format]
+
+class NotAChartError(Exception):
+    """Raised when none of the photos looks like a price chart, before any Gemini call is made."""
+    def __init__(self, score):
+        super().__init__(f"Photo does not look like a price chart (score {score:.2f})")
+        self.score = score
+
+def get_not_a_chart_text(lang):
+    return "🤔 This doesn't look like a price chart. Please send a screenshot of a candlestick or line chart." if lang == 'en' else "🤔 Gambar ini sepertinya bukan chart harga. Silakan kirim screenshot chart candlestick atau line."
+
+
+def chart_features(data, side=CHART_FILTER_SIDE):
+    """
+    Cheap layout and colour statistics of an image, computed on a thumbnail of at most side pixels:
+    background share, palette size, candle-coloured share, grid lines, the share of columns crossed by only a
+    few traces (a candle or price line, overlays, volume bars, an indicator pane) and the aspect ratio.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', (side, side)) # JPEG decodes straight to a fraction of the size
+    img = img.convert('RGB')
+    width, height = img.size
+    img.thumbnail((side, side), Image.NEAREST) # No blending, so candle and grid colours stay pure
+    pixels = np.asarray(img, dtype=np.int16)
+    total = pixels.shape[0] * pixels.shape[1]
+
+    # Colour histogram at 4 bits per channel: charts are a flat background and a handful of colours
+    codes = ((pixels[..., 0] >> 4) << 8) | ((pixels[..., 1] >> 4) << 4) | (pixels[..., 2] >> 4)
+    counts = np.bincount(codes.ravel(), minlength=4096)
+    ordered = np.sort(counts)[::-1]
+    background = int(counts.argmax())
+    palette = int(np.searchsorted(np.cumsum(ordered), 0.9 * total)) + 1
+
+    background_rgb = np.array([(background >> 8) * 16 + 8, ((background >> 4) & 15) * 16 + 8, (background & 15) * 16 + 8])
+    foreground = np.abs(pixels - background_rgb).sum(axis=2) > 60
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    saturated = pixels.max(axis=2) - pixels.min(axis=2) > 50
+    candle = saturated & ((g > r + 40) | ((r > g + 50) & (r > b + 20)))
+
+    # Rows and columns that are mostly foreground are grid lines, axes, toolbars or text boxes; what's left of
+    # a chart is a few traces per column (price, moving averages, volume, an indicator pane), where text,
+    # tables and photos cross a column many times
+    line_rows = foreground.mean(axis=1) >= 0.5
+    line_cols = foreground.mean(axis=0) >= 0.5
+    marks = foreground & ~line_rows[:, None] & ~line_cols[None, :]
+    runs = (marks[1:] & ~marks[:-1]).sum(axis=0) + marks[0]
+    marked = runs > 0
+    edges = (marks[1:] != marks[:-1]).mean(axis=1) # Long horizontal edges: bubbles, buttons, text lines
+    return {
+        'background': ordered[0] / total,
+        'palette': palette,
+        'candle': (candle & foreground).sum() / max(1, foreground.sum()),
+        'line_rows': line_rows.mean(),
+        'grid_lines': bool(line_rows.any() or line_cols.any()),
+        'marked_columns': marked.mean(),
+        'few_traces': (runs[marked] <= 6).mean() if marked.any() else 0.0,
+        'block_edges': (edges >= 0.25).mean(),
+        'aspect': width / height,
+    }
+
+def chart_likelihood(data, side=CHART_FILTER_SIDE):
+    """Scores from 0 to 1 how much an image looks like a price chart, or None if it can't be scored locally."""
+    if Image is None or np is None:
+        return None
+    try:
+        features = chart_features(data, side)
+    except Exception as e: # Let Gemini judge anything Pillow can't read
+        print(f"Warning: Chart pre-filter could not read the image: {e}")
+        return None
+    clip = lambda value: min(1.0, max(0.0, value))
+    trace = (
+        clip((features['few_traces'] - 0.5) / 0.3) # Most marked columns hold a few candles or lines
+        * clip(features['marked_columns'] / 0.3) # ...across a good part of the width
+        * clip((0.6 - features['line_rows']) / 0.25) # ...and the picture isn't mostly solid bands
+        * clip((0.035 - features['block_edges']) / 0.02) # ...or boxes and lines of text (chat bubbles, documents)
+    )
+    bonus = (
+        clip((features['background'] - 0.3) / 0.3) * (features['background'] < 0.995) # Flat, but not blank
+        + clip((48 - features['palette']) / 40)
+        + clip(features['candle'] / 0.3)
+        + features['grid_lines']
+    ) / 4
+    score = trace * (0.6 + 0.4 * bonus)
+    if not 0.25 <= features['aspect'] <= 4: # Banners and long scrolling screenshots
+        score /= 2
+    return float(score)
+
+chart_filter_stats = {'photos': 0, 'charts': 0, 'rejected': 0}
+chart_filter_lock = threading.Lock() # Photos are scored on ingest threads and, in the async runtime, in to_thread
+
+def chart_filter_snapshot():
+    with chart_filter_lock:
+        return dict(chart_filter_stats)
+
+def filter_chart_photos(file_ids, downloads, map_all=map):
+    """
+    Scores downloaded photos with chart_likelihood and keeps the ones that may be charts.
+    Returns (file_ids, downloads); raises NotAChartError when nothing is left, so no Gemini call is spent.
+    """
+    scores = list(map_all(chart_likelihood, downloads))
+    kept = [i for i, score in enumerate(scores) if score is None or score >= CHART_FILTER_THRESHOLD]
+    with chart_filter_lock:
+        chart_filter_stats['photos'] += len(scores)
+        chart_filter_stats['charts'] += len(kept)
+        chart_filter_stats['rejected'] += len(scores) - len(kept)
+    for score in scores:
+        outcome = 'unscored' if score is None else 'chart' if score >= CHART_FILTER_THRESHOLD else 'rejected'
+        metrics.inc('tradebot_chart_filter_total', "Photos scored by the local chart pre-filter", outcome=outcome)
+    if len(kept) < len(scores):
+        log_event('chart_filter', rejected=len(scores) - len(kept), scores=[score if score is None else round(score, 2) for score in scores])
+    if not kept:
+        raise NotAChartError(max(scores))
+    return [file_ids[i] for i in kept], [downloads[i] for i in kept]
+
+# By name, so building this doesn't import the Gemini SDK; the SDK maps the names to its enums
+CHART_SAFETY_SETTINGS = {
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE',
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE'
+}
+
+def get_photo_mode_error(lang, current_mode, current_sub_mode):
+    """Returns the reply for a photo sent outside an image analysis mode, or None if the mode is fine."""
+    # If mode is 'setup', current_sub_mode *must* be 'swing' or 'scalp'
+    if current_mode == 'setup' and current_sub_mode not in ['swing', 'scalp']:
+        return "Please choose a trading style first (Swing or Scalp) using the menu or commands like /swing or /scalp." if lang == 'en' else "Mohon pilih gaya trading terlebih dahulu (Swing atau Scalp) menggunakan menu atau perintah seperti /swing atau /scalp."
+    elif current_mode not in ['setup', 'general_analyze']: # For other invalid modes
+        return "Please select an analysis mode first (Swing, Scalp, or General Analysis) using /menu or commands." if lang == 'en' else "Mohon pilih mode analisis terlebih dahulu (Swing, Scalp, atau Analisis Umum) menggunakan /menu atau perintah."
+    return None
+
+def get_processing_text(lang):
+    return "⏳ Processing image... This may take a moment." if lang == 'en' else "⏳ Memproses gambar... Ini mungkin memakan waktu sebentar."
+
+def get_chart_instruction(lang, current_mode, current_sub_mode):
+    """Determines the appropriate instruction text based on current_mode and sub_mode."""
+    if current_mode == 'setup':
+        if current_sub_mode == 'swing':
+            return SETUP_SWING_INSTRUCTION_EN if lang == 'en' else SETUP_SWING_INSTRUCTION_ID
+        elif current_sub_mode == 'scalp':
+            return SETUP_SCALP_INSTRUCTION_EN if lang == 'en' else SETUP_SCALP_INSTRUCTION_ID
+    elif current_mode == 'general_analyze':
+        return ANALYZE_INSTRUCTION_EN if lang == 'en' else ANALYZE_INSTRUCTION_ID
+    return ""
+
+def get_album_instruction(lang, current_mode, current_sub_mode, count):
+    """The chart instruction for several charts analyzed together, prefixed with the multi-timeframe brief."""
+    prefix = MULTI_TIMEFRAME_PREFIX_EN if lang == 'en' else MULTI_TIMEFRAME_PREFIX_ID
+    return prefix.format(count=count) + get_chart_instruction(lang, current_mode, current_sub_mode)
+
+def get_chart_generation_config(current_mode):
+    """Configures generation settings to constrain output."""
+    return genai.types.GenerationConfig(
+        temperature=0.7,
+        max_output_tokens=300, # Reduced to encourage concise, single-signal output
+        # Let Gemini emit schema-conforming JSON for setups, so parsing is a plain json.loads
+        **({'response_mime_type': 'application/json', 'response_schema': SETUP_SIGNAL_RESPONSE_SCHEMA}
+           if current_mode == 'setup' and GEMINI_JSON_OUTPUT else {})
+    )
+
+def format_chart_reply(gemini_response, lang, current_mode, current_sub_mode):
+    """
+    Turns a Gemini response into the reply shown to the user.
+    Returns (reply_text, setup_data, cacheable): setup_data is the parsed signal in setup mode, else None,
+    and replies that only report a parsing problem are not cacheable.
+    """
+    raw_reply = ""
+    if not gemini_response.candidates:
+        block_reason_feedback = "UNKNOWN_REASON"
+        if gemini_response.prompt_feedback and gemini_response.prompt_feedback.block_reason:
+            block_reason_feedback = gemini_response.prompt_feedback.block_reason.name
+        
+        if block_reason_feedback == "SAFETY":
+            raise genai.types.BlockedPromptException(
+                "Prompt blocked due to content policy. This often occurs if the chart or request implies risky financial behavior. Please try a different chart or a more general/educational request." if lang == 'en' else
+                "Permintaan diblokir karena kebijakan konten. Ini sering terjadi jika chart atau permintaan menyiratkan perilaku keuangan berisiko. Silakan coba chart yang berbeda atau permintaan yang lebih umum/edukatif."
+            )
+        else:
+            raise ValueError(
+                f"Gemini API did not return any candidates and was blocked for reason: {block_reason_feedback}." if lang == 'en' else
+                f"API Gemini tidak mengembalikan hasil dan diblokir karena alasan: {block_reason_feedback}."
+            )
+    else:
+        raw_reply = gemini_response.text
+
+    reply_text = ""
+    setup_data = None
+    if current_mode == 'setup':
+        setup_data, problem = parse_setup_signal(raw_reply, strict=SETUP_STRICT_SCHEMA)
+        if setup_data is None:
+            reply_text = (f"❌ Error: Could not parse setup data ({problem}). "
+                          f"Raw AI response:\n`{raw_reply}`") if lang == 'en' \
+                         else (f"❌ Error: Tidak dapat mengurai data setup ({problem}). "
+                               f"Respon AI mentah:\n`{raw_reply}`")
+
+        if setup_data:
+            # Bold the section title for better readability
+            if lang == 'en':
+                reply_text = (
+                    f"📊 **Trade Setup ({current_sub_mode.capitalize()}):**\n"
+                    f"➡️ **Pair:** `{setup_data.get('Pair', 'N/A')}`\n"
+                    f"➡️ **Position:** `{setup_data.get('Position', 'N/A')}`\n"
+                    f"➡️ **Entry:** `{setup_data.get('Entry', 'N/A')}`\n"
+                    f"➡️ **TP:** `{setup_data.get('TP', 'N/A')}`\n"
+                    f"➡️ **SL:** `{setup_data.get('SL', 'N/A')}`\n"
+                    f"➡️ **RR:** `{setup_data.get('RR', 'N/A')}`\n"
+                    f"➡️ **Reason:** {setup_data.get('Reason', 'N/A')}\n\n"
+                    f"_Important: This analysis is for educational purposes only and not financial advice._"
+                )
+            else: # id
+                reply_text = (
+                    f"📊 **Setup Trading ({current_sub_mode.capitalize()}):**\n"
+                    f"➡️ **Pair:** `{setup_data.get('Pair', 'N/A')}`\n"
+                    f"➡️ **Position:** `{setup_data.get('Position', 'N/A')}`\n"
+                    f"➡️ **Entry:** `{setup_data.get('Entry', 'N/A')}`\n"
+                    f"➡️ **TP:** `{setup_data.get('TP', 'N/A')}`\n"
+                    f"➡️ **SL:** `{setup_data.get('SL', 'N/A')}`\n"
+                    f"➡️ **RR:** `{setup_data.get('RR', 'N/A')}`\n"
+                    f"➡️ **Alasan:** {setup_data.get('Reason', 'N/A')}\n\n"
+                    f"_Penting: Analisis ini murni bersifat edukatif dan bukan nasihat keuangan._"
+                )
+    else: # general_analyze
+        reply_text = raw_reply + (
+            "\n\n_Important: This analysis is for educational purposes only and not financial advice._" if lang == 'en' else "\n\n_Penting: Analisis ini murni bersifat edukatif dan bukan nasihat keuangan._"
+        )
+
+    cacheable = current_mode != 'setup' or setup_data is not None
+    return reply_text, setup_data, cacheable
+
+def get_chart_error_text(e, lang):
+    """Returns the user-facing text for an exception raised while analyzing a chart."""
+    if isinstance(e, NotAChartError):
+        return get_not_a_chart_text(lang)
+    if isinstance(e, RateLimitedError):
+        return get_slow_down_text(lang)
+    if isinstance(e, BackendUnavailableError):
+        print(f"Warning: {e}")
+        return get_backend_unavailable_text(lang)
+
+    # Specific error handling for Gemini API content blocking
+    if genai.loaded and isinstance(e, genai.types.BlockedPromptException):
+        block_reason = "Unknown"
+        response = getattr(e, 'response', None)
+        if response and response.prompt_feedback and response.prompt_feedback.block_reason:
+            block_reason = response.prompt_feedback.block_reason.name
+
+        detailed_msg_en = f"The input (chart or caption) was blocked due to '{block_reason}' content policy. This often occurs if the chart or request implies risky financial behavior. Please try a different chart or a more general/educational request."
+        detailed_msg_id = f"Input (chart atau caption) diblokir karena kebijakan konten '{block_reason}'. Silakan coba chart yang berbeda atau modifikasi permintaan Anda agar tidak terlalu eksplisit tentang potensi risiko keuangan."
+
+        final_error_msg = detailed_msg_en if lang == 'en' else detailed_msg_id
+        return f"❌ Analysis blocked by AI:\n{final_error_msg}"
+
+    if genai.loaded and isinstance(e, genai.types.StopCandidateException):
+        block_reason_category = "UNKNOWN"
+        response = getattr(e, 'response', None)
+        if response and response.safety_ratings:
+            for rating in response.safety_ratings:
+                if rating.blocked:
+                    block_reason_category = rating.category.name.replace("HARM_CATEGORY_", "")
+                    break
+
+        detailed_msg_en = f"The AI's response was blocked due to '{block_reason_category}' content policy. This can happen if the generated signal/analysis is interpreted as promoting high-risk behavior. Please try again with a different chart."
+        detailed_msg_id = f"Respons AI diblokir karena kebijakan konten '{block_reason_category}'. Ini bisa terjadi jika sinyal/analisis yang dihasilkan diinterpretasikan sebagai mendorong perilaku berisiko tinggi. Silakan coba lagi dengan chart yang berbeda."
+
+        final_error_msg = detailed_msg_en if lang == 'en' else detailed_msg_id
+        return f"❌ AI response blocked:\n{final_error_msg}"
+
+    return f"❌ An unexpected error occurred during image analysis:\n{str(e)}" if lang == 'en' else f"❌ Terjadi error tak terduga saat analisis gambar:\n{str(e)}"
+
+def analyze_chart_images(file_ids, lang, current_mode, current_sub_mode, chat_id=None):
+    """
+    Downloads one or more chart photos, runs them through Gemini in a single request and formats the reply.
+    The photos of an album are downloaded and preprocessed in parallel and analyzed as one multi-timeframe view.
+    Returns (reply_text, setup_data, cacheable), see format_chart_reply.
+    """
+    temp_file_paths = []
+    uploaded_files = []
+    timings = {}
+    sizes = {}
+    album = len(file_ids) > 1
+    path = 'album_inline' if album else 'inline'
+    pool = ThreadPoolExecutor(max_workers=len(file_ids), thread_name_prefix="album") if album else None
+    map_all = pool.map if pool else map
+
+    try:
+        with span('download', timings):
+            downloads = list(map_all(lambda file_id: bot.download_file(bot.get_file(file_id).file_path), file_ids))
+        sizes = {'bytes_downloaded': sum(len(data) for data in downloads)}
+
+        if CHART_FILTER_THRESHOLD > 0:
+            with span('chart_filter', timings):
+                file_ids, downloads = filter_chart_photos(file_ids, downloads, map_all)
+            album = len(file_ids) > 1
+            path = 'album_inline' if album else 'inline'
+
+        with span('preprocess', timings):
+            images = list(map_all(preprocess_chart_image, downloads))
+        sizes['bytes_sent'] = sum(len(image_bytes) for image_bytes, _ in images)
+
+        # Images travel inside the generate_content request itself while they fit, no File API round trips
+        image_parts = []
+        inline_bytes = 0
+        for file_id, (image_bytes, mime_type) in zip(file_ids, images):
+            if inline_bytes + len(image_bytes) <= INLINE_IMAGE_MAX_BYTES:
+                inline_bytes += len(image_bytes)
+                image_parts.append({'mime_type': mime_type, 'data': image_bytes})
+            else:
+                image_parts.append((file_id, image_bytes, mime_type))
+
+        if any(isinstance(part, tuple) for part in image_parts):
+            path = 'album_file_api' if album else 'file_api'
+            with span('upload', timings):
+                for i, part in enumerate(image_parts):
+                    if not isinstance(part, tuple):
+                        continue
+                    file_id, image_bytes, mime_type = part
+                    temp_file_path = f"temp_{file_id}.jpg"
+                    temp_file_paths.append(temp_file_path)
+                    with open(temp_file_path, 'wb') as f:
+                        f.write(image_bytes)
+                    image_parts[i] = genai.upload_file(path=temp_file_path, mime_type=mime_type, display_name=f"chart_{file_id}")
+                    uploaded_files.append(image_parts[i])
+
+            with span('activate', timings):
+                polls = 0
+                for i, part in enumerate(image_parts):
+                    if isinstance(part, dict):
+                        continue
+                    while part.state.name == "PROCESSING":
+                        polls += 1
+                        time.sleep(1)
+                        part = image_parts[i] = genai.get_file(part.name)
+                    if part.state.name == "FAILED":
+                        raise ValueError("File processing failed on Gemini side. Please try again.")
+            sizes['activate_polls'] = polls
+
+        if album:
+            contents = [get_album_instruction(lang, current_mode, current_sub_mode, len(image_parts))]
+            for i, part in enumerate(image_parts, 1):
+                contents += [f"Chart {i}:", part]
+        else:
+            contents = [
+                get_chart_instruction(lang, current_mode, current_sub_mode),
+                image_parts[0]
+            ]
+
+        def generate(backend):
+            response = backend.client.generate_content(
+                contents=contents,
+                safety_settings=CHART_SAFETY_SETTINGS,
+                generation_config=get_chart_generation_config(current_mode),
+                request_options={'timeout': backend.timeout}
+            )
+            record_gemini_usage(backend.name, response)
+            return response
+
+        wait_start = time.monotonic()
+        with backend_limiters['gemini'].slot(chat_id):
+            observe_stage('backend_wait', time.monotonic() - wait_start)
+            with span('generate', timings), usage_ledger.request(chat_id, 'chart'):
+                gemini_response = chart_router.call(generate)
+
+        with span('parse', timings):
+            return format_chart_reply(gemini_response, lang, current_mode, current_sub_mode)
+    finally:
+        image_pipeline_stats.record(path, timings, sizes)
+        if pool:
+            pool.shutdown(wait=False)
+        # Temp files and Gemini uploads are deleted in the background, the reply doesn't wait for it
+        for temp_file_path in temp_file_paths:
+            cleanup_worker.delete_temp_file(temp_file_path)
+        for uploaded_file in uploaded_files:
+            cleanup_worker.delete_upload(uploaded_file.name)
+
+class MediaGroupCollector:
+    """
+    Collects the photos of an album, which Telegram delivers as one update per photo sharing a media_group_id,
+    and hands them to on_complete together once no photo arrived for `window` seconds (at most `max_wait` after
+    the first). call_later(delay, fn, *args) schedules the hand-over and returns something with cancel();
+    dispatch(chat_id, fn) runs the album, by default on the ingest worker of its chat, in order with the
+    chat's other updates. With a shared ingest queue the photo updates stay unacknowledged until their album
+    ran, and the worker keeps the chat's shard meanwhile, so the album is neither split between processes
+    nor lost when the process dies.
+    """
+    def __init__(self, window, max_wait, on_complete, call_later=None, dispatch=None):
+        self.window = window
+        self.max_wait = max_wait
+        self.on_complete = on_complete
+        self._call_later = call_later or self._start_timer
+        self._dispatch = dispatch or (lambda chat_id, fn: fn())
+        self._groups = {} # (chat_id, media_group_id) -> {'messages': [...], 'acks': [...], 'started': t, 'timer': handle}
+        self._lock = threading.Lock()
+        self.stats = {'albums': 0, 'photos': 0}
+
+    @staticmethod
+    def _start_timer(delay, fn, *args):
+        timer = threading.Timer(delay, fn, args=args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def add(self, message):
+        key = (message.chat.id, message.media_group_id)
+        ack = defer_update_ack() # Acknowledged once the album ran, see SharedUpdateDispatcher
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = {'messages': [], 'acks': [], 'started': time.monotonic(), 'timer': None}
+            group['messages'].append(message)
+            if ack is not None:
+                group['acks'].append(ack)
+            self.stats['photos'] += 1
+            if group['timer'] is not None:
+                group['timer'].cancel()
+            delay = min(self.window, max(0.0, group['started'] + self.max_wait - time.monotonic()))
+            group['timer'] = self._call_later(delay, self._complete, key)
+
+    def _complete(self, key):
+        with self._lock:
+            group = self._groups.pop(key, None) # None if a timer we cancelled was already running
+            if group is None:
+                return
+            self.stats['albums'] += 1
+
+        def run():
+            try:
+                self.on_complete(sorted(group['messages'], key=lambda m: m.message_id))
+            except Exception as e:
+                print(f"Warning: Failed to handle album {key[1]} in chat {key[0]}: {e}")
+            finally:
+                for ack in group['acks']:
+                    ack()
+        self._dispatch(key[0], run)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'open': len(self._groups), 'model_calls_saved': self.stats['photos'] - self.stats['albums']}
+
+@bot.message_handler(content_types=["photo"])
+def handle_photo(message):
+    if message.media_group_id and MEDIA_GROUP_WINDOW > 0:
+        media_group_collector.add(message) # Analyzed together with the rest of its album by handle_album
+        return
+    with trace_context(handler='photo', chat_id=message.chat.id, message_id=message.message_id):
+        _handle_photo([message])
+
+def handle_album(messages):
+    """Analyzes the photos of one album together: one rate-limit token, one Gemini call and one reply."""
+    first = messages[0]
+    with trace_context(handler='photo', chat_id=first.chat.id, message_id=first.message_id, photos=len(messages)):
+        _handle_photo(messages)
+
+media_group_collector = MediaGroupCollector(MEDIA_GROUP_WINDOW, MEDIA_GROUP_MAX_WAIT, handle_album,
+                                             dispatch=lambda chat_id, fn: dispatcher.run_for_chat(chat_id, fn))
+
+def _handle_photo(messages):
+    message = messages[0]
+    chat_id = str(message.chat.id)
+    user_settings = user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
+    lang = user_settings['lang']
+    current_mode = user_settings['mode']
+    current_sub_mode = user_settings['sub_mode'] # Get sub-mode
+
+    # Check if in a valid analysis mode for images
+    mode_error = get_photo_mode_error(lang, current_mode, current_sub_mode)
+    if mode_error:
+        bot.reply_to(message, mode_error)
+        return
+
+    quota_error = get_quota_error(chat_id, lang)
+    if quota_error:
+        bot.reply_to(message, quota_error)
+        return
+
+    with span('rate_limit'):
+        allowed = chat_rate_limiter.acquire(chat_id)
+    if not allowed:
+        bot.reply_to(message, get_slow_down_text(lang))
+        return
+
+    # Indicate that the bot is processing the image
+    with span('placeholder'):
+        processing_message = bot.reply_to(message, get_processing_text(lang))
+
+    try:
+        photos = [select_photo_size(m.photo) for m in messages[:MEDIA_GROUP_MAX_PHOTOS]]
+        # file_unique_id is stable across forwards of the same picture, so it addresses the analysis without downloading
+        cache_key = f"{','.join(photo.file_unique_id for photo in photos)}:{current_mode}:{current_sub_mode}:{lang}"
+        with span('analysis'):
+            reply_text, setup_data = analysis_cache.get_or_compute(
+                cache_key, lambda: analyze_chart_images([photo.file_id for photo in photos], lang, current_mode, current_sub_mode, chat_id)
+            )
+    except Exception as e:
+        if isinstance(e, NotAChartError):
+            chat_rate_limiter.refund(chat_id) # No model call was made
+        reply_text, setup_data = get_chart_error_text(e, lang), None
+    if setup_data:
+        # Every chat that gets the signal journals it, including cache hits and collapsed requests
+        journal_signal(chat_id, current_sub_mode, setup_data)
+    with span('reply'):
+        bot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=reply_text)
+
+
+# ========== OHLC DOCUMENTS ==========
+OHLC_EXTENSIONS = ('.csv', '.json')
+OHLC_MIME_TYPES = ('text/csv', 'application/json', 'text/comma-separated-values')
+OHLC_TEXT_EXTENSIONS = ('.txt',) # Plain text files are only read as candles when the caption asks for it
+OHLC_ALIASES = {
+    'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume', 'vol': 'volume', 'tickvol': 'volume',
+    'tick_volume': 'volume', 'date': 'time', 'datetime': 'time', 'timestamp': 'time', 'open_time': 'time', 't': 'time',
+}
+OHLC_MIN_CANDLES = 30
+FIB_RATIOS = (0.236, 0.382, 0.5, 0.618, 0.786)
+
+class OhlcFormatError(ValueError):
+    """The document isn't OHLC data we can read."""
+
+def is_ohlc_document(document, caption=None):
+    """CSV and JSON files, and .txt/text/plain files whose caption mentions OHLC (e.g. '/ohlc'); other text files are left alone."""
+    name = (document.file_name or "").lower()
+    if name.endswith(OHLC_EXTENSIONS) or (document.mime_type or "") in OHLC_MIME_TYPES:
+        return True
+    is_text = name.endswith(OHLC_TEXT_EXTENSIONS) or document.mime_type == 'text/plain'
+    return is_text and 'ohlc' in (caption or "").lower()
+
+def _ohlc_columns(names):
+    """Maps header names (CSV header or JSON keys) to their positions, or returns None if open/high/low/close are missing."""
+    names = [str(name).strip().strip('"').lower() for name in names]
+    names = [OHLC_ALIASES.get(name, name) for name in names]
+    if not all(column in names for column in ('open', 'high', 'low', 'close')):
+        return None
+    return {column: names.index(column) for column in ('time', 'open', 'high', 'low', 'close', 'volume') if column in names}
+
+def _headerless_columns(fields):
+    """
+    Guesses the layout of a row without a header: leading non-numeric fields are the time (MT4/MT5 exports put date and
+    time in two columns), a leading epoch timestamp is too (Binance klines), then open, high, low, close and volume.
+    """
+    def numeric(value):
+        try:
+            float(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+    start = 0
+    while start < len(fields) and not numeric(fields[start]):
+        start += 1
+    if start == 0 and len(fields) >= 6 and float(fields[0]) > 1e9:
+        start = 1 # Epoch seconds or milliseconds
+    if len(fields) - start < 4 or not all(numeric(value) for value in fields[start:start + 4]):
+        return None
+    columns = {'open': start, 'high': start + 1, 'low': start + 2, 'close': start + 3}
+    if len(fields) - start > 4 and numeric(fields[start + 4]):
+        columns['volume'] = start + 4
+    if start:
+        columns['time'] = slice(0, start)
+    return columns
+
+def _time_label(fields, columns):
+    where = columns.get('time')
+    if where is None:
+        return None
+    value = " ".join(str(field) for field in fields[where]) if isinstance(where, slice) else str(fields[where])
+    value = value.strip().strip('"')
+    try:
+        stamp = float(value)
+    except ValueError:
+        return value
+    if stamp > 1e11: # Milliseconds
+        stamp /= 1000
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(stamp))
+
+def _candle_arrays(rows, columns):
+    """Turns a 2-D float array laid out as columns describes into named 1-D arrays."""
+    order = [column for column in ('open', 'high', 'low', 'close', 'volume') if column in columns]
+    return {column: rows[:, i] for i, column in enumerate(order)}
+
+def read_ohlc_csv(lines, window=OHLC_WINDOW, chunk_rows=OHLC_CHUNK_ROWS):
+    """
+    Parses CSV candles OHLC_CHUNK_ROWS at a time and keeps only the last `window` rows, so memory stays flat however long
+    the file is. Returns (candles, total rows, time label of the last row).
+    """
+    lines = (line for line in lines if line.strip())
+    first = next(lines, None)
+    if first is None:
+        raise OhlcFormatError("the file is empty")
+    delimiter = max((',', ';', '\t'), key=first.count)
+    header = first.rstrip('\r\n').split(delimiter)
+    columns = _ohlc_columns(header)
+    pending = []
+    if columns is None:
+        columns = _headerless_columns(header)
+        if columns is None:
+            raise OhlcFormatError("no open/high/low/close columns found")
+        pending.append(first)
+    usecols = [columns[column] for column in ('open', 'high', 'low', 'close', 'volume') if column in columns]
+
+    kept = np.empty((0, len(usecols)))
+    total = 0
+    last_line = first
+    def parse(chunk):
+        try:
+            return np.loadtxt(chunk, delimiter=delimiter, usecols=usecols, ndmin=2, quotechar='"')
+        except ValueError as e:
+            raise OhlcFormatError(f"unreadable row in lines {total + 1}-{total + len(chunk)}: {e}") from None
+    for line in lines:
+        pending.append(line)
+        if len(pending) >= chunk_rows:
+            kept = np.concatenate([kept, parse(pending)])[-window:]
+            total += len(pending)
+            last_line = pending[-1]
+            pending = []
+    if pending:
+        kept = np.concatenate([kept, parse(pending)])[-window:]
+        total += len(pending)
+        last_line = pending[-1]
+    return _candle_arrays(kept, columns), total, _time_label(last_line.rstrip('\r\n').split(delimiter), columns)
+
+def read_ohlc_json(data, window=OHLC_WINDOW):
+    """
+    Reads candles from JSON: a list of objects, an object of arrays, or a list of rows such as Binance klines,
+    optionally wrapped in {"data": ...} or {"candles": ...}. Returns (candles, total rows, time label of the last row).
+    """
+    try:
+        payload = json.loads(data)
+    except ValueError as e:
+        raise OhlcFormatError(f"invalid JSON: {e}") from None
+    if isinstance(payload, dict) and not _ohlc_columns(payload.keys()):
+        payload = next((payload[key] for key in ('data', 'candles', 'result', 'values') if key in payload), payload)
+    try:
+        if isinstance(payload, dict): # Object of arrays
+            keys = list(payload.keys())
+            columns = _ohlc_columns(keys)
+            if columns is None:
+                raise OhlcFormatError("no open/high/low/close keys found")
+            total = len(payload[keys[columns['close']]])
+            rows = [[payload[keys[columns[column]]][i] for column in ('open', 'high', 'low', 'close', 'volume') if column in columns]
+                    for i in range(max(0, total - window), total)]
+            label = _time_label([payload[key][-1] if isinstance(payload[key], list) and payload[key] else None for key in keys], columns)
+        elif isinstance(payload, list) and payload and isinstance(payload[0], dict): # List of objects
+            keys = list(payload[0].keys())
+            columns = _ohlc_columns(keys)
+            if columns is None:
+                raise OhlcFormatError("no open/high/low/close keys found")
+            total = len(payload)
+            wanted = [keys[columns[column]] for column in ('open', 'high', 'low', 'close', 'volume') if column in columns]
+            rows = [[row[key] for key in wanted] for row in payload[-window:]]
+            label = _time_label([payload[-1].get(key) for key in keys], columns)
+        elif isinstance(payload, list) and payload and isinstance(payload[0], list): # List of rows
+            columns = _headerless_columns(payload[0])
+            if columns is None:
+                raise OhlcFormatError("rows don't start with open/high/low/close values")
+            total = len(payload)
+            wanted = [columns[column] for column in ('open', 'high', 'low', 'close', 'volume') if column in columns]
+            rows = [[row[i] for i in wanted] for row in payload[-window:]]
+            label = _time_label(payload[-1], columns)
+        else:
+            raise OhlcFormatError("expected a list of candles")
+        return _candle_arrays(np.asarray(rows, dtype=float).reshape(len(rows), -1), columns), total, label
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        if isinstance(e, OhlcFormatError):
+            raise
+        raise OhlcFormatError(f"inconsistent candles: {e}") from None
+
+def ema(values, span=None, alpha=None):
+    """
+    Exponential moving average of a whole series in one convolution. Weights (1 - alpha)^k are cut off once they drop
+    below 1e-12, so this equals the recursive (adjusted) EMA to well within float precision.
+    """
+    alpha = alpha or 2 / (span + 1)
+    taps = max(1, min(len(values), int(np.ceil(np.log(1e-12) / np.log(1 - alpha)))))
+    weights = (1 - alpha) ** np.arange(taps)
+    numerator = np.convolve(values, weights)[:len(values)]
+    return numerator / np.cumsum(weights)[np.minimum(np.arange(len(values)), taps - 1)]
+
+def sma(values, period):
+    return np.convolve(values, np.ones(period) / period, mode='valid')
+
+def wilder_smooth(values, period):
+    """
+    Wilder's smoothing as charting platforms compute it: seeded with the SMA of the first `period` values, then
+    avg = (prev * (period - 1) + value) / period. Element i of the result belongs to values[period - 1 + i].
+    """
+    alpha = 1 / period
+    seed = values[:period].mean()
+    rest = values[period:]
+    taps = max(1, min(len(rest), int(np.ceil(np.log(1e-12) / np.log(1 - alpha)))))
+    smoothed = seed * (1 - alpha) ** np.arange(1, len(rest) + 1) + np.convolve(rest, alpha * (1 - alpha) ** np.arange(taps))[:len(rest)]
+    return np.concatenate(([seed], smoothed))
+
+def rsi(close, period=14):
+    """Wilder's RSI, for close[period:]: average gains and losses with Wilder's SMA-seeded smoothing."""
+    delta = np.diff(close)
+    gains = wilder_smooth(np.clip(delta, 0, None), period)
+    losses = wilder_smooth(np.clip(-delta, 0, None), period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = 100 - 100 / (1 + gains / losses)
+    return np.where(losses == 0, np.where(gains == 0, 50.0, 100.0), values)
+
+def stochastic(high, low, close, period=14, smooth_k=3, smooth_d=3):
+    """Slow stochastic (14, 3, 3). Returns (%K, %D)."""
+    highest = np.lib.stride_tricks.sliding_window_view(high, period).max(axis=1)
+    lowest = np.lib.stride_tricks.sliding_window_view(low, period).min(axis=1)
+    spread = highest - lowest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw = np.where(spread > 0, 100 * (close[period - 1:] - lowest) / spread, 50.0)
+    k = sma(raw, smooth_k)
+    return k, sma(k, smooth_d)
+
+def swing_points(high, low, strength=2):
+    """Indices of fractal swing highs/lows: the extreme of the `strength` candles on either side."""
+    size = 2 * strength + 1
+    highs = np.flatnonzero(np.lib.stride_tricks.sliding_window_view(high, size).argmax(axis=1) == strength) + strength
+    lows = np.flatnonzero(np.lib.stride_tricks.sliding_window_view(low, size).argmin(axis=1) == strength) + strength
+    return highs, lows
+
+def fair_value_gaps(high, low):
+    """
+    Three-candle imbalances not yet traded through, as (kind, bottom, top, index of the middle candle), newest last.
+    Bullish: the third candle's low is above the first one's high; bearish: its high is below the first one's low.
+    """
+    later_low = np.append(np.minimum.accumulate(low[::-1])[::-1][1:], np.inf) # Lowest low after each candle
+    later_high = np.append(np.maximum.accumulate(high[::-1])[::-1][1:], -np.inf)
+    third = np.arange(2, len(high))
+    bullish = third[(low[2:] > high[:-2]) & (later_low[2:] > high[:-2])]
+    bearish = third[(high[2:] < low[:-2]) & (later_high[2:] < low[:-2])]
+    gaps = [('bullish', high[i - 2], low[i], i - 1) for i in bullish] + [('bearish', high[i], low[i - 2], i - 1) for i in bearish]
+    return sorted(gaps, key=lambda gap: gap[3])
+
+def compute_ohlc_indicators(candles):
+    """The numbers behind an OHLC reply, all from the last candle's point of view."""
+    high, low, close = candles['high'], candles['low'], candles['close']
+    if len(close) < OHLC_MIN_CANDLES:
+        raise OhlcFormatError(f"need at least {OHLC_MIN_CANDLES} candles, got {len(close)}")
+    last = len(close) - 1
+    k, d = stochastic(high, low, close)
+    swing_highs, swing_lows = swing_points(high, low)
+    result = {
+        'close': close[-1], 'ema9': ema(close, 9)[-1], 'ema20': ema(close, 20)[-1], 'rsi': rsi(close)[-1],
+        'stoch_k': k[-1], 'stoch_d': d[-1],
+        'swing_high': (high[swing_highs[-1]], last - swing_highs[-1]) if len(swing_highs) else None,
+        'swing_low': (low[swing_lows[-1]], last - swing_lows[-1]) if len(swing_lows) else None,
+        'fvgs': [(kind, bottom, top, last - i) for kind, bottom, top, i in fair_value_gaps(high, low)[-3:]],
+        'fib': None,
+    }
+    if result['swing_high'] and result['swing_low']:
+        (swing_high, high_age), (swing_low, low_age) = result['swing_high'], result['swing_low']
+        up_leg = low_age > high_age # The low came first, so price is retracing an up move
+        result['fib'] = ('up' if up_leg else 'down',
+                         [(ratio, swing_high - (swing_high - swing_low) * ratio if up_leg else swing_low + (swing_high - swing_low) * ratio)
+                          for ratio in FIB_RATIOS])
+    return result
+
+def format_ohlc_reply(result, lang, rows, last_label):
+    """Formats compute_ohlc_indicators output for Telegram (HTML)."""
+    en = lang == 'en'
+    price = lambda value: f"{value:.6g}"
+    trend = ("bullish" if en else "bullish (naik)") if result['ema9'] > result['ema20'] else ("bearish" if en else "bearish (turun)")
+    lines = [
+        (f"📈 <b>OHLC analysis</b> ({rows} candles" if en else f"📈 <b>Analisis OHLC</b> ({rows} candle")
+        + (f", last {last_label})" if en and last_label else f", terakhir {last_label})" if last_label else ")"),
+        f"Close: <code>{price(result['close'])}</code>",
+        f"EMA 9 / 20: <code>{price(result['ema9'])}</code> / <code>{price(result['ema20'])}</code> "
+        + (f"(EMA 9 {'above' if result['ema9'] > result['ema20'] else 'below'} EMA 20, {trend})" if en
+           else f"(EMA 9 {'di atas' if result['ema9'] > result['ema20'] else 'di bawah'} EMA 20, {trend})"),
+        f"RSI 14: <code>{result['rsi']:.1f}</code>"
+        + ((" (overbought)" if en else " (jenuh beli)") if result['rsi'] >= 70 else (" (oversold)" if en else " (jenuh jual)") if result['rsi'] <= 30 else ""),
+        f"Stochastic 14,3,3: %K <code>{result['stoch_k']:.1f}</code> / %D <code>{result['stoch_d']:.1f}</code>",
+    ]
+    ago = "candles ago" if en else "candle lalu"
+    for key, label in (('swing_high', "Swing high"), ('swing_low', "Swing low")):
+        if result[key]:
+            lines.append(f"{label}: <code>{price(result[key][0])}</code> ({result[key][1]} {ago})")
+    if result['fib']:
+        direction, levels = result['fib']
+        leg = "low → high" if direction == 'up' else "high → low"
+        lines.append(f"Fibonacci ({leg}): " + " · ".join(f"{ratio * 100:g}% <code>{price(level)}</code>" for ratio, level in levels))
+    if result['fvgs']:
+        lines.append("Open FVGs:" if en else "FVG terbuka:")
+        lines += [f"• {kind} <code>{price(bottom)}</code>–<code>{price(top)}</code> ({age} {ago})" for kind, bottom, top, age in result['fvgs']]
+    else:
+        lines.append("No open FVGs." if en else "Tidak ada FVG terbuka.")
+    lines.append("\n<i>Computed from your data, no AI involved. Educational only, not financial advice.</i>" if en
+                 else "\n<i>Dihitung dari data Anda tanpa AI. Hanya edukasi, bukan nasihat keuangan.</i>")
+    return "\n".join(lines)
+
+def analyze_ohlc_document(data, file_name, lang):
+    """Parses an OHLC CSV/JSON document and returns the formatted indicator reply. Raises OhlcFormatError."""
+    with span('parse'):
+        if (file_name or "").lower().endswith('.json') or data.lstrip()[:1] in (b'[', b'{'):
+            candles, rows, last_label = read_ohlc_json(data)
+        else:
+            candles, rows, last_label = read_ohlc_csv(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', errors='replace'))
+    with span('indicators'):
+        result = compute_ohlc_indicators(candles)
+    return format_ohlc_reply(result, lang, rows, last_label)
+
+def get_ohlc_document_error(lang, document):
+    """Returns the reply for an OHLC document we won't read, or None if it can be analyzed."""
+    if np is None:
+        return "❌ OHLC files need NumPy on the server (pip install numpy)." if lang == 'en' else "❌ File OHLC membutuhkan NumPy di server (pip install numpy)."
+    if document.file_size and document.file_size > OHLC_MAX_FILE_BYTES:
+        limit = OHLC_MAX_FILE_BYTES // (1024 * 1024)
+        return f"❌ The file is larger than {limit} MB." if lang == 'en' else f"❌ Ukuran file melebihi {limit} MB."
+    return None
+
+def get_ohlc_error_text(e, lang):
+    if isinstance(e, OhlcFormatError):
+        return (f"❌ Could not read OHLC data: {e}.\nSend a CSV or JSON file with open, high, low and close columns." if lang == 'en'
+                else f"❌ Data OHLC tidak dapat dibaca: {e}.\nKirim file CSV atau JSON dengan kolom open, high, low dan close.")
+    return f"❌ Error:\n{str(e)}"
+
+@bot.message_handler(content_types=["document"], func=lambda m: is_ohlc_document(m.document, m.caption) and is_addressed_to_bot(m))
+def handle_document(message):
+    with trace_context(handler='document', chat_id=message.chat.id, message_id=message.message_id):
+        _handle_document(message)
+
+def _handle_document(message):
+    chat_id = str(message.chat.id)
+    lang = user_data.get(chat_id, {}).get('lang', 'en')
+    document_error = get_ohlc_document_error(lang, message.document)
+    if document_error:
+        bot.reply_to(message, document_error)
+        return
+    try:
+        with span('download'):
+            data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+        reply_text = analyze_ohlc_document(data, message.document.file_name, lang)
+    except Exception as e:
+        reply_text = get_ohlc_error_text(e, lang)
+    with span('reply'):
+        for part in split_message(reply_text):
+            bot.reply_to(message, part)
+
+
+# ========= UPDATE INGESTION =========
+class UpdateDeduplicator:
+    """
+    Remembers recently seen update_ids in a bounded TTL/LRU map so Telegram replays are dropped.
+    With the 'sqlite' backend the ids are also persisted, so a restarted worker still recognizes them.
+    With the 'redis' backend the ids are shared, so a replay is dropped whichever worker it reaches.
+    """
+    PRUNE_EVERY = 500 # Inserts between expired-row cleanups in sqlite
+
+    def __init__(self, ttl, max_size, backend='memory', db_file=DEDUP_DB_FILE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict() # update_id -> first seen timestamp
+        self._lock = threading.Lock()
+        self._db = None
+        self._inserts = 0
+        self.backend = backend
+        self.stats = {'hits': 0, 'misses': 0}
+        if backend == 'sqlite':
+            self._db = sqlite3.connect(db_file, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)")
+            self._db.commit()
+
+    def check_and_add(self, update_id):
+        """Returns True if update_id was already seen (a replay), otherwise records it and returns False."""
+        if self.backend == 'redis':
+            first = get_redis().set(f"tradebot:seen:{update_id}", 1, nx=True, ex=max(1, int(self.ttl)))
+            with self._lock:
+                self.stats['misses' if first else 'hits'] += 1
+            return not first
+        now = time.time()
+        with self._lock:
+            seen_at = self._seen.get(update_id)
+            if seen_at is None and self._db is not None:
+                row = self._db.execute("SELECT seen_at FROM seen_updates WHERE update_id = ?", (update_id,)).fetchone()
+                seen_at = row[0] if row else None
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen[update_id] = seen_at
+                self._seen.move_to_end(update_id)
+                self.stats['hits'] += 1
+                return True
+
+            self.stats['misses'] += 1
+            self._seen[update_id] = now
+            self._seen.move_to_end(update_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO seen_updates (update_id, seen_at) VALUES (?, ?)", (update_id, now))
+                self._inserts += 1
+                if self._inserts % self.PRUNE_EVERY == 0:
+                    self._db.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.ttl,))
+                self._db.commit()
+            return False
+
+    def forget(self, update_id):
+        """Drops an update_id again, e.g. when we answered 503 and want Telegram's retry to go through."""
+        if self.backend == 'redis':
+            get_redis().delete(f"tradebot:seen:{update_id}")
+            return
+        with self._lock:
+            self._seen.pop(update_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+                self._db.commit()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._seen)
+        stats['backend'] = self.backend
+        return stats
+
+deduplicator = UpdateDeduplicator(DEDUP_TTL, DEDUP_MAX_SIZE, DEDUP_BACKEND)
+
+def process_update(update):
+    """Runs one update through the handlers, after pulling settings other workers changed."""
+    with trace_context(update_id=update.update_id):
+        refresh_user_data()
+        bot.process_new_updates([update])
+
+def get_update_chat_id(update):
+    """Returns the chat id an update belongs to, or None for updates without a chat."""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    call = getattr(update, 'callback_query', None)
+    if call is not None and call.message is not None:
+        return call.message.chat.id
+    return None
+
+_ingest_item = contextvars.ContextVar('ingest_item', default=None) # Shared queue item being processed
+
+def defer_update_ack():
+    """
+    Lets a handler keep the update it is processing for later (the photos of an open album): a shared ingest
+    queue then acknowledges it only when the returned callback runs. Returns None if nothing needs acknowledging.
+    """
+    item = _ingest_item.get()
+    if item is None:
+        return None
+    item['deferred'] = True
+    return item['ack']
+
+class UpdateDispatcher:
+    """
+    Bounded in-process queue in front of bot.process_new_updates.
+    Updates are sharded by chat id onto one queue per worker, so every chat is handled in order.
+    run_for_chat queues work on behalf of a chat (a completed album) behind the chat's pending updates.
+    """
+    def __init__(self, workers, queue_size, overflow):
+        self.overflow = overflow
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._lock = threading.Lock()
+        self._started = False
+        self.stats = {'accepted': 0, 'rejected': 0, 'shed': 0, 'processed': 0, 'failed': 0, 'tasks': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0}
+
+    def start(self):
+        """Starts the worker threads once."""
+        with self._lock:
+            if self._started:
+                return
+            for i, q in enumerate(self._queues):
+                threading.Thread(target=self._worker, args=(q,), name=f"ingest-{i}", daemon=True).start()
+            self._started = True
+
+    def submit(self, update, payload=None):
+        """Queues an update. Returns False if it was rejected because the queue is full."""
+        self.start()
+        chat_id = get_update_chat_id(update)
+        q = self._queues[hash(chat_id) % len(self._queues)]
+        item = (time.monotonic(), update, None)
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            if self.overflow != 'shed':
+                with self._lock:
+                    self.stats['rejected'] += 1
+                return False
+            shed = self._shed_oldest(q, chat_id)
+            if shed is None:
+                with self._lock:
+                    self.stats['rejected'] += 1
+                return False
+            deduplicator.forget(shed.update_id) # Telegram's retry of the dropped update must not be taken as a duplicate
+            with self._lock:
+                self.stats['shed'] += 1
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                with self._lock:
+                    self.stats['rejected'] += 1
+                return False
+        with self._lock:
+            self.stats['accepted'] += 1
+        return True
+
+    @staticmethod
+    def _shed_oldest(q, chat_id):
+        """
+        Removes the oldest queued update of chat_id and returns it, or None if the chat has none queued.
+        Other chats' updates and run_for_chat tasks are never dropped.
+        """
+        with q.mutex:
+            for i, (_, update, task) in enumerate(q.queue):
+                if task is None and get_update_chat_id(update) == chat_id:
+                    del q.queue[i]
+                    q.unfinished_tasks -= 1
+                    q.not_full.notify()
+                    return update
+        return None
+
+    def run_for_chat(self, chat_id, fn):
+        """Runs fn on the worker thread of chat_id, after the updates already queued for the chat."""
+        self.start()
+        self._queues[hash(chat_id) % len(self._queues)].put((time.monotonic(), None, fn)) # Waits for room rather than dropping it
+
+    def _worker(self, q):
+        while True:
+            enqueued_at, update, task = q.get()
+            wait = time.monotonic() - enqueued_at
+            try:
+                if task is not None:
+                    task()
+                else:
+                    process_update(update)
+                ok = True
+            except Exception as e:
+                print(f"Warning: Failed to process update {update.update_id if update else 'task'}: {e}")
+                ok = False
+            finally:
+                q.task_done()
+            with self._lock:
+                self.stats['tasks' if task is not None else 'processed' if ok else 'failed'] += 1
+                self.stats['wait_total'] += wait
+                self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+
+    def snapshot(self):
+        """Returns queue depth and wait-time metrics."""
+        with self._lock:
+            stats = dict(self.stats)
+        done = stats['processed'] + stats['failed']
+        stats['wait_avg'] = stats['wait_total'] / done if done else 0.0
+        stats['queue_depth'] = [q.qsize() for q in self._queues]
+        stats['queue_depth_total'] = sum(stats['queue_depth'])
+        stats['mode'] = INGEST_MODE
+        stats['backend'] = 'local'
+        return stats
+
+class SqliteUpdateQueue:
+    """Per-shard FIFO of raw updates plus shard leases in one sqlite file, shared by worker processes on one host."""
+    def __init__(self, path=INGEST_DB_FILE):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending_updates (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "shard INTEGER NOT NULL, enqueued_at REAL NOT NULL, payload TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pending_updates_shard ON pending_updates (shard, id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS shard_leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def push(self, shard, payload, max_depth):
+        with self._lock:
+            depth = self._db.execute("SELECT COUNT(*) FROM pending_updates WHERE shard = ?", (shard,)).fetchone()[0]
+            if depth >= max_depth:
+                return False
+            self._db.execute("INSERT INTO pending_updates (shard, enqueued_at, payload) VALUES (?, ?, ?)",
+                             (shard, time.time(), payload))
+            return True
+
+    def peek(self, shard, skip=0):
+        """Returns (item_id, enqueued_at, payload) of the oldest update in the shard after the first skip, or None."""
+        with self._lock:
+            return self._db.execute("SELECT id, enqueued_at, payload FROM pending_updates WHERE shard = ? ORDER BY id LIMIT 1 OFFSET ?",
+                                    (shard, skip)).fetchone()
+
+    def ack(self, shard, item_id):
+        with self._lock:
+            self._db.execute("DELETE FROM pending_updates WHERE id = ?", (item_id,))
+
+    def depth(self, shards):
+        with self._lock:
+            rows = dict(self._db.execute("SELECT shard, COUNT(*) FROM pending_updates GROUP BY shard").fetchall())
+        return [rows.get(shard, 0) for shard in range(shards)]
+
+    def lease(self, shard, owner, ttl):
+        """Takes or renews the lease on a shard. Returns True if owner holds it afterwards."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO shard_leases (shard, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(shard) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE shard_leases.owner = excluded.owner OR shard_leases.expires_at < ?",
+                (shard, owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, shard, owner):
+        with self._lock:
+            self._db.execute("DELETE FROM shard_leases WHERE shard = ? AND owner = ?", (shard, owner))
+
+class RedisUpdateQueue:
+    """Per-shard Redis lists of raw updates plus SET NX leases, shared by workers on any number of hosts."""
+    def __init__(self, prefix="tradebot:updates"):
+        self.prefix = prefix
+
+    def push(self, shard, payload, max_depth):
+        r = get_redis()
+        if r.llen(f"{self.prefix}:{shard}") >= max_depth:
+            return False
+        r.rpush(f"{self.prefix}:{shard}", json.dumps([time.time(), payload]))
+        return True
+
+    def peek(self, shard, skip=0):
+        raw = get_redis().lindex(f"{self.prefix}:{shard}", skip)
+        if raw is None:
+            return None
+        enqueued_at, payload = json.loads(raw)
+        return raw, enqueued_at, payload
+
+    def ack(self, shard, item_id):
+        get_redis().lrem(f"{self.prefix}:{shard}", 1, item_id)
+
+    def depth(self, shards):
+        pipe = get_redis().pipeline()
+        for shard in range(shards):
+            pipe.llen(f"{self.prefix}:{shard}")
+        return pipe.execute()
+
+    def lease(self, shard, owner, ttl):
+        r = get_redis()
+        key, ttl_ms = f"{self.prefix}:lease:{shard}", int(ttl * 1000)
+        if r.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        return r.get(key) == owner and bool(r.pexpire(key, ttl_ms))
+
+    def release(self, shard, owner):
+        r = get_redis()
+        key = f"{self.prefix}:lease:{shard}"
+        if r.get(key) == owner:
+            r.delete(key)
+
+INGEST_QUEUE_BACKENDS = {
+    'sqlite': SqliteUpdateQueue,
+    'redis': RedisUpdateQueue,
+}
+
+class SharedUpdateDispatcher:
+    """
+    Update queue shared by every worker process, for running several web workers or nodes.
+    Updates are sharded by chat id; a worker thread leases a shard while it has pending updates and is
+    the only one processing it, so every chat is still handled in order whichever worker received it.
+    Leases are renewed by a heartbeat and expire after INGEST_LEASE_TTL if the worker dies.
+    Updates a handler keeps for later (defer_update_ack) stay in the queue, skipped, and the shard stays
+    leased until they are acknowledged; run_for_chat runs work for a chat on the thread holding its shard.
+    """
+    def __init__(self, store, shards, workers, queue_size, lease_ttl=INGEST_LEASE_TTL, poll_interval=INGEST_POLL_INTERVAL):
+        self.store = store
+        self.shards = max(1, shards)
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._owned = {} # owner -> set of leased shards
+        self._held = {} # shard -> processed updates left unacknowledged, at the head of its queue
+        self._tasks = {} # shard -> deque of work for the thread holding the shard
+        self._lock = threading.Lock()
+        self._started = False
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'deferred': 0, 'tasks': 0,
+                      'leases_taken': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def start(self):
+        """Starts the consumer and heartbeat threads once per process."""
+        with self._lock:
+            if self._started:
+                return
+            prefix = f"{socket.gethostname()}:{os.getpid()}"
+            for i in range(self.workers):
+                owner = f"{prefix}:{i}"
+                self._owned[owner] = set()
+                threading.Thread(target=self._worker, args=(owner, i), name=f"ingest-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True).start()
+            self._started = True
+
+    def submit(self, update, payload):
+        """Queues the raw update JSON on its chat's shard. Returns False if that shard is full."""
+        self.start()
+        shard = self._shard(get_update_chat_id(update))
+        ok = self.store.push(shard, payload, self.queue_size)
+        with self._lock:
+            self.stats['accepted' if ok else 'rejected'] += 1
+        return ok
+
+    def _shard(self, chat_id):
+        return int(chat_id) % self.shards if chat_id is not None else 0
+
+    def run_for_chat(self, chat_id, fn):
+        """Runs fn on the thread holding chat_id's shard, between two of its updates."""
+        shard = self._shard(chat_id)
+        with self._lock:
+            if any(shard in owned for owned in self._owned.values()):
+                self._tasks.setdefault(shard, deque()).append(fn)
+                return
+        fn() # The lease was lost: the held updates are replayed elsewhere anyway, finish here
+
+    def _ack_held(self, shard, item_id):
+        self.store.ack(shard, item_id)
+        with self._lock:
+            self._held[shard] = max(0, self._held.get(shard, 0) - 1)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            for owner, owned in list(self._owned.items()):
+                for shard in list(owned):
+                    try:
+                        if not self.store.lease(shard, owner, self.lease_ttl):
+                            owned.discard(shard)
+                            with self._lock:
+                                self._held.pop(shard, None) # Its next owner replays them
+                    except Exception as e:
+                        print(f"Warning: Failed to renew lease on shard {shard}: {e}")
+
+    def _worker(self, owner, offset):
+        owned = self._owned[owner]
+        while True:
+            try:
+                busy = self._work_once(owner, owned, offset)
+            except Exception as e:
+                print(f"Warning: Shared ingest worker {owner} failed: {e}")
+                busy = False
+            if not busy:
+                time.sleep(self.poll_interval)
+
+    def _work_once(self, owner, owned, offset):
+        """Claims at most one new shard, then handles one update from each owned shard. Returns True if any ran."""
+        depth = self.store.depth(self.shards)
+        for i in range(self.shards):
+            shard = (offset + i) % self.shards # Threads start scanning at different shards
+            if depth[shard] and shard not in owned and self.store.lease(shard, owner, self.lease_ttl):
+                owned.add(shard)
+                with self._lock:
+                    self.stats['leases_taken'] += 1
+                break
+
+        busy = False
+        for shard in sorted(owned):
+            with self._lock:
+                tasks = self._tasks.pop(shard, ())
+            for task in tasks:
+                busy = True
+                try:
+                    task()
+                except Exception as e:
+                    print(f"Warning: Failed to run queued work on shard {shard}: {e}")
+                with self._lock:
+                    self.stats['tasks'] += 1
+            with self._lock:
+                held = self._held.get(shard, 0)
+            item = self.store.peek(shard, held)
+            if item is None:
+                if not held:
+                    owned.discard(shard) # Hand idle shards back so busy workers' chats spread out
+                    self.store.release(shard, owner)
+                continue
+            busy = True
+            item_id, enqueued_at, payload = item
+            wait = max(0.0, time.time() - enqueued_at)
+            entry = {'deferred': False, 'ack': lambda shard=shard, item_id=item_id: self._ack_held(shard, item_id)}
+            token = _ingest_item.set(entry)
+            try:
+                update = telebot.types.Update.de_json(payload)
+                process_update(update)
+                ok = True
+            except Exception as e:
+                print(f"Warning: Failed to process queued update on shard {shard}: {e}")
+                ok = False
+            finally:
+                _ingest_item.reset(token)
+            if entry['deferred']:
+                with self._lock:
+                    self._held[shard] = self._held.get(shard, 0) + 1
+                    self.stats['deferred'] += 1
+            else:
+                self.store.ack(shard, item_id) # Acked after processing, so a crash mid-update replays it elsewhere
+            with self._lock:
+                self.stats['processed' if ok else 'failed'] += 1
+                self.stats['wait_total'] += wait
+                self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+        return busy
+
+    def snapshot(self):
+        """Returns shared queue depth, this process's leases and wait-time metrics."""
+        with self._lock:
+            stats = dict(self.stats)
+        done = stats['processed'] + stats['failed']
+        stats['wait_avg'] = stats['wait_total'] / done if done else 0.0
+        try:
+            stats['queue_depth'] = self.store.depth(self.shards)
+            stats['queue_depth_total'] = sum(stats['queue_depth'])
+        except Exception as e:
+            stats['queue_depth_error'] = str(e)
+        stats['shards_owned'] = sum(len(owned) for owned in self._owned.values())
+        with self._lock:
+            stats['held'] = sum(self._held.values())
+        stats['mode'] = INGEST_MODE
+        stats['backend'] = INGEST_BACKEND
+        stats['pid'] = os.getpid()
+        return stats
+
+if INGEST_BACKEND == 'local':
+    dispatcher = UpdateDispatcher(INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_OVERFLOW)
+else:
+    dispatcher = SharedUpdateDispatcher(INGEST_QUEUE_BACKENDS[INGEST_BACKEND](), INGEST_SHARDS, INGEST_WORKERS, INGEST_QUEUE_SIZE)
+
+
+# ========= FLASK ROUTES =========
+@app.route("/")
+def home():
+    """Basic home route to indicate the bot is running."""
+    return "🤖 Bot is running via webhook!", 200
+
+_record_lock = threading.Lock()
+
+def count_update(outcome):
+    metrics.inc('tradebot_webhook_updates_total', "Webhook updates by outcome", outcome=outcome)
+
+def record_update(json_string):
+    """Appends a raw webhook payload to UPDATE_RECORD_FILE, one per line."""
+    with _record_lock:
+        with open(UPDATE_RECORD_FILE, 'a') as f:
+            f.write(json_string.replace("\n", " ") + "\n")
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    """Webhook endpoint for Telegram updates."""
+    if request.headers.get('content-type') == 'application/json':
+        json_string = request.get_data().decode("utf-8")
+        if UPDATE_RECORD_FILE:
+            record_update(json_string)
+        update = telebot.types.Update.de_json(json_string)
+        if deduplicator.check_and_add(update.update_id):
+            count_update('duplicate')
+            return "OK", 200 # Replay of an update we already have, ack it so Telegram stops retrying
+        if INGEST_MODE == 'queue':
+            if not dispatcher.submit(update, json_string):
+                deduplicator.forget(update.update_id)
+                count_update('rejected')
+                return "Queue full", 503
+        else:
+            process_update(update)
+        count_update('accepted')
+        return "OK", 200
+    return "Invalid request", 403
+
+def collect_stats():
+    """Runtime counters for monitoring, shared by the Flask and asyncio runtimes."""
+    return {
+        'ingest': dispatcher.snapshot(),
+        'dedup': deduplicator.snapshot(),
+        'settings': settings_store.snapshot(),
+        'analysis_cache': analysis_cache.snapshot(),
+        'learn_cache': learn_answer_cache.snapshot(),
+        'conversation_memory': conversation_memory.snapshot(),
+        'image_pipeline': image_pipeline_stats.snapshot(),
+        'learn_reply': learn_reply_stats.snapshot(),
+        'group_filter': group_filter_snapshot(),
+        'media_groups': media_group_collector.snapshot(),
+        'chart_filter': chart_filter_snapshot(),
+        'journal': signal_journal.snapshot() if signal_journal else None,
+        'cleanup': cleanup_worker.snapshot(),
+        'usage': usage_ledger.snapshot(),
+        'outbound': telegram_outbound.snapshot(),
+        'backends': {'learn': learn_router.snapshot(), 'chart': chart_router.snapshot()},
+        'rate_limits': {
+            'chats': chat_rate_limiter.snapshot(),
+            **{name: limiter.snapshot() for name, limiter in backend_limiters.items()},
+        },
+    }
+
+@app.route("/stats")
+def stats():
+    """Runtime counters for monitoring."""
+    return jsonify(collect_stats()), 200
+
+def usage_report_allowed(authorization):
+    """True if an Authorization header carries ADMIN_TOKEN; the usage report is off while ADMIN_TOKEN is unset."""
+    return bool(ADMIN_TOKEN) and authorization == f"Bearer {ADMIN_TOKEN}"
+
+@app.route("/usage")
+def usage_route():
+    """Today's token usage, cost per model and the top consuming chats, for admins."""
+    if not usage_report_allowed(request.headers.get('Authorization')):
+        return "Not found", 404
+    top = request.args.get('top', '10')
+    return jsonify(usage_ledger.report(top=int(top) if top.isdigit() else 10, day=request.args.get('day'))), 200
+
+@app.route("/metrics")
+def metrics_route():
+    """Prometheus-style histograms and counters."""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# ========== STARTUP ==========
+def warm_up():
+    """Does the work STARTUP_MODE=lazy leaves to the first update: chat settings, SDK imports and model clients."""
+    start = time.monotonic()
+    try:
+        load_user_data()
+        for router in (learn_router, chart_router):
+            for backend in router.backends:
+                backend.client
+        print(f"Running as @{get_bot_identity().username}")
+    except Exception as e:
+        print(f"Warning: Warm-up failed, it will be retried on first use: {e}")
+        return
+    print(f"Warm-up done in {(time.monotonic() - start) * 1000:.0f}ms")
+
+def ensure_webhook(webhook_bot, url=WEBHOOK_URL):
+    """
+    Registers the webhook only when Telegram has a different URL. Re-registering on every boot
+    (deleteWebhook + setWebhook) is two extra round trips, and updates sent in between are lost.
+    Returns True if the webhook had to be set.
+    """
+    info = webhook_bot.get_webhook_info()
+    if info.url == url:
+        print(f"Webhook already set to {url} ({info.pending_update_count} pending updates)")
+        return False
+    webhook_bot.set_webhook(url=url) # Replaces any previous URL, no deleteWebhook needed
+    print(f"Webhook set to {url}" + (f", was {info.url}" if info.url else ""))
+    return True
+
+if STARTUP_MODE == 'eager':
+    warm_up()
+elif STARTUP_MODE == 'background':
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 # ========= RUN FLASK + SET WEBHOOK =========
+# For production, serve with several workers: `gunicorn -c gunicorn.conf.py bot:app` (see Procfile).
+# The development server below runs a single process.
 if __name__ == "__main__":
-    bot.remove_webhook()
-    bot.set_webhook(url=WEBHOOK_URL)
+    ensure_webhook(bot)
+    cleanup_worker.start() # Its first sweep removes what a previous process left behind
 
     port = int(os.environ.get("PORT", 5000))
     print(f"Starting Flask app on port {port} with webhook URL: {WEBHOOK_URL}")
@@ -0,0 +1,562 @@
+"""
+Asyncio runtime for the bot: the same handlers, served from one event loop.
+
+Telegram, Groq and Gemini I/O is awaited instead of pinning a thread per request, so a single
+process can hold hundreds of analyses in flight. Prompts, chat settings, caches, rate limits and
+reply formatting are shared with bot.py.
+
+Run with `python bot_async.py` instead of `python bot.py`.
+"""
+import io
+import os
+import time
+import asyncio
+import contextlib
+
+import telebot
+from aiohttp import web
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+import bot as core
+
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "500")) # Updates processed concurrently before answering 503
+
+if core.TELEGRAM_API_BASE:
+    asyncio_helper.API_URL = core.telebot.apihelper.API_URL
+    asyncio_helper.FILE_URL = core.telebot.apihelper.FILE_URL
+abot = AsyncTeleBot(core.BOT_TOKEN, parse_mode="HTML")
+
+# ========== OUTBOUND TELEGRAM ==========
+_process_request = asyncio_helper._process_request
+
+async def paced_process_request(token, url, method='get', params=None, files=None, **kwargs):
+    """
+    Async twin of bot.TelegramOutbound.request, wrapped around telebot's aiohttp request function
+    (which already keeps a pooled session). Shares the outbound buckets, 429 blocks, coalescing and stats.
+    """
+    outbound = core.telegram_outbound
+    with outbound._lock:
+        outbound.stats['requests'] += 1
+    chat_id = (params or {}).get('chat_id')
+    if chat_id is None or not url.startswith(outbound.PACED_PREFIXES):
+        return await _process_request(token, url, method, params, files, **kwargs)
+
+    edit = outbound._register_edit(url, chat_id, params)
+    send = None # Set once this request sends an edit on behalf of every edit it covers
+    result = error = None
+    try:
+        for attempt in range(outbound.max_retries + 1):
+            wait = outbound._reserve(chat_id)
+            if wait is None:
+                with outbound._lock:
+                    outbound.stats['dropped'] += 1
+                raise core.RateLimitedError(f"Outbound messages for chat {chat_id} are backed up over {outbound.max_wait:g}s")
+            await asyncio.sleep(wait)
+            if attempt == 0:
+                outbound._record_wait(wait)
+                if edit:
+                    params, claimed = outbound._claim_edit(*edit, asyncio.Event)
+                    if params is None:
+                        edit = None # Covered by another send, nothing left to finish or abandon
+                        outbound._refund(chat_id)
+                        try:
+                            await asyncio.wait_for(claimed['done'].wait(), outbound.max_wait)
+                        except asyncio.TimeoutError:
+                            return outbound._covered_result(claimed, False)
+                        return outbound._covered_result(claimed, True)
+                    send = claimed
+            elif edit:
+                params = outbound._refresh_edit(edit[0])
+            try:
+                result = await _process_request(token, url, method, dict(params), files, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == outbound.max_retries:
+                    raise
+                outbound._block(chat_id, float(e.result_json.get('parameters', {}).get('retry_after', 1)))
+                continue
+            return result
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if edit and send is None:
+            outbound._abandon_edit(edit[0])
+        elif send:
+            outbound._finish_edit(edit[0], send, result, error) # A cancelled send hands its edits an error
+
+asyncio_helper._process_request = paced_process_request
+
+# ========== COMMAND HANDLERS ==========
+@abot.message_handler(commands=['start', 'menu', 'language'])
+async def send_menu(message):
+    chat_id = str(message.chat.id)
+    text, markup = core.get_menu_reply(chat_id, message.text.split()[0].lstrip('/').split('@')[0])
+    await abot.send_message(chat_id, text, reply_markup=markup)
+
+@abot.message_handler(commands=list(core.MODE_COMMANDS))
+async def set_mode_command(message):
+    chat_id = str(message.chat.id)
+    command = message.text.split()[0].lstrip('/').split('@')[0]
+    await abot.send_message(chat_id, core.apply_mode_command(chat_id, command))
+
+@abot.message_handler(commands=['journal'])
+async def send_journal(message):
+    chat_id = str(message.chat.id)
+    lang = core.get_chat_settings(chat_id)['lang']
+    await abot.send_message(chat_id, await asyncio.to_thread(core.get_journal_reply, chat_id, message.text.split()[1:], lang))
+
+@abot.message_handler(commands=['stats'])
+async def send_journal_stats(message):
+    chat_id = str(message.chat.id)
+    lang = core.get_chat_settings(chat_id)['lang']
+    await abot.send_message(chat_id, await asyncio.to_thread(core.get_journal_stats_reply, chat_id, lang))
+
+@abot.message_handler(commands=['usage'])
+async def send_usage(message):
+    chat_id = str(message.chat.id)
+    await abot.send_message(chat_id, await asyncio.to_thread(core.get_usage_reply, chat_id, core.get_chat_settings(chat_id)['lang']))
+
+# ========== CALLBACK QUERY HANDLERS ==========
+@abot.callback_query_handler(func=lambda call: call.data.startswith('set_lang_'))
+async def set_language_callback(call):
+    chat_id = str(call.message.chat.id)
+    lang = call.data.split('_')[2]
+    await abot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id, text=core.apply_language(chat_id, lang))
+    text, markup = core.get_menu_reply(chat_id, 'menu')
+    await abot.send_message(chat_id, text, reply_markup=markup)
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith('command_'))
+async def handle_command_buttons(call):
+    chat_id = str(call.message.chat.id)
+    command_name = call.data.split('_', 1)[1]
+    if command_name in core.BUTTON_COMMANDS:
+        await abot.send_message(chat_id, core.apply_mode_command(chat_id, core.BUTTON_COMMANDS[command_name]))
+    await abot.answer_callback_query(call.id)
+
+# ========== TEXT HANDLER ==========
+@abot.message_handler(func=lambda m: m.content_type == 'text' and core.is_addressed_to_bot(m))
+async def handle_text(message):
+    with core.trace_context(handler='text', chat_id=message.chat.id, message_id=message.message_id):
+        await _handle_text(message)
+
+async def _handle_text(message):
+    chat_id = str(message.chat.id)
+    user_settings = core.user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
+    lang = user_settings['lang']
+
+    if user_settings['mode'] != 'learn':
+        await abot.reply_to(message, core.get_learn_mode_error(lang))
+        return
+
+    start = time.monotonic()
+    cached = None
+    if not core.conversation_memory.has_history(chat_id):
+        with core.span('cache_lookup'):
+            cached = core.learn_answer_cache.get(lang, message.text)
+    if cached is not None:
+        for part in core.split_message(cached):
+            await abot.reply_to(message, part)
+        elapsed = time.monotonic() - start
+        core.learn_reply_stats.record('async_cached', {'first_token': elapsed, 'total': elapsed})
+        core.conversation_memory.add(chat_id, message.text, cached)
+        core.journal_learn(chat_id, lang, message.text, cached)
+        return
+
+    quota_error = await asyncio.to_thread(core.get_quota_error, chat_id, lang)
+    if quota_error:
+        await abot.reply_to(message, quota_error)
+        return
+
+    with core.span('rate_limit'):
+        allowed = await core.chat_rate_limiter.acquire_async(chat_id)
+    if not allowed:
+        await abot.reply_to(message, core.get_slow_down_text(lang))
+        return
+
+    try:
+        messages, with_context = core.assemble_learn_messages(chat_id, lang, message.text)
+        await ensure_sdk(core.groq_sdk)
+        wait_start = time.monotonic()
+        async with core.backend_limiters['groq'].async_slot(chat_id):
+            core.observe_stage('backend_wait', time.monotonic() - wait_start)
+            async with core.usage_ledger.request_async(chat_id, 'learn') as usage:
+                reply = await stream_learn_reply(message, messages, lang)
+                if reply is None:
+                    usage['outcome'] = 'error'
+        if not with_context:
+            core.learn_answer_cache.put(lang, message.text, reply)
+        core.conversation_memory.add(chat_id, message.text, reply)
+        core.journal_learn(chat_id, lang, message.text, reply)
+    except core.RateLimitedError:
+        await abot.reply_to(message, core.get_slow_down_text(lang))
+    except core.BackendUnavailableError as e:
+        print(f"Warning: {e}")
+        await abot.reply_to(message, core.get_backend_unavailable_text(lang))
+    except Exception as e:
+        await abot.reply_to(message, f"❌ Error:\n{str(e)}")
+
+async def ensure_sdk(sdk):
+    """Imports a lazily loaded SDK (see STARTUP_MODE) in a thread, so the first call doesn't stall the loop."""
+    if not sdk.loaded:
+        await asyncio.to_thread(sdk.load)
+
+async def iter_stream_deltas(stream, backend, first=None):
+    """Async twin of bot.iter_stream_deltas."""
+    if first:
+        yield first
+    async for chunk in stream:
+        usage = core.chunk_usage(chunk)
+        if usage is not None:
+            core.record_groq_usage(backend.name, usage)
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+async def open_learn_stream(backend, messages):
+    """Async twin of bot.open_learn_stream: returns an async iterator once the first token arrived."""
+    stream = await backend.async_client.chat.completions.create(messages=messages, model=backend.model, stream=True,
+                                                                timeout=backend.timeout, **core.LEARN_COMPLETION_OPTIONS)
+    async for first in iter_stream_deltas(stream, backend):
+        return iter_stream_deltas(stream, backend, first)
+    return iter_stream_deltas(stream, backend)
+
+async def stream_learn_reply(message, messages, lang):
+    """Async twin of bot.stream_learn_reply: progressive, rate-limited edits of one placeholder reply."""
+    start = time.monotonic()
+    with core.span('placeholder'):
+        placeholder = await abot.reply_to(message, core.get_thinking_text(lang))
+    sent = [[placeholder, ""]]
+    counters = {'edits': 0, 'messages': 1}
+    first_token_at = None
+    reply = ""
+
+    async def publish():
+        for i, part in enumerate(core.split_message(reply)):
+            if i == len(sent):
+                sent.append([await abot.send_message(message.chat.id, part, reply_to_message_id=message.message_id), part])
+                counters['messages'] += 1
+            elif sent[i][1] != part:
+                await abot.edit_message_text(chat_id=message.chat.id, message_id=sent[i][0].message_id, text=part)
+                sent[i][1] = part
+                counters['edits'] += 1
+
+    try:
+        with core.span('first_token'):
+            deltas = await core.learn_router.call_async(lambda backend: open_learn_stream(backend, messages))
+        generate_start = last_publish = time.monotonic()
+        async for delta in deltas:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            reply += delta
+            if time.monotonic() - last_publish >= core.LEARN_STREAM_EDIT_INTERVAL:
+                with core.span('publish'):
+                    await publish()
+                last_publish = time.monotonic()
+        core.observe_stage('stream', time.monotonic() - generate_start)
+        if not reply.strip(): # Nothing to show, the placeholder would keep saying it is thinking
+            raise core.BackendUnavailableError(core.learn_router.name, ["the model returned an empty answer"])
+        with core.span('publish'):
+            await publish()
+    except Exception as e:
+        error_text = core.get_backend_unavailable_text(lang) if isinstance(e, core.BackendUnavailableError) else f"❌ Error:\n{str(e)}"
+        await abot.edit_message_text(chat_id=message.chat.id, message_id=sent[-1][0].message_id,
+                                     text=(sent[-1][1] + "\n\n" if sent[-1][1] else "") + error_text)
+        return None
+
+    end = time.monotonic()
+    core.learn_reply_stats.record('async_stream', {'first_token': (first_token_at or end) - start, 'total': end - start}, counters)
+    return reply
+
+# ========== IMAGE HANDLER ==========
+async def analyze_chart_images(file_ids, lang, current_mode, current_sub_mode, chat_id):
+    """Async twin of bot.analyze_chart_images. Large payloads are uploaded from memory, not a temp file."""
+    uploaded_files = []
+    timings = {}
+    sizes = {}
+    album = len(file_ids) > 1
+    path = 'async_album_inline' if album else 'async_inline'
+
+    async def download(file_id):
+        file_info = await abot.get_file(file_id)
+        return await abot.download_file(file_info.file_path)
+
+    try:
+        with core.span('download', timings):
+            downloads = await asyncio.gather(*(download(file_id) for file_id in file_ids))
+        sizes = {'bytes_downloaded': sum(len(data) for data in downloads)}
+
+        if core.CHART_FILTER_THRESHOLD > 0:
+            with core.span('chart_filter', timings):
+                file_ids, downloads = await asyncio.to_thread(core.filter_chart_photos, file_ids, downloads)
+            album = len(file_ids) > 1
+            path = 'async_album_inline' if album else 'async_inline'
+
+        with core.span('preprocess', timings):
+            images = await asyncio.gather(*(asyncio.to_thread(core.preprocess_chart_image, data) for data in downloads))
+        sizes['bytes_sent'] = sum(len(image_bytes) for image_bytes, _ in images)
+
+        image_parts = []
+        inline_bytes = 0
+        for file_id, (image_bytes, mime_type) in zip(file_ids, images):
+            if inline_bytes + len(image_bytes) <= core.INLINE_IMAGE_MAX_BYTES:
+                inline_bytes += len(image_bytes)
+                image_parts.append({'mime_type': mime_type, 'data': image_bytes})
+            else:
+                image_parts.append((file_id, image_bytes, mime_type))
+
+        if any(isinstance(part, tuple) for part in image_parts):
+            path = 'async_album_file_api' if album else 'async_file_api'
+            with core.span('upload', timings):
+                for i, part in enumerate(image_parts):
+                    if not isinstance(part, tuple):
+                        continue
+                    file_id, image_bytes, mime_type = part
+                    image_parts[i] = await asyncio.to_thread(core.genai.upload_file, io.BytesIO(image_bytes),
+                                                             mime_type=mime_type, display_name=f"chart_{file_id}")
+                    uploaded_files.append(image_parts[i])
+            with core.span('activate', timings):
+                polls = 0
+                for i, part in enumerate(image_parts):
+                    if isinstance(part, dict):
+                        continue
+                    while part.state.name == "PROCESSING":
+                        polls += 1
+                        await asyncio.sleep(1)
+                        part = image_parts[i] = await asyncio.to_thread(core.genai.get_file, part.name)
+                    if part.state.name == "FAILED":
+                        raise ValueError("File processing failed on Gemini side. Please try again.")
+            sizes['activate_polls'] = polls
+
+        if album:
+            contents = [core.get_album_instruction(lang, current_mode, current_sub_mode, len(image_parts))]
+            for i, part in enumerate(image_parts, 1):
+                contents += [f"Chart {i}:", part]
+        else:
+            contents = [core.get_chart_instruction(lang, current_mode, current_sub_mode), image_parts[0]]
+        await ensure_sdk(core.genai)
+
+        async def generate(backend):
+            kwargs = dict(contents=contents, safety_settings=core.CHART_SAFETY_SETTINGS,
+                          generation_config=core.get_chart_generation_config(current_mode),
+                          request_options={'timeout': backend.timeout})
+            # The SDK's REST transport (GEMINI_API_ENDPOINT) has no working async client, so it runs in a thread
+            if core.GEMINI_API_ENDPOINT:
+                response = await asyncio.to_thread(backend.client.generate_content, **kwargs)
+            else:
+                response = await backend.client.generate_content_async(**kwargs)
+            core.record_gemini_usage(backend.name, response)
+            return response
+
+        wait_start = time.monotonic()
+        async with core.backend_limiters['gemini'].async_slot(chat_id):
+            core.observe_stage('backend_wait', time.monotonic() - wait_start)
+            with core.span('generate', timings):
+                async with core.usage_ledger.request_async(chat_id, 'chart'):
+                    gemini_response = await core.chart_router.call_async(generate)
+
+        with core.span('parse', timings):
+            return core.format_chart_reply(gemini_response, lang, current_mode, current_sub_mode)
+    finally:
+        core.image_pipeline_stats.record(path, timings, sizes)
+        for uploaded_file in uploaded_files:
+            core.cleanup_worker.delete_upload(uploaded_file.name)
+
+@abot.message_handler(content_types=["photo"])
+async def handle_photo(message):
+    if message.media_group_id and core.MEDIA_GROUP_WINDOW > 0:
+        media_group_collector.add(message) # Analyzed together with the rest of its album by handle_album
+        return
+    with core.trace_context(handler='photo', chat_id=message.chat.id, message_id=message.message_id):
+        await _handle_photo([message])
+
+async def handle_album(messages):
+    """Async twin of bot.handle_album, run in the chat's turn so it stays in order with the chat's other updates."""
+    first = messages[0]
+    async with chat_turn(first.chat.id):
+        with core.trace_context(handler='photo', chat_id=first.chat.id, message_id=first.message_id, photos=len(messages)):
+            await _handle_photo(messages)
+
+def start_album(messages):
+    task = asyncio.create_task(handle_album(messages))
+    _in_flight.add(task)
+    task.add_done_callback(_in_flight.discard)
+
+# Timers run on the event loop, and the album is handled as its own task
+media_group_collector = core.MediaGroupCollector(core.MEDIA_GROUP_WINDOW, core.MEDIA_GROUP_MAX_WAIT, start_album,
+                                                 call_later=lambda delay, fn, *args: asyncio.get_running_loop().call_later(delay, fn, *args))
+
+async def _handle_photo(messages):
+    message = messages[0]
+    chat_id = str(message.chat.id)
+    user_settings = core.user_data.get(chat_id, {'lang': 'en', 'mode': 'learn', 'sub_mode': None})
+    lang = user_settings['lang']
+    current_mode = user_settings['mode']
+    current_sub_mode = user_settings['sub_mode']
+
+    mode_error = core.get_photo_mode_error(lang, current_mode, current_sub_mode)
+    if mode_error:
+        await abot.reply_to(message, mode_error)
+        return
+
+    quota_error = await asyncio.to_thread(core.get_quota_error, chat_id, lang)
+    if quota_error:
+        await abot.reply_to(message, quota_error)
+        return
+
+    with core.span('rate_limit'):
+        allowed = await core.chat_rate_limiter.acquire_async(chat_id)
+    if not allowed:
+        await abot.reply_to(message, core.get_slow_down_text(lang))
+        return
+
+    with core.span('placeholder'):
+        processing_message = await abot.reply_to(message, core.get_processing_text(lang))
+    try:
+        photos = [core.select_photo_size(m.photo) for m in messages[:core.MEDIA_GROUP_MAX_PHOTOS]]
+        cache_key = f"{','.join(photo.file_unique_id for photo in photos)}:{current_mode}:{current_sub_mode}:{lang}"
+        with core.span('analysis'):
+            reply_text, setup_data = await core.analysis_cache.get_or_compute_async(
+                cache_key, lambda: analyze_chart_images([photo.file_id for photo in photos], lang, current_mode, current_sub_mode, chat_id)
+            )
+    except Exception as e:
+        if isinstance(e, core.NotAChartError):
+            core.chat_rate_limiter.refund(chat_id) # No model call was made
+        reply_text, setup_data = core.get_chart_error_text(e, lang), None
+    if setup_data:
+        core.journal_signal(chat_id, current_sub_mode, setup_data)
+    with core.span('reply'):
+        await abot.edit_message_text(chat_id=chat_id, message_id=processing_message.message_id, text=reply_text)
+
+# ========== OHLC DOCUMENTS ==========
+@abot.message_handler(content_types=["document"], func=lambda m: core.is_ohlc_document(m.document, m.caption) and core.is_addressed_to_bot(m))
+async def handle_document(message):
+    with core.trace_context(handler='document', chat_id=message.chat.id, message_id=message.message_id):
+        await _handle_document(message)
+
+async def _handle_document(message):
+    """Async twin of bot._handle_document; parsing and the indicators run in a thread."""
+    chat_id = str(message.chat.id)
+    lang = core.user_data.get(chat_id, {}).get('lang', 'en')
+    document_error = core.get_ohlc_document_error(lang, message.document)
+    if document_error:
+        await abot.reply_to(message, document_error)
+        return
+    try:
+        with core.span('download'):
+            file_info = await abot.get_file(message.document.file_id)
+            data = await abot.download_file(file_info.file_path)
+        reply_text = await asyncio.to_thread(core.analyze_ohlc_document, data, message.document.file_name, lang)
+    except Exception as e:
+        reply_text = core.get_ohlc_error_text(e, lang)
+    with core.span('reply'):
+        for part in core.split_message(reply_text):
+            await abot.reply_to(message, part)
+
+# ========== UPDATE INGESTION ==========
+_in_flight = set()
+_chat_locks = {} # chat_id -> [asyncio.Lock, pending update count]
+ingest_stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+@contextlib.asynccontextmanager
+async def chat_turn(chat_id):
+    """Waits until nothing else of the chat is being handled, so each chat is handled in order."""
+    entry = _chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _chat_locks[chat_id]
+
+async def process_update(update, received_at):
+    """Runs an update through the handlers, one at a time per chat."""
+    async with chat_turn(core.get_update_chat_id(update)):
+        wait = time.monotonic() - received_at
+        ingest_stats['wait_total'] += wait
+        ingest_stats['wait_max'] = max(ingest_stats['wait_max'], wait)
+        try:
+            await asyncio.to_thread(core.refresh_user_data) # Pick up settings other workers changed
+            with core.trace_context(update_id=update.update_id):
+                await abot.process_new_updates([update])
+            ingest_stats['processed'] += 1
+        except Exception as e:
+            ingest_stats['failed'] += 1
+            print(f"Warning: Failed to process update {update.update_id}: {e}")
+
+# ========== HTTP ROUTES ==========
+async def home(request):
+    return web.Response(text="🤖 Bot is running via webhook (asyncio)!")
+
+async def webhook(request):
+    if request.content_type != 'application/json':
+        return web.Response(text="Invalid request", status=403)
+    json_string = await request.text()
+    if core.UPDATE_RECORD_FILE:
+        core.record_update(json_string)
+    update = telebot.types.Update.de_json(json_string)
+    # The dedup store may be sqlite or Redis, so its calls run in a thread
+    if await asyncio.to_thread(core.deduplicator.check_and_add, update.update_id):
+        core.count_update('duplicate')
+        return web.Response(text="OK")
+    if len(_in_flight) >= ASYNC_MAX_IN_FLIGHT:
+        await asyncio.to_thread(core.deduplicator.forget, update.update_id)
+        ingest_stats['rejected'] += 1
+        core.count_update('rejected')
+        return web.Response(text="Too many updates in flight", status=503)
+    ingest_stats['accepted'] += 1
+    core.count_update('accepted')
+    task = asyncio.create_task(process_update(update, time.monotonic()))
+    _in_flight.add(task)
+    task.add_done_callback(_in_flight.discard)
+    return web.Response(text="OK")
+
+async def stats(request):
+    done = ingest_stats['processed'] + ingest_stats['failed']
+    data = core.collect_stats()
+    data['media_groups'] = media_group_collector.snapshot()
+    data['ingest'] = {**ingest_stats, 'mode': 'async', 'in_flight': len(_in_flight), 'chats_in_flight': len(_chat_locks),
+                      'wait_avg': ingest_stats['wait_total'] / done if done else 0.0}
+    return web.json_response(data)
+
+async def usage(request):
+    if not core.usage_report_allowed(request.headers.get('Authorization')):
+        raise web.HTTPNotFound()
+    top = request.query.get('top', '10')
+    return web.json_response(await asyncio.to_thread(core.usage_ledger.report, top=int(top) if top.isdigit() else 10, day=request.query.get('day')))
+
+async def metrics(request):
+    return web.Response(text=core.metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+def create_app():
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_post("/webhook", webhook)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/usage", usage)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+async def on_startup(app):
+    me = await asyncio.to_thread(core.get_bot_identity) # Resolved once so the group pre-filter never blocks the loop
+    print(f"Running as @{me.username}")
+    core.cleanup_worker.start() # Its first sweep removes what a previous process left behind
+    info = await abot.get_webhook_info() # Same check as bot.ensure_webhook
+    if info.url == core.WEBHOOK_URL:
+        print(f"Webhook already set to {core.WEBHOOK_URL} ({info.pending_update_count} pending updates)")
+    else:
+        await abot.set_webhook(url=core.WEBHOOK_URL)
+        print(f"Webhook set to {core.WEBHOOK_URL}")
+
+async def on_cleanup(app):
+    await abot.close_session()
+
+if __name__ == "__main__":
+    app = create_app()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    port = int(os.environ.get("PORT", 5000))
+    print(f"Starting asyncio app on port {port} with webhook URL: {core.WEBHOOK_URL}")
+    web.run_app(app, host="0.0.0.0", port=port)
@@ -0,0 +1,55 @@
+"""
+Gunicorn settings for running the Flask app with several worker processes.
+
+Start with `gunicorn -c gunicorn.conf.py bot:app`. One worker is the default. With more than one worker
+(WEB_CONCURRENCY), share state between them, or gunicorn refuses to start:
+  SETTINGS_BACKEND=sqlite (one host) or redis (many hosts)
+  DEDUP_BACKEND=sqlite or redis
+  INGEST_BACKEND=sqlite or redis, so updates for a chat are processed in order by whichever worker leases its shard
+Albums, conversation memory, rate limits, caches and usage quotas stay per worker.
+"""
+import os
+from dotenv import load_dotenv
+
+load_dotenv() # The checks below and on_starting read the same .env as bot.py
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+if workers > 1:
+    # With per-process queues and dedup, a chat's updates would be spread over the workers and processed out of order,
+    # and json/log settings files are rewritten or replayed by each worker on its own, so writes would be lost
+    unshared = [name for name, default in (("SETTINGS_BACKEND", "sqlite"), ("INGEST_BACKEND", "local"), ("DEDUP_BACKEND", "memory"))
+                if os.environ.get(name, default) not in ("sqlite", "redis")]
+    if unshared:
+        raise SystemExit(f"WEB_CONCURRENCY={workers} needs shared state: set {' and '.join(unshared)} to sqlite or redis.")
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+preload_app = False # Each worker opens its own sqlite/Redis connections and threads
+
+
+def on_starting(server):
+    """
+    Registers the webhook once in the master, instead of once per worker.
+    bot is not imported here: workers would inherit its sqlite connections through fork.
+    """
+    import telebot
+    webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/webhook"
+    webhook_bot = telebot.TeleBot(os.getenv("BOT_TOKEN"))
+    # Same check as bot.ensure_webhook: a redeploy to the same host keeps the webhook and loses no updates
+    if webhook_bot.get_webhook_info().url == webhook_url:
+        server.log.info(f"Webhook already set to {webhook_url}")
+        return
+    webhook_bot.set_webhook(url=webhook_url)
+    server.log.info(f"Webhook set to {webhook_url}")
+
+
+def post_worker_init(worker):
+    """
+    Starts the shared-queue consumers right away, so queued updates drain before the first new request, and the
+    cleanup thread, whose sweeps run in whichever worker holds the sweep lock.
+    """
+    import bot
+    if bot.INGEST_BACKEND != 'local':
+        bot.dispatcher.start()
+    bot.cleanup_worker.start()